@@ -0,0 +1,68 @@
+"""
+Measures how long a fresh chirp process takes to import the app and answer its first request, which is most of
+the time a new replica takes to become ready. Each run is a new process so nothing is already imported.
+
+Run from the chirp directory:
+
+    python benchmarks/benchmark_startup.py --repeats 5
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def measure() -> None:
+    """
+    Imports chirp and posts to /subscribe, then prints the time taken by each in seconds
+    """
+
+    start = time.perf_counter()
+    import chirp
+    imported = time.perf_counter()
+
+    # Only the verification code is saved and the message queued, so no request reaches Twilio or S3
+    response = chirp.create_app().test_client().post('/subscribe', data={'phone': '07000000000', 'topic': 'red'})
+    answered = time.perf_counter()
+
+    if response.status_code != 200:
+        raise RuntimeError(response.get_json())
+
+    print(imported - start, answered - imported)
+
+
+def main(repeats: int) -> None:
+
+    chirp_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ, OUTBOUND_QUEUE_URL='spool://' + os.path.join(tempfile.mkdtemp(), 'outbox'))
+
+    timings = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--measure'], cwd=chirp_directory, env=environment,
+            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        timings.append([float(value) for value in output.split()])
+
+    import_times, request_times = zip(*timings)
+
+    print('{:>20} {:>12} {:>12}'.format('', 'median ms', 'max ms'))
+    for name, times in [('import', import_times), ('first request', request_times),
+                        ('total', [sum(timing) for timing in timings])]:
+        print('{:>20} {:>12.1f} {:>12.1f}'.format(name, statistics.median(times) * 1000, max(times) * 1000))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks the start up time of chirp')
+    parser.add_argument('--repeats', type=int, default=5, help='The number of fresh processes to time')
+    parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        sys.path.insert(0, os.getcwd())
+        measure()
+    else:
+        main(args.repeats)
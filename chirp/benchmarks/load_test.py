@@ -0,0 +1,248 @@
+"""
+Load tests the /subscribe and /subscribe/verify routes with Twilio and S3 stubbed out, measuring the requests
+per second and the latency of each route. The stubs wait for --latency seconds to stand in for the network.
+
+Run from the chirp directory, comparing the development server with gunicorn:
+
+    python benchmarks/load_test.py --server flask --users 16 --requests 50
+    python benchmarks/load_test.py --server gunicorn --workers 4 --threads 8 --users 16 --requests 50
+    python benchmarks/load_test.py --server gunicorn --workers 2 --worker-class gevent --users 64 --requests 20
+"""
+import argparse
+import http.client
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The code every stubbed verification message contains
+CODE = 123456
+
+
+class StubTwilioClient:
+    """
+    A Twilio client which waits instead of sending messages
+    """
+
+    class Messages:
+
+        def __init__(self, latency):
+            self.latency = latency
+
+        def create(self, from_, body, to):
+            time.sleep(self.latency)
+            return {'sid': 'SM{}'.format(to)}
+
+    def __init__(self, latency):
+        self.messages = self.Messages(latency)
+
+
+class StubS3Resource:
+    """
+    An S3 resource which waits instead of saving or deleting objects
+    """
+
+    class StubObject:
+
+        def __init__(self, latency):
+            self.latency = latency
+
+        def put(self, Body):
+            time.sleep(self.latency)
+
+        def delete(self):
+            time.sleep(self.latency)
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def Object(self, bucket_name, key):
+        return StubS3Resource.StubObject(self.latency)
+
+
+def create_stubbed_app(latency: float):
+    """
+    Imports chirp with Twilio and S3 stubbed and a fixed verification code
+
+    :param float latency: The time in seconds each stubbed call waits for
+
+    :return: flask.Flask app: The chirp app
+    """
+
+    import chirp
+
+    chirp.globals['twilio_client'] = StubTwilioClient(latency)
+    chirp.globals['s3'] = StubS3Resource(latency)
+    chirp.globals['bucket_name'] = 'subscribers'
+    chirp.randint = lambda low, high: CODE
+
+    return chirp.create_app()
+
+
+def serve_flask(app, port: int) -> None:
+    """
+    Serves the app with the single threaded development server used by flask run
+    """
+    from werkzeug.serving import make_server
+    make_server('127.0.0.1', port, app, threaded=False).serve_forever()
+
+
+def serve_gunicorn(latency: float, port: int, workers: int, threads: int, worker_class: str) -> None:
+    """
+    Serves the app with gunicorn using the settings in gunicorn.conf.py
+    """
+    import runpy
+    from gunicorn.app.base import BaseApplication
+
+    settings = runpy.run_path(
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gunicorn.conf.py'))
+
+    class StubbedApplication(BaseApplication):
+
+        def load_config(self):
+            for name, value in settings.items():
+                if name in self.cfg.settings:
+                    self.cfg.set(name, value)
+            self.cfg.set('bind', '127.0.0.1:{}'.format(port))
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', worker_class)
+            self.cfg.set('accesslog', None)
+
+        def load(self):
+            # Import chirp in each worker, as gunicorn does without --preload, so it is imported after gevent
+            # has patched the standard library and no connections are carried over from the parent process
+            return create_stubbed_app(latency)
+
+    StubbedApplication().run()
+
+
+def post(connection: http.client.HTTPConnection, path: str, form: dict):
+    """
+    Posts a form, reusing the connection
+
+    :return: tuple(int, float) response: The status code and the latency in seconds
+    """
+    start = time.perf_counter()
+    connection.request('POST', path, body=urlencode(form),
+                       headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    response = connection.getresponse()
+    response.read()
+    return response.status, time.perf_counter() - start
+
+
+def run_user(port: int, user: int, requests: int) -> dict:
+    """
+    Subscribes and verifies a number of phone numbers one after another over one kept alive connection
+
+    :return: dict latencies: The latencies of the successful requests and the number of failures for each route
+    """
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    results = {'/subscribe': [], '/subscribe/verify': [], 'failures': 0}
+
+    for request in range(requests):
+        phone = '07{:04d}{:05d}'.format(user, request)
+
+        for path, form in [('/subscribe', {'phone': phone, 'topic': 'red'}),
+                           ('/subscribe/verify', {'phone': phone, 'code': CODE, 'opt-in': 'on'})]:
+            status, latency = post(connection, path, form)
+            if status == 200:
+                results[path].append(latency)
+            else:
+                results['failures'] += 1
+
+    connection.close()
+    return results
+
+
+def wait_for_server(port: int, timeout: float = 30, settle_time: float = 3) -> None:
+    """
+    Waits until the server answers a request, then a little longer so every worker has loaded the app and the
+    start up isn't counted in the latencies
+    """
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            time.sleep(settle_time)
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('The server did not start')
+
+
+def main(server: str, port: int, workers: int, threads: int, worker_class: str, users: int, requests: int,
+         latency: float) -> None:
+
+    # Share the codes and the outbound messages between the gunicorn workers
+    directory = tempfile.mkdtemp()
+    os.environ['VERIFICATION_CODE_STORE_URL'] = 'sqlite:///' + os.path.join(directory, 'codes.db')
+    os.environ['OUTBOUND_QUEUE_URL'] = 'spool://' + os.path.join(directory, 'outbox')
+    os.environ.setdefault('TWILIO_MESSAGES_PER_SECOND', '100000')
+    os.environ.setdefault('TWILIO_MESSAGES_BURST', '100000')
+
+    if server == 'flask':
+        threading.Thread(target=serve_flask, args=(create_stubbed_app(latency), port), daemon=True).start()
+    else:
+        # gunicorn has to run in the main thread of its own process
+        pid = os.fork()
+        if pid == 0:
+            serve_gunicorn(latency, port, workers, threads, worker_class)
+            os._exit(0)
+
+    try:
+        wait_for_server(port)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=users) as executor:
+            results = list(executor.map(lambda user: run_user(port, user, requests), range(users)))
+        elapsed = time.perf_counter() - start
+
+    finally:
+        if server != 'flask':
+            os.kill(pid, 15)
+            os.waitpid(pid, 0)
+
+    total = sum(len(result[path]) for result in results for path in ['/subscribe', '/subscribe/verify'])
+    if server != 'flask':
+        server = '{} {}'.format(server, worker_class)
+
+    print('{} server, {} users, {} requests in {:.2f} secs, {:.1f} requests/sec, {} failures'.format(
+        server, users, total, elapsed, total / elapsed, sum(result['failures'] for result in results)))
+
+    print('{:>20} {:>10} {:>10} {:>10}'.format('route', 'requests', 'p50 ms', 'p99 ms'))
+    for path in ['/subscribe', '/subscribe/verify']:
+        latencies = np.array([latency for result in results for latency in result[path]]) * 1000
+        if len(latencies) == 0:
+            continue
+        print('{:>20} {:>10} {:>10.1f} {:>10.1f}'.format(
+            path, len(latencies), np.percentile(latencies, 50), np.percentile(latencies, 99)))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Load tests the chirp subscription routes')
+    parser.add_argument('--server', choices=['flask', 'gunicorn'], default='gunicorn',
+                        help='The server to run chirp with')
+    parser.add_argument('--port', type=int, default=5055, help='The port to serve on')
+    parser.add_argument('--workers', type=int, default=4, help='The number of gunicorn workers')
+    parser.add_argument('--threads', type=int, default=8, help='The number of threads in each gunicorn worker')
+    parser.add_argument('--worker-class', choices=['gthread', 'gevent'], default='gthread',
+                        help='The type of gunicorn worker')
+    parser.add_argument('--users', type=int, default=16, help='The number of concurrent users')
+    parser.add_argument('--requests', type=int, default=50, help='The number of phone numbers each user subscribes')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='The time in seconds each stubbed Twilio and S3 call waits for')
+    args = parser.parse_args()
+
+    main(args.server, args.port, args.workers, args.threads, args.worker_class, args.users, args.requests,
+         args.latency)
@@ -0,0 +1,360 @@
+import argparse
+import csv
+import hashlib
+import io
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# The values of the opt-in column which mean the subscriber opted in
+OPT_IN_VALUES = ['true', '1', 'yes', 'y', 'on']
+
+# The object naming the current subscriber snapshot and the prefixes of the snapshots bucket, see silence/snapshots.py
+CURRENT_SNAPSHOT_KEY = 'current-snapshot.json'
+SNAPSHOTS_PREFIX = 'snapshots/'
+TOMBSTONES_PREFIX = 'tombstones/'
+
+
+def read_subscribers(lines, file_format):
+    """
+    This reads the subscribers from a CSV file with a header row of phone, topic and opt-in,
+    or from NDJSON with one object holding those keys on each line
+
+    param: (iterable[str]) lines: The lines of the file
+    param: (str) file_format: The format of the file, 'csv' or 'ndjson'
+
+    returns: (generator[dict]) subscribers: Each subscriber, or a dict holding an 'error' for
+    a line which couldn't be read so that the subscribers keep their position in the file
+    """
+
+    if file_format == 'csv':
+        for subscriber in csv.DictReader(lines):
+            yield subscriber
+        return
+
+    if file_format != 'ndjson':
+        raise ValueError("The format {} is not supported, please use one of ['csv', 'ndjson']".format(file_format))
+
+    for line in lines:
+        if not line.strip():
+            yield {'error': 'The line is empty'}
+            continue
+        try:
+            subscriber = json.loads(line)
+        except ValueError:
+            yield {'error': 'The line is not valid JSON'}
+            continue
+        yield subscriber if isinstance(subscriber, dict) else {'error': 'The line is not a JSON object'}
+
+
+def validate_subscriber(subscriber, levels, verify_phone_number_function):
+    """
+    This checks a subscriber which has already been verified elsewhere and creates the payload
+    to save for them, in the same form as a subscriber who verified through /subscribe/verify
+
+    param: (dict) subscriber: The subscriber as read from the file
+    param: (list[str]) levels: The topics which can be subscribed to
+    param: (func) verify_phone_number_function: The function to check the format of the phone number
+
+    returns: (dict) payload: The payload to save, or None if the subscriber is invalid
+    returns: (str) message: Why the subscriber is invalid, or None if they are valid
+    """
+
+    if 'error' in subscriber:
+        return None, subscriber['error']
+
+    phone = str(subscriber.get('phone') or '').strip()
+    topic = str(subscriber.get('topic') or '').strip().lower()
+
+    phone_verification = verify_phone_number_function(phone)
+    if not phone_verification['success']:
+        return None, phone_verification['message']
+
+    if topic not in levels:
+        return None, 'The topic {} is not one of {}'.format(topic, sorted(levels))
+
+    opt_in = 'True' if str(subscriber.get('opt-in', '')).strip().lower() in OPT_IN_VALUES else 'False'
+
+    return {'phone': phone, 'topic': topic, 'opt-in': opt_in}, None
+
+
+def load_checkpoint(path):
+    """
+    param: (str) path: The path of the checkpoint file
+
+    returns: (dict) checkpoint: The progress saved by an earlier import, or None if there isn't one
+    """
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def save_checkpoint(path, checkpoint):
+    """
+    This saves the progress of an import, replacing the file in one step so that a crash
+    never leaves a partial checkpoint
+
+    param: (str) path: The path of the checkpoint file
+    param: (dict) checkpoint: The progress of the import
+    """
+
+    with open(path + '.tmp', 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(path + '.tmp', path)
+
+
+def import_subscribers(subscribers, validate_function, save_function, workers=10, batch_size=500,
+                       checkpoint_path=None, source=None, progress_function=None, max_errors=100):
+    """
+    This saves a batch of subscribers, validating each one and saving the valid ones from a pool
+    of threads. The subscribers are handled in batches and the progress is checkpointed after
+    each batch, so an import which is stopped can be resumed from the last whole batch.
+
+    param: (iterable[dict]) subscribers: The subscribers, e.g. from read_subscribers
+    param: (func) validate_function: The function to validate a subscriber, returning the payload
+    to save or None and why it is invalid
+    param: (func) save_function: The function to save a payload, returning a dict with its 'success'
+    and a 'message'
+    param: (int) workers: The number of subscribers to save at once, which should be no more than
+    the connections in the S3 client's pool
+    param: (int) batch_size: The number of subscribers between checkpoints
+    param: (str) checkpoint_path: The path of the checkpoint file, if None the import can't be resumed
+    param: (str) source: The name of the file being imported, a checkpoint for another file is refused
+    param: (func) progress_function: The function to call with the report after each batch
+    param: (int) max_errors: The number of invalid or failed subscribers to keep the details of
+
+    returns: (dict) report: The number of subscribers processed, saved, invalid and failed, and the
+    position and message of the first max_errors which weren't saved
+    """
+
+    report = {'source': source, 'processed': 0, 'saved': 0, 'invalid': 0, 'failed': 0, 'errors': []}
+
+    checkpoint = load_checkpoint(checkpoint_path) if checkpoint_path is not None else None
+    if checkpoint is not None:
+        if checkpoint['source'] != source:
+            raise ValueError('The checkpoint {} is for {} not {}'.format(checkpoint_path, checkpoint['source'], source))
+        report.update(checkpoint)
+        logging.info('Resuming the import of {} after {} subscribers'.format(source, report['processed']))
+
+    def add_error(number, message):
+        if len(report['errors']) < max_errors:
+            report['errors'].append({'record': number, 'message': message})
+
+    start = time.perf_counter()
+    numbered_subscribers = enumerate(subscribers, start=1)
+
+    # Skip the subscribers handled before the checkpoint
+    numbered_subscribers = itertools.islice(numbered_subscribers, report['processed'], None)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        while True:
+            batch = list(itertools.islice(numbered_subscribers, batch_size))
+            if not batch:
+                break
+
+            saves = []
+            for number, subscriber in batch:
+                payload, message = validate_function(subscriber)
+                if payload is None:
+                    report['invalid'] += 1
+                    add_error(number, message)
+                    continue
+                saves.append((number, executor.submit(save_function, payload)))
+
+            for number, save in saves:
+                try:
+                    save_status = save.result()
+                except Exception as error:
+                    save_status = {'success': False, 'message': str(error)}
+                if save_status['success']:
+                    report['saved'] += 1
+                else:
+                    report['failed'] += 1
+                    add_error(number, save_status['message'])
+
+            report['processed'] = batch[-1][0]
+
+            if checkpoint_path is not None:
+                save_checkpoint(checkpoint_path, report)
+
+            if progress_function is not None:
+                progress_function(dict(report, elapsed=time.perf_counter() - start))
+
+    return report
+
+
+def list_keys(s3, bucket_name, prefix=''):
+    """
+    param: (boto3.resource) s3: The boto3 S3 resource
+    param: (str) bucket_name: The bucket to list
+    param: (str) prefix: The prefix of the keys
+
+    returns: (generator[str]) keys: The key of each object under the prefix
+    """
+
+    return (summary.key for summary in s3.Bucket(bucket_name).objects.filter(Prefix=prefix))
+
+
+def iterate_snapshot_subscribers(s3, snapshots_bucket_name):
+    """
+    This reads the subscribers in the current snapshot compacted by silence, see silence/snapshots.py
+
+    param: (boto3.resource) s3: The boto3 S3 resource
+    param: (str) snapshots_bucket_name: The bucket holding the subscriber snapshots
+
+    returns: (generator[dict]) subscribers: The phone hash and payload of each subscriber, there
+    are none until the first compaction
+    """
+
+    if CURRENT_SNAPSHOT_KEY not in list_keys(s3, snapshots_bucket_name, CURRENT_SNAPSHOT_KEY):
+        return
+
+    # Only the export reads the snapshots, so chirp doesn't load pyarrow otherwise
+    import pyarrow.parquet as pq
+
+    snapshot = json.loads(s3.Object(snapshots_bucket_name, CURRENT_SNAPSHOT_KEY).get()['Body'].read())['snapshot']
+
+    for key in sorted(list_keys(s3, snapshots_bucket_name, '{}snapshot_id={}/'.format(SNAPSHOTS_PREFIX, snapshot))):
+        table = pq.read_table(io.BytesIO(s3.Object(snapshots_bucket_name, key).get()['Body'].read()))
+        for row in table.to_pylist():
+            yield row['phone_hash'], {'phone': row['phone'], 'topic': row['topic'], 'opt-in': row['opt_in']}
+
+
+def iterate_subscribers(s3, bucket_name, workers=10, batch_size=1000, snapshots_bucket_name=None):
+    """
+    This reads every subscriber saved in S3, fetching the objects from a pool of threads. With
+    snapshots the subscribers compacted into the current snapshot are read as well, leaving out
+    those saved again or unsubscribed since.
+
+    param: (boto3.resource) s3: The boto3 S3 resource
+    param: (str) bucket_name: The bucket the subscribers are saved in
+    param: (int) workers: The number of objects to fetch at once
+    param: (int) batch_size: The number of objects listed before fetching them
+    param: (str) snapshots_bucket_name: The bucket holding the subscriber snapshots and the
+    tombstones, if None only the subscribers saved as their own object are read
+
+    returns: (generator[dict]) subscribers: The payload saved for each subscriber
+    """
+
+    def get_object(bucket_and_key):
+        # A compaction can delete an object after it was listed, it is then in the snapshot read below
+        try:
+            return json.loads(s3.Object(*bucket_and_key).get()['Body'].read())
+        except s3.meta.client.exceptions.NoSuchKey:
+            return None
+
+    # The subscribers may be at the top of the bucket or partitioned by topic
+    keys = ((bucket_name, key) for key in list_keys(s3, bucket_name) if key.split('/')[-1].startswith('subscriber-'))
+
+    if snapshots_bucket_name is None:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                batch = list(itertools.islice(keys, batch_size))
+                if not batch:
+                    break
+                yield from (subscriber for subscriber in executor.map(get_object, batch) if subscriber is not None)
+        return
+
+    # List the subscribers and tombstones before reading the snapshot, as silence's compaction does, so anything
+    # deleted by a compaction in the meantime is in the snapshot read
+    keys = list(keys)
+    keys += [(snapshots_bucket_name, key) for key in list_keys(s3, snapshots_bucket_name, TOMBSTONES_PREFIX)]
+
+    replaced = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for json_object in executor.map(get_object, keys):
+            if json_object is None:
+                continue
+            # A tombstone only holds the phone hash, a subscriber saved since the snapshot replaces it
+            if 'phone_hash' in json_object:
+                replaced.add(json_object['phone_hash'])
+                continue
+            replaced.add(hashlib.md5(json_object['phone'].encode('utf-8')).hexdigest())
+            yield json_object
+
+    for phone_hash, subscriber in iterate_snapshot_subscribers(s3, snapshots_bucket_name):
+        if phone_hash not in replaced:
+            yield subscriber
+
+
+def export_subscribers(s3, bucket_name, output, workers=10, snapshots_bucket_name=None):
+    """
+    This writes every subscriber saved in S3 to a file as NDJSON, which can be imported again
+
+    param: (boto3.resource) s3: The boto3 S3 resource
+    param: (str) bucket_name: The bucket the subscribers are saved in
+    param: (file) output: The file to write to
+    param: (int) workers: The number of objects to fetch at once
+    param: (str) snapshots_bucket_name: The bucket holding the subscriber snapshots, if any
+
+    returns: (int) exported: The number of subscribers written
+    """
+
+    exported = 0
+
+    for subscriber in iterate_subscribers(s3, bucket_name, workers, snapshots_bucket_name=snapshots_bucket_name):
+        output.write(json.dumps(subscriber) + '\n')
+        exported += 1
+
+    return exported
+
+
+def log_progress(report):
+    """
+    param: (dict) report: The progress of the import
+    """
+    logging.info('{processed} processed, {saved} saved, {invalid} invalid, {failed} failed in {elapsed:.0f} secs '
+                 '({rate:.0f} per sec)'.format(rate=report['processed'] / max(report['elapsed'], 1e-9), **report))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Imports pre-verified subscribers into S3 or exports them')
+    parser.add_argument('command', choices=['import', 'export'], help='Whether to import or export subscribers')
+    parser.add_argument('path', help='The CSV or NDJSON file to import from, or the NDJSON file to export to')
+    parser.add_argument('--format', choices=['csv', 'ndjson'], default=None,
+                        help='The format of the file to import, by default taken from its extension')
+    parser.add_argument('--checkpoint', default=None,
+                        help='The file to save the progress of the import to, and to resume it from')
+    parser.add_argument('--workers', type=int, default=10, help='The number of subscribers to save or fetch at once')
+    parser.add_argument('--batch-size', type=int, default=500, help='The number of subscribers between checkpoints')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    # Give the S3 client a connection for each worker, it is created when chirp first uses it
+    os.environ.setdefault('AWS_MAX_POOL_CONNECTIONS', str(args.workers))
+    import chirp
+
+    if args.command == 'export':
+        with open(args.path, 'w') as output:
+            print(export_subscribers(
+                chirp.get_s3(), chirp.globals['bucket_name'], output, args.workers,
+                chirp.globals['snapshots_bucket_name']))
+        sys.exit(0)
+
+    file_format = args.format or ('csv' if args.path.endswith('.csv') else 'ndjson')
+
+    with open(args.path, newline='') as input_file:
+        report = import_subscribers(
+            subscribers=read_subscribers(input_file, file_format),
+            validate_function=lambda subscriber: validate_subscriber(
+                subscriber, chirp.globals['levels'], chirp.verify_phone_number),
+            save_function=lambda payload: chirp.save_user_to_s3(
+                chirp.get_s3(), chirp.globals['bucket_name'], payload, chirp.globals['snapshots_bucket_name'],
+                chirp.globals['subscriber_layout']),
+            workers=args.workers,
+            batch_size=args.batch_size,
+            checkpoint_path=args.checkpoint,
+            source=os.path.abspath(args.path),
+            progress_function=log_progress)
+
+    print(json.dumps(report, indent=2))
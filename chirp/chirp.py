@@ -1,17 +1,33 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
-import boto3
+from contextlib import contextmanager
+import fcntl
 import json
 import hashlib
+import hmac
+import io
 import os
-from twilio.rest import Client
 from random import randint
 import datetime
 import pytz
+import throttle
+import code_store
+import outbox
+import metrics
+import bulk
+import logging
+import threading
+import time
 
 globals = {}
 # Amazon Web Services bucket name to hold the subsciber information
 globals['bucket_name'] = os.getenv("SUBSCRIBERS_S3_BUCKET_NAME", None)
+# The bucket to write a tombstone to when someone unsubscribes, so that they are removed from the
+# subscriber snapshots compacted by silence, if None no tombstones are written
+globals['snapshots_bucket_name'] = os.getenv("SUBSCRIBER_SNAPSHOTS_S3_BUCKET_NAME", None)
+# How the subscribers are laid out in the bucket, 'flat' or 'topic' to partition them by their topic
+# so that silence only reads the subscribers at or below the current level
+globals['subscriber_layout'] = os.getenv("SUBSCRIBER_LAYOUT", "flat")
 # Get the Twilio account id and authorisation token
 globals['twilio_account_sid'] = os.getenv("TWILIO_ACCOUNT_ID", None)
 globals['twilio_auth_token'] = os.getenv("TWILIO_AUTH_TOKEN", None)
@@ -22,37 +38,284 @@ globals['levels'] = {
     "amber": "unhealthy for sensitive groups",
     "red": "unhealthy for everyone"
 }
-# Temporay storage for the verification codes
-globals['verification_codes'] = {}
-
-# Create the twilio client
-twilio_client = Client(
-    globals['twilio_account_sid'],
-    globals['twilio_auth_token'])
-
-# Create the flask app
-app = Flask(__name__)
-# Enable CORS
-CORS(app)
-
-# Pass in the access credentials via environment variables
-AWS_SERVER_PUBLIC_KEY = os.getenv("AWS_SERVER_PUBLIC_KEY", None)
-AWS_SERVER_SECRET_KEY = os.getenv("AWS_SERVER_SECRET_KEY", None)
-
-# Check if the environment variables exist, they are only required for external access
-if AWS_SERVER_PUBLIC_KEY is not None and AWS_SERVER_SECRET_KEY is not None:
-
-    session = boto3.Session(
-        aws_access_key_id=AWS_SERVER_PUBLIC_KEY,
-        aws_secret_access_key=AWS_SERVER_SECRET_KEY,
-        region_name='eu-west-2'
-    )
+# Temporary storage for the verification codes, shared between workers unless kept in memory
+globals['verification_code_store_url'] = os.getenv("VERIFICATION_CODE_STORE_URL", None)
+globals['verification_code_ttl'] = int(os.getenv("VERIFICATION_CODE_TTL", 3600))
+# Keeps the outbound messages within the Twilio account's sending limits, retrying briefly if throttled
+globals['twilio_throttle'] = throttle.Throttle(
+    bucket=throttle.TokenBucket(
+        rate=float(os.getenv("TWILIO_MESSAGES_PER_SECOND", 1)),
+        capacity=int(os.getenv("TWILIO_MESSAGES_BURST", 5))),
+    max_retries=int(os.getenv("TWILIO_MAX_RETRIES", 3)),
+    max_delay=5.0)
+
+# Where the verification and confirmation messages are queued to be sent in the background
+globals['outbound_queue_url'] = os.getenv("OUTBOUND_QUEUE_URL", "spool:///tmp/chirp/outbox")
+
+# The token which authorises the bulk import and export of subscribers, if None they are disabled
+globals['bulk_token'] = os.getenv("BULK_TOKEN", None)
+# The number of subscribers a bulk import saves at once
+globals['bulk_workers'] = int(os.getenv("BULK_WORKERS", 10))
+
+# Where each worker saves its metrics so that /metrics can report them for every worker, if None
+# /metrics only reports the worker answering the scrape
+globals['metrics_directory'] = os.getenv("METRICS_DIR", None)
+# When this worker last saved its metrics
+globals['metrics_saved'] = 0
+# The file in the metrics directory holding the metrics of the workers which have exited
+RETIRED_METRICS_FILE = 'retired.json'
+
+# Guards the creation of the clients, the code store and the outbound queue, which happens when they are first used
+clients_lock = threading.Lock()
+
+# The routes are added to an app by create_app
+routes = Blueprint('chirp', __name__)
+
+
+def get_twilio_client():
+    """
+    This gets the Twilio client, creating it the first time it is used so that importing
+    chirp doesn't pay for loading the Twilio library
+
+    returns: (Twilio Client) client: The Twilio client, keeping a connection open for each
+    thread which can send a message
+    """
+
+    if 'twilio_client' not in globals:
+        with clients_lock:
+            if 'twilio_client' not in globals:
+                import clients
+                globals['twilio_client'] = clients.create_twilio_client(
+                    globals['twilio_account_sid'],
+                    globals['twilio_auth_token'],
+                    pool_connections=int(os.getenv("TWILIO_POOL_CONNECTIONS", 10)),
+                    timeout=float(os.getenv("TWILIO_TIMEOUT", 30)))
+
+    return globals['twilio_client']
+
+
+def get_s3():
+    """
+    This gets the S3 resource, creating it the first time it is used so that importing
+    chirp doesn't pay for loading boto3
+
+    returns: (boto3.resource) s3: The boto3 S3 resource
+    """
+
+    if 's3' not in globals:
+        with clients_lock:
+            if 's3' not in globals:
+                import clients
+                # Pass in the access credentials via environment variables, they are only required for
+                # external access. If they don't exist rely on a AWS role instead
+                globals['s3'] = clients.create_aws_client(
+                    service_name='s3',
+                    resource=True,
+                    public_key=os.getenv("AWS_SERVER_PUBLIC_KEY", None),
+                    secret_key=os.getenv("AWS_SERVER_SECRET_KEY", None),
+                    region='eu-west-2',
+                    max_pool_connections=int(os.getenv("AWS_MAX_POOL_CONNECTIONS", 10)),
+                    connect_timeout=float(os.getenv("AWS_CONNECT_TIMEOUT", 5)),
+                    read_timeout=float(os.getenv("AWS_READ_TIMEOUT", 30)),
+                    max_attempts=int(os.getenv("AWS_MAX_ATTEMPTS", 3)))
+
+    return globals['s3']
+
+
+def get_verification_codes():
+    """
+    This gets the store for the pending verification codes, creating it the first time it is
+    used so that importing chirp doesn't open the database or connect to Redis
+
+    returns: (code_store.TimedCodeStore) verification_codes: The store, timing each request to it
+    """
+
+    if 'verification_codes' not in globals:
+        with clients_lock:
+            if 'verification_codes' not in globals:
+                globals['verification_codes'] = code_store.TimedCodeStore(
+                    code_store.create_code_store(
+                        url=globals['verification_code_store_url'],
+                        ttl=globals['verification_code_ttl']),
+                    metrics.registry)
+
+    return globals['verification_codes']
+
+
+def get_outbox():
+    """
+    This gets the queue which sends messages in the background, creating it the first time it
+    is used so that importing chirp doesn't create the spool directory or connect to Redis. Its
+    workers are started if they aren't running in this process, gunicorn gets the queue as soon
+    as each worker starts so the messages already queued are sent.
+
+    returns: (outbox.OutboundQueue) outbound_queue: The queue, retrying any messages which fail
+    """
+
+    if 'outbox' not in globals:
+        with clients_lock:
+            if 'outbox' not in globals:
+                globals['outbox'] = outbox.OutboundQueue(
+                    broker=outbox.create_broker(globals['outbound_queue_url']),
+                    send_function=lambda phone_number, message_body: send_message(
+                        get_twilio_client(), phone_number, message_body, globals['twilio_throttle']),
+                    workers=int(os.getenv("OUTBOUND_QUEUE_WORKERS", 2)),
+                    max_attempts=int(os.getenv("OUTBOUND_QUEUE_MAX_ATTEMPTS", 5)))
+
+    globals['outbox'].start()
+
+    return globals['outbox']
+
+
+def create_app():
+    """
+    This creates the flask app with the chirp routes
+
+    returns: (Flask) app: The flask app
+    """
+
+    app = Flask(__name__)
+    # Enable CORS
+    CORS(app)
+    app.register_blueprint(routes)
+    app.before_request(start_request_timer)
+    app.after_request(record_request_metrics)
+
+    return app
+
+
+def start_request_timer():
+    """
+    This notes when the request started so that its latency can be recorded once it is answered
+    """
+    g.request_start = time.perf_counter()
+
+
+def record_request_metrics(response):
+    """
+    This records the latency and status code of a request by its route, and saves the worker's
+    metrics if they are shared with the other workers
+
+    param: (Response) response: The response to the request
+
+    returns: (Response) response: The same response
+    """
 
-    globals['s3'] = session.resource('s3')
+    # Label by the route rather than the path so that the number of series stays bounded
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
 
-# If no environment variables rely on a AWS role instead
-else:
-    globals['s3'] = boto3.resource('s3')
+    if 'request_start' in g:
+        metrics.registry.observe(
+            'chirp_request_seconds', time.perf_counter() - g.request_start,
+            labels={'route': route, 'method': request.method})
+    metrics.registry.increment(
+        'chirp_responses_total', labels={'route': route, 'method': request.method, 'status': response.status_code})
+
+    # Save at most once a second, a scrape may miss the last second of requests
+    if globals['metrics_directory'] is not None and time.time() - globals['metrics_saved'] >= 1:
+        globals['metrics_saved'] = time.time()
+        try:
+            save_metrics(globals['metrics_directory'])
+        except OSError:
+            logging.exception("The metrics couldn't be saved")
+
+    return response
+
+
+def save_metrics(directory):
+    """
+    This saves the metrics of this worker to a file named after its process id
+
+    param: (str) directory: The directory shared by the workers
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '{}.json'.format(os.getpid()))
+
+    # Replace the file in one step so a scrape never reads a partial file
+    with open(path + '.tmp', 'w') as metrics_file:
+        json.dump(metrics.registry.snapshot(), metrics_file)
+    os.replace(path + '.tmp', path)
+
+
+@contextmanager
+def lock_metrics(directory):
+    """
+    This holds a lock on the metrics directory, so that a scrape never reads the metrics of a
+    worker which has exited both in its own file and in the retired workers' file
+
+    param: (str) directory: The directory shared by the workers
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    with open(os.path.join(directory, '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_metrics(directory):
+    """
+    This combines the metrics saved by every worker with the current metrics of this one. The
+    metrics of workers which have exited are kept in one file so that the counters don't go
+    backwards.
+
+    param: (str) directory: The directory shared by the workers
+
+    returns: (metrics.Registry) registry: The combined metrics
+    """
+
+    registry = metrics.Registry()
+    registry.merge(metrics.registry.snapshot())
+
+    own_file = '{}.json'.format(os.getpid())
+
+    with lock_metrics(directory):
+        for file_name in os.listdir(directory):
+            if not file_name.endswith('.json') or file_name == own_file:
+                continue
+            try:
+                with open(os.path.join(directory, file_name)) as metrics_file:
+                    registry.merge(json.load(metrics_file))
+            except (OSError, ValueError):
+                logging.warning("The metrics in {} couldn't be read".format(file_name))
+
+    return registry
+
+
+def retire_metrics(directory, pid):
+    """
+    This merges the metrics saved by a worker which has exited into the retired workers' file
+    and removes its own file, so the directory doesn't grow as gunicorn restarts its workers
+
+    param: (str) directory: The directory shared by the workers
+    param: (int) pid: The process id of the worker which has exited
+    """
+
+    path = os.path.join(directory, '{}.json'.format(pid))
+    retired_path = os.path.join(directory, RETIRED_METRICS_FILE)
+
+    with lock_metrics(directory):
+        if not os.path.exists(path):
+            return
+
+        registry = metrics.Registry()
+        for file_path in [retired_path, path]:
+            try:
+                with open(file_path) as metrics_file:
+                    registry.merge(json.load(metrics_file))
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                logging.warning("The metrics in {} couldn't be read".format(file_path))
+
+        with open(retired_path + '.tmp', 'w') as metrics_file:
+            json.dump(registry.snapshot(), metrics_file)
+        os.replace(retired_path + '.tmp', retired_path)
+        os.remove(path)
 
 
 def get_details_from_request(request_body, parameters):
@@ -102,7 +365,47 @@ def hash_phone_number(phone_number):
     return phone_hash
 
 
-def save_user_to_s3(s3, bucket_name, json_payload):
+def get_tombstone_key(phone_hash):
+    """
+    param: (str) phone_hash: The hash of the subscriber's phone number
+
+    returns: (str) key: The key of the subscriber's tombstone in the snapshots bucket
+    """
+    return 'tombstones/tombstone-{}.json'.format(phone_hash)
+
+
+def get_subscriber_key(phone_hash, topic=None, layout='flat'):
+    """
+    param: (str) phone_hash: The hash of the subscriber's phone number
+    param: (str) topic: The topic the subscriber is subscribed to, only needed for the topic layout
+    param: (str) layout: How the subscribers are laid out, 'flat' or 'topic'
+
+    returns: (str) key: The key of the subscriber's file in the subscribers bucket
+    """
+
+    if layout == 'topic':
+        return 'topic={}/subscriber-{}.json'.format(topic, phone_hash)
+
+    return 'subscriber-{}.json'.format(phone_hash)
+
+
+def get_other_subscriber_keys(phone_hash, topic=None):
+    """
+    This gets the keys a subscriber may have been saved at other than the one for their
+    topic, that is under any other topic or in the flat layout
+
+    param: (str) phone_hash: The hash of the subscriber's phone number
+    param: (str) topic: The topic the subscriber is subscribed to, if None every key is returned
+
+    returns: (list[str]) keys: The other keys
+    """
+
+    keys = [get_subscriber_key(phone_hash, level, 'topic') for level in globals['levels'] if level != topic]
+
+    return keys + [get_subscriber_key(phone_hash)]
+
+
+def save_user_to_s3(s3, bucket_name, json_payload, snapshots_bucket_name=None, layout='flat'):
     """
     This function creates a json file for a subscriber and stores it in an S3
     bucket so that it can be queried by Amazon Athena
@@ -111,6 +414,10 @@ def save_user_to_s3(s3, bucket_name, json_payload):
     with Amazon S3
     param: (str) bucket_name: The bucket name in S3 to store the user information
     param: (dict) json_payload: The json payload to store in the json file
+    param: (str) snapshots_bucket_name: The bucket holding the subscriber snapshots, if provided
+    any tombstone left from the subscriber unsubscribing before is removed
+    param: (str) layout: How the subscribers are laid out, 'flat' or 'topic'. With the topic
+    layout the subscriber is removed from any other topic they were saved under.
 
     return: (dict) save_status: Holds details about the status of saving the user info
     """
@@ -120,8 +427,18 @@ def save_user_to_s3(s3, bucket_name, json_payload):
     phone_hash = hash_phone_number(json_payload['phone'])
     # Create and store the file in S3
     try:
-        s3.Object(bucket_name, 'subscriber-{}.json'.format(
-            phone_hash)).put(Body=json.dumps(json_payload))
+        with metrics.registry.time('chirp_s3_seconds', labels={'operation': 'put'}):
+            s3.Object(bucket_name, get_subscriber_key(phone_hash, json_payload['topic'], layout)).put(
+                Body=json.dumps(json_payload))
+        if layout == 'topic':
+            with metrics.registry.time('chirp_s3_seconds', labels={'operation': 'delete'}):
+                s3.Bucket(bucket_name).delete_objects(Delete={
+                    'Objects': [{'Key': key} for key in get_other_subscriber_keys(phone_hash, json_payload['topic'])],
+                    'Quiet': True
+                })
+        if snapshots_bucket_name is not None:
+            with metrics.registry.time('chirp_s3_seconds', labels={'operation': 'delete_tombstone'}):
+                s3.Object(snapshots_bucket_name, get_tombstone_key(phone_hash)).delete()
     except:
         save_status['success'] = False
         save_status['message'] = 'The saving of the user failed due to an unknown error'
@@ -132,7 +449,7 @@ def save_user_to_s3(s3, bucket_name, json_payload):
     return save_status
 
 
-def remove_user_from_s3(s3, bucket_name, phone):
+def remove_user_from_s3(s3, bucket_name, phone, snapshots_bucket_name=None, layout='flat'):
     """
     This function deletes a json file for a subscriber which is stored in S3
 
@@ -141,6 +458,10 @@ def remove_user_from_s3(s3, bucket_name, phone):
     param: (str) bucket_name: The bucket name in S3 to store the user information
     param: (str) phone: The phone number of the subscriber whos information should
     be deleted
+    param: (str) snapshots_bucket_name: The bucket holding the subscriber snapshots, if
+    provided a tombstone is written there to remove the subscriber from the snapshots
+    param: (str) layout: How the subscribers are laid out, 'flat' or 'topic'. With the topic
+    layout the subscriber's topic isn't known so they are removed from every topic.
 
     return: (dict) delete_status: Holds details about the status of deleting the user info
     """
@@ -150,8 +471,21 @@ def remove_user_from_s3(s3, bucket_name, phone):
     phone_hash = hash_phone_number(phone)
 
     try:
-        s3.Object(bucket_name, 'subscriber-{}.json'.format(
-            phone_hash)).delete()
+        # Write the tombstone first so that the subscriber is never left in the snapshots without one
+        if snapshots_bucket_name is not None:
+            with metrics.registry.time('chirp_s3_seconds', labels={'operation': 'put_tombstone'}):
+                s3.Object(snapshots_bucket_name, get_tombstone_key(phone_hash)).put(Body=json.dumps({
+                    'phone_hash': phone_hash,
+                    'unsubscribed_at': datetime.datetime.now(pytz.UTC).isoformat()
+                }))
+        with metrics.registry.time('chirp_s3_seconds', labels={'operation': 'delete'}):
+            if layout == 'topic':
+                s3.Bucket(bucket_name).delete_objects(Delete={
+                    'Objects': [{'Key': key} for key in get_other_subscriber_keys(phone_hash)],
+                    'Quiet': True
+                })
+            else:
+                s3.Object(bucket_name, get_subscriber_key(phone_hash)).delete()
     except:
         delete_status['success'] = False
         delete_status['message'] = 'The deleting of the user failed due to an unknown error'
@@ -162,17 +496,49 @@ def remove_user_from_s3(s3, bucket_name, phone):
     return delete_status
 
 
-def issue_verification_code(client, phone_number, sub_type, level=None):
+def send_message(client, phone_number, message_body, twilio_throttle=None):
+    """
+    This sends an SMS message, keeping within the Twilio account's sending limits if a throttle is provided
+
+    param: (Twilio Client) client: The Twilio client to use
+    param: (str) phone_number: The phone number to send the message to
+    param: (str) message_body: The text of the message
+    param: (throttle.Throttle) twilio_throttle: The throttle for the Twilio account
+
+    returns: (MessageInstance) message: The message created by Twilio
+    """
+
+    with metrics.registry.time('chirp_twilio_send_seconds'):
+        if twilio_throttle is None:
+            return client.messages.create(
+                from_='+442033225373',
+                body=message_body,
+                to=phone_number
+            )
+
+        return twilio_throttle.call(
+            client.messages.create,
+            from_='+442033225373',
+            body=message_body,
+            to=phone_number
+        )
+
+
+def issue_verification_code(client, phone_number, sub_type, level=None, twilio_throttle=None, outbound_queue=None):
     """
     This issues a verification code for a user who is attempting to subscribe.
     They must enter this code into the web application to prove that they have
     ownership of the phone number that they are subscribing
 
-    param: (Twilio Client) client: The Twilio client to use
+    param: (Twilio Client) client: The Twilio client to use, not needed if an outbound
+    queue is provided
     param: (str) phone_number: The phone number of the potential subscriber
     param: (str) sub_type: Whether the user is 'Subscribing' or 'Unsubscribing'
     param: (str) level: The level of alerts that the user is subcribing to if this
     is for a subscription request
+    param: (throttle.Throttle) twilio_throttle: The throttle for the Twilio account
+    param: (outbox.OutboundQueue) outbound_queue: If provided the message is handed to this
+    queue to send in the background rather than sent straight away
 
     return: (dict) code_status: The status of the code verification result and the code
     if it was successful
@@ -203,11 +569,10 @@ def issue_verification_code(client, phone_number, sub_type, level=None):
 
     # Attempt to send a message to the user with the verification code
     try:
-        message_result = client.messages.create(
-            from_='+442033225373',
-            body=message_body,
-            to=phone_number
-        )
+        if outbound_queue is not None:
+            outbound_queue.enqueue(phone_number, message_body)
+        else:
+            message_result = send_message(client, phone_number, message_body, twilio_throttle)
     except:
         code_status['success'] = False
         code_status['message'] = 'The verification code message failed to send due to an unknown error'
@@ -220,13 +585,17 @@ def issue_verification_code(client, phone_number, sub_type, level=None):
     return code_status
 
 
-def send_subscription_confirmation(client, phone_number, level):
+def send_subscription_confirmation(client, phone_number, level, twilio_throttle=None, outbound_queue=None):
     """
     This sends a success message to a successful subscriber
 
-    param: (Twilio Client) client: The Twilio client to use
+    param: (Twilio Client) client: The Twilio client to use, not needed if an outbound
+    queue is provided
     param: (str) phone_number: The phone number of the new subscriber
     param: (str) level: The alert level that the subscriber has subscribed to
+    param: (throttle.Throttle) twilio_throttle: The throttle for the Twilio account
+    param: (outbox.OutboundQueue) outbound_queue: If provided the message is handed to this
+    queue to send in the background rather than sent straight away
 
     returns: (dict) confirmation_status: Details around the success of the confirmation message
     """
@@ -237,11 +606,10 @@ def send_subscription_confirmation(client, phone_number, level):
         globals['levels'][level])
 
     try:
-        message = client.messages.create(
-            from_='+442033225373',
-            body=message_body,
-            to=phone_number
-        )
+        if outbound_queue is not None:
+            outbound_queue.enqueue(phone_number, message_body)
+        else:
+            message = send_message(client, phone_number, message_body, twilio_throttle)
     except:
         confirmation_status['success'] = False
         confirmation_status['message'] = 'The verification code message failed to send due to an unknown error'
@@ -274,30 +642,37 @@ def verify_phone_number(phone_number):
     return phone_verification
 
 
-def verify_code(phone_number_hash, code, max_attempts, max_elapsed_time):
+def verify_code(phone_number_hash, code, max_attempts, max_elapsed_time, verification_codes=None):
     """
     This verifies that a user has ownership of the phone number that they are registering
 
     param: (str) phone_number: The phone number of the new subscriber
     param: (str) code: The code that they entered
+    param: (code_store) verification_codes: The store holding the verification codes,
+    defaults to the store for the app
 
-    returns: (dict) verification_status: Details about the verification
+    returns: (dict) verification_status: Details about the verification and the level
+    the code was issued for
     """
 
     verification_status = {}
 
-    if phone_number_hash not in globals['verification_codes'].keys():
+    if verification_codes is None:
+        verification_codes = get_verification_codes()
+
+    record = verification_codes.get(phone_number_hash)
+
+    # Increment the number of attempts that this user has made to verify their subscription
+    number_attempts = verification_codes.increment_attempts(phone_number_hash)
+
+    if record is None or number_attempts is None:
         verification_status['success'] = False
         verification_status['message'] = "No record of sending a verification code to this user"
         return verification_status
 
-    # Get the details from the dictionary
-    verify_code = globals['verification_codes'][phone_number_hash]['verify_code']
-    verification_datetime = globals['verification_codes'][phone_number_hash]['verification_datetime']
-    number_attempts = globals['verification_codes'][phone_number_hash]['attempts']
-
-    # Increment the number of attempts that this user has made to verify their subscription
-    globals['verification_codes'][phone_number_hash]['attempts'] += 1
+    # Get the details from the record
+    verify_code = record['verify_code']
+    verification_datetime = datetime.datetime.fromtimestamp(record['verification_timestamp'], pytz.UTC)
 
     # Check that the user hasn't exceeded the allowed number of attempts
     if number_attempts >= max_attempts:
@@ -324,12 +699,13 @@ def verify_code(phone_number_hash, code, max_attempts, max_elapsed_time):
     # Return a success
     verification_status['success'] = True
     verification_status['message'] = "Verification successful with {} attempts and {} minutes elapsed".format(number_attempts, time_elapsed)
+    verification_status['level'] = record.get('level')
 
     return verification_status
 
 
 # API POST route for subscribing
-@app.route("/subscribe", methods=['POST'])
+@routes.route("/subscribe", methods=['POST'])
 def subscribe_user():
     """
     This function subscribes a user to the appropriate topic
@@ -360,10 +736,12 @@ def subscribe_user():
 
     # If so, issue a verification code
     verify_code = issue_verification_code(
-        client=twilio_client,
+        client=None,
         phone_number=request_params["phone"],
         sub_type="Subscribe",
-        level=topic
+        level=topic,
+        twilio_throttle=globals['twilio_throttle'],
+        outbound_queue=get_outbox()
     )
 
     # If there were any issues sending the verification code
@@ -375,13 +753,13 @@ def subscribe_user():
     # Hash the phone number for use as a key in a dictionary to temporarily hold the code and level
     phone_hash = hash_phone_number(phone)
 
-    # Save the details to the global dictionary for use in verification confirmation
-    globals['verification_codes'][phone_hash] = {
+    # Save the details to the code store for use in verification confirmation
+    get_verification_codes().set(phone_hash, {
         "verify_code": verify_code['code'],
-        "verification_datetime": datetime.datetime.now(pytz.UTC),
+        "verification_timestamp": datetime.datetime.now(pytz.UTC).timestamp(),
         "attempts": 0,
         "level": topic
-    }
+    })
 
     resp = jsonify(success=True)
     resp.status_code = 200
@@ -389,7 +767,7 @@ def subscribe_user():
 
 
 # API POST rote for unsubscribing
-@app.route("/unsubscribe", methods=['POST'])
+@routes.route("/unsubscribe", methods=['POST'])
 def unsubscribe_user():
     """
     This function unsubscribes a user from the appropriate topic
@@ -418,9 +796,11 @@ def unsubscribe_user():
 
     # If so, issue a verification code
     verify_code = issue_verification_code(
-        client=twilio_client,
+        client=None,
         phone_number=request_params["phone"],
-        sub_type="Unsubscribe"
+        sub_type="Unsubscribe",
+        twilio_throttle=globals['twilio_throttle'],
+        outbound_queue=get_outbox()
     )
 
     # If there were any issues sending the verification code
@@ -432,12 +812,12 @@ def unsubscribe_user():
     # Hash the phone number for use as a key in a dictionary to temporarily hold the code and level
     phone_hash = hash_phone_number(phone)
 
-    # Save the details to the global dictionary for use in verification confirmation
-    globals['verification_codes'][phone_hash] = {
+    # Save the details to the code store for use in verification confirmation
+    get_verification_codes().set(phone_hash, {
         "verify_code": verify_code['code'],
-        "verification_datetime": datetime.datetime.now(pytz.UTC),
+        "verification_timestamp": datetime.datetime.now(pytz.UTC).timestamp(),
         "attempts": 0
-    }
+    })
 
     resp = jsonify(success=True)
     resp.status_code = 200
@@ -445,7 +825,7 @@ def unsubscribe_user():
 
 
 # API POST route for confirming a subscription
-@app.route("/subscribe/verify", methods=['POST'])
+@routes.route("/subscribe/verify", methods=['POST'])
 def confirm_subscription():
     """
     This function subscribes a user to the appropriate topic
@@ -479,7 +859,7 @@ def confirm_subscription():
         resp.status_code = 400
         return resp
 
-    level = globals['verification_codes'][phone_hash]['level']
+    level = verification['level']
 
     save_user_payload = {
         "phone": phone,
@@ -488,23 +868,25 @@ def confirm_subscription():
     }
 
     save_status = save_user_to_s3(
-        s3=globals['s3'],
+        s3=get_s3(),
         bucket_name=globals['bucket_name'],
-        json_payload=save_user_payload)
+        json_payload=save_user_payload,
+        snapshots_bucket_name=globals['snapshots_bucket_name'],
+        layout=globals['subscriber_layout'])
 
     if not save_status["success"]:
         resp = jsonify(success=False, message=save_status['message'])
         resp.status_code = 400
         return resp
 
-    confirmation_status = send_subscription_confirmation(twilio_client, phone, level)
+    # The confirmation is sent in the background, the subscriber has been saved so it isn't an error if it fails
+    confirmation_status = send_subscription_confirmation(
+        None, phone, level, twilio_throttle=globals['twilio_throttle'], outbound_queue=get_outbox())
 
     if not confirmation_status['success']:
-        resp = jsonify(success=False, message=confirmation_status['message'])
-        resp.status_code = 400
-        return resp
+        logging.warning(confirmation_status['message'])
 
-    del globals['verification_codes'][phone_hash]
+    get_verification_codes().delete(phone_hash)
 
     resp = jsonify(success=True)
     resp.status_code = 200
@@ -512,7 +894,7 @@ def confirm_subscription():
 
 
 # API POST rote for unsubscribing
-@app.route("/unsubscribe/verify", methods=['POST'])
+@routes.route("/unsubscribe/verify", methods=['POST'])
 def confirm_unsubscription():
     """
     This function unsubscribes a user from the appropriate topic
@@ -543,15 +925,110 @@ def confirm_unsubscription():
         return resp
 
     delete_status = remove_user_from_s3(
-        s3=globals['s3'],
+        s3=get_s3(),
         bucket_name=globals['bucket_name'],
-        phone=phone)
+        phone=phone,
+        snapshots_bucket_name=globals['snapshots_bucket_name'],
+        layout=globals['subscriber_layout'])
 
     if not delete_status["success"]:
         resp = jsonify(success=False, message=delete_status['message'])
         resp.status_code = 400
         return resp
 
+    get_verification_codes().delete(phone_hash)
+
     resp = jsonify(success=True)
     resp.status_code = 200
     return resp
+
+
+# API GET route for the metrics in the Prometheus text format
+@routes.route("/metrics", methods=['GET'])
+def get_metrics():
+    """
+    This returns the request and dependency metrics, for every worker if they share a metrics directory
+    """
+
+    if globals['metrics_directory'] is None:
+        registry = metrics.registry
+    else:
+        registry = load_metrics(globals['metrics_directory'])
+
+    return Response(registry.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+def is_bulk_request_authorised(headers):
+    """
+    This checks that a bulk request carries the bulk token as a bearer token
+
+    param: (Headers) headers: The headers of the request
+
+    returns: (bool) authorised: Whether the request is authorised, always False if there is no token
+    """
+
+    if not globals['bulk_token']:
+        return False
+
+    authorization = headers.get('Authorization', '')
+    if not authorization.startswith('Bearer '):
+        return False
+
+    return hmac.compare_digest(
+        authorization[len('Bearer '):].encode('utf-8'), globals['bulk_token'].encode('utf-8'))
+
+
+# API POST route for importing subscribers who have already been verified
+@routes.route("/subscribers/import", methods=['POST'])
+def import_subscribers():
+    """
+    This saves a batch of pre-verified subscribers sent as CSV or NDJSON. Very large
+    imports should use the bulk.py command line instead, which can be resumed.
+    """
+
+    if not is_bulk_request_authorised(request.headers):
+        resp = jsonify(success=False, message="The request is not authorised")
+        resp.status_code = 401
+        return resp
+
+    file_formats = {'text/csv': 'csv', 'application/x-ndjson': 'ndjson', 'application/jsonl': 'ndjson'}
+
+    if request.mimetype not in file_formats:
+        resp = jsonify(success=False, message="Please send the subscribers as one of {}".format(list(file_formats)))
+        resp.status_code = 415
+        return resp
+
+    report = bulk.import_subscribers(
+        subscribers=bulk.read_subscribers(
+            io.TextIOWrapper(request.stream, encoding='utf-8', newline=''), file_formats[request.mimetype]),
+        validate_function=lambda subscriber: bulk.validate_subscriber(
+            subscriber, globals['levels'], verify_phone_number),
+        save_function=lambda payload: save_user_to_s3(
+            get_s3(), globals['bucket_name'], payload, globals['snapshots_bucket_name'], globals['subscriber_layout']),
+        workers=globals['bulk_workers'])
+
+    resp = jsonify(success=report['failed'] == 0, **report)
+    resp.status_code = 200
+    return resp
+
+
+# API GET route for exporting every subscriber
+@routes.route("/subscribers/export", methods=['GET'])
+def export_subscribers():
+    """
+    This streams every subscriber as NDJSON, in the form accepted by /subscribers/import
+    """
+
+    if not is_bulk_request_authorised(request.headers):
+        resp = jsonify(success=False, message="The request is not authorised")
+        resp.status_code = 401
+        return resp
+
+    subscribers = bulk.iterate_subscribers(
+        get_s3(), globals['bucket_name'], globals['bulk_workers'],
+        snapshots_bucket_name=globals['snapshots_bucket_name'])
+
+    return Response(
+        stream_with_context(json.dumps(subscriber) + '\n' for subscriber in subscribers),
+        mimetype='application/x-ndjson')
+
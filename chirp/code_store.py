@@ -0,0 +1,369 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+
+class MemoryCodeStore:
+    """
+    This holds the pending verification codes in a dictionary in this process. Expired
+    codes are removed as they are looked up and whenever a new code is saved. It is only
+    suitable for a single worker as the codes are not shared between processes.
+
+    Every code is kept for the same time, so the codes expire in the order they were saved
+    and only those at the front of the queue of expiry times need to be looked at.
+    """
+
+    def __init__(self, ttl, get_current_time_function=time.time):
+        """
+        param: (int) ttl: The number of seconds to keep a code for
+        param: (func) get_current_time_function: The function to use to get the current time
+        """
+        self.ttl = ttl
+        self.get_current_time_function = get_current_time_function
+        self.records = {}
+        self.expiries = deque()
+        self.lock = threading.Lock()
+
+    def remove_expired(self):
+        """
+        This removes every code which has expired, the caller must hold the lock
+        """
+        now = self.get_current_time_function()
+        while self.expiries and self.expiries[0][0] <= now:
+            expires_at, key = self.expiries.popleft()
+            # The code may have been saved again since with a later expiry, or deleted already
+            if key in self.records and self.records[key][1] == expires_at:
+                del self.records[key]
+
+    def set(self, key, record):
+        """
+        This saves the details of a code, replacing any existing code for the key
+
+        param: (str) key: The hash of the phone number the code was sent to
+        param: (dict) record: The code, the time it was issued, the number of attempts and the level
+        """
+        with self.lock:
+            self.remove_expired()
+            expires_at = self.get_current_time_function() + self.ttl
+            self.records[key] = (dict(record), expires_at)
+            self.expiries.append((expires_at, key))
+
+    def get(self, key):
+        """
+        This gets the details of a code
+
+        param: (str) key: The hash of the phone number the code was sent to
+
+        returns: (dict) record: The details of the code, or None if there is no code or it has expired
+        """
+        with self.lock:
+            if key not in self.records:
+                return None
+            record, expires_at = self.records[key]
+            if expires_at <= self.get_current_time_function():
+                del self.records[key]
+                return None
+            return dict(record)
+
+    def increment_attempts(self, key):
+        """
+        This records an attempt to verify a code
+
+        param: (str) key: The hash of the phone number the code was sent to
+
+        returns: (int) attempts: The number of attempts made before this one, or None if there is no code
+        """
+        with self.lock:
+            if key not in self.records or self.records[key][1] <= self.get_current_time_function():
+                return None
+            self.records[key][0]['attempts'] += 1
+            return self.records[key][0]['attempts'] - 1
+
+    def delete(self, key):
+        """
+        param: (str) key: The hash of the phone number the code was sent to
+        """
+        with self.lock:
+            self.records.pop(key, None)
+
+    def __len__(self):
+        with self.lock:
+            self.remove_expired()
+            return len(self.records)
+
+
+class SQLiteCodeStore:
+    """
+    This holds the pending verification codes in an SQLite database so that they can be
+    shared between the workers on one machine, or kept in a file for tests
+    """
+
+    def __init__(self, path, ttl, get_current_time_function=time.time):
+        """
+        param: (str) path: The path of the database file
+        param: (int) ttl: The number of seconds to keep a code for
+        param: (func) get_current_time_function: The function to use to get the current time
+        """
+        self.path = path
+        self.ttl = ttl
+        self.get_current_time_function = get_current_time_function
+        # Each thread needs its own connection
+        self.local = threading.local()
+
+        with self.connect() as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS verification_codes (
+                  key TEXT PRIMARY KEY,
+                  record TEXT NOT NULL,
+                  attempts INTEGER NOT NULL,
+                  expires_at REAL NOT NULL
+                )
+                """)
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS verification_codes_expires_at ON verification_codes (expires_at)")
+
+    def connect(self):
+        """
+        returns: (sqlite3.Connection) connection: The connection for this thread
+        """
+        if getattr(self.local, 'connection', None) is None:
+            # Wait for other workers holding the write lock rather than failing straight away
+            self.local.connection = sqlite3.connect(self.path, timeout=10)
+        return self.local.connection
+
+    def set(self, key, record):
+        """
+        This saves the details of a code, replacing any existing code for the key
+
+        param: (str) key: The hash of the phone number the code was sent to
+        param: (dict) record: The code, the time it was issued, the number of attempts and the level
+        """
+        now = self.get_current_time_function()
+        record = dict(record)
+        attempts = record.pop('attempts', 0)
+
+        with self.connect() as connection:
+            connection.execute("DELETE FROM verification_codes WHERE expires_at <= ?", (now,))
+            connection.execute(
+                "INSERT OR REPLACE INTO verification_codes (key, record, attempts, expires_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(record), attempts, now + self.ttl))
+
+    def get(self, key):
+        """
+        This gets the details of a code
+
+        param: (str) key: The hash of the phone number the code was sent to
+
+        returns: (dict) record: The details of the code, or None if there is no code or it has expired
+        """
+        row = self.connect().execute(
+            "SELECT record, attempts FROM verification_codes WHERE key = ? AND expires_at > ?",
+            (key, self.get_current_time_function())).fetchone()
+
+        if row is None:
+            return None
+
+        record = json.loads(row[0])
+        record['attempts'] = row[1]
+        return record
+
+    def increment_attempts(self, key):
+        """
+        This records an attempt to verify a code
+
+        param: (str) key: The hash of the phone number the code was sent to
+
+        returns: (int) attempts: The number of attempts made before this one, or None if there is no code
+        """
+        connection = self.connect()
+
+        with connection:
+            # Take the write lock before reading so two workers can't both see the same count
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT attempts FROM verification_codes WHERE key = ? AND expires_at > ?",
+                (key, self.get_current_time_function())).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE verification_codes SET attempts = attempts + 1 WHERE key = ?", (key,))
+
+        return row[0]
+
+    def delete(self, key):
+        """
+        param: (str) key: The hash of the phone number the code was sent to
+        """
+        with self.connect() as connection:
+            connection.execute("DELETE FROM verification_codes WHERE key = ?", (key,))
+
+    def __len__(self):
+        return self.connect().execute(
+            "SELECT count(*) FROM verification_codes WHERE expires_at > ?",
+            (self.get_current_time_function(),)).fetchone()[0]
+
+
+class RedisCodeStore:
+    """
+    This holds the pending verification codes in Redis, or any server speaking the Redis
+    protocol, so that they can be shared between every worker and replica. Each code is a
+    hash which Redis expires itself.
+    """
+
+    # Counts an attempt only if the code still exists, run as a script so that a code saved
+    # or expired at the same time is never changed or deleted by mistake
+    INCREMENT_ATTEMPTS_SCRIPT = """
+    if redis.call('exists', KEYS[1]) == 1 then
+      return redis.call('hincrby', KEYS[1], 'attempts', 1)
+    end
+    return false
+    """
+
+    def __init__(self, client, ttl, prefix='verification-code:'):
+        """
+        param: (redis.Redis) client: The Redis client to use
+        param: (int) ttl: The number of seconds to keep a code for
+        param: (str) prefix: The prefix of the keys holding the codes
+        """
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.increment_attempts_script = client.register_script(self.INCREMENT_ATTEMPTS_SCRIPT)
+
+    def set(self, key, record):
+        """
+        This saves the details of a code, replacing any existing code for the key
+
+        param: (str) key: The hash of the phone number the code was sent to
+        param: (dict) record: The code, the time it was issued, the number of attempts and the level
+        """
+        record = dict(record)
+        attempts = record.pop('attempts', 0)
+
+        pipeline = self.client.pipeline(transaction=True)
+        pipeline.delete(self.prefix + key)
+        pipeline.hset(self.prefix + key, mapping={'record': json.dumps(record), 'attempts': attempts})
+        pipeline.expire(self.prefix + key, self.ttl)
+        pipeline.execute()
+
+    def get(self, key):
+        """
+        This gets the details of a code
+
+        param: (str) key: The hash of the phone number the code was sent to
+
+        returns: (dict) record: The details of the code, or None if there is no code or it has expired
+        """
+        values = self.client.hgetall(self.prefix + key)
+
+        if not values:
+            return None
+
+        # The client returns bytes unless it was created to decode the responses
+        values = {
+            (name.decode('utf-8') if isinstance(name, bytes) else name): value for name, value in values.items()}
+
+        record = json.loads(values['record'])
+        record['attempts'] = int(values['attempts'])
+        return record
+
+    def increment_attempts(self, key):
+        """
+        This records an attempt to verify a code
+
+        param: (str) key: The hash of the phone number the code was sent to
+
+        returns: (int) attempts: The number of attempts made before this one, or None if there is no code
+        """
+        attempts = self.increment_attempts_script(keys=[self.prefix + key])
+
+        # The code expired
+        if attempts is None:
+            return None
+
+        return int(attempts) - 1
+
+    def delete(self, key):
+        """
+        param: (str) key: The hash of the phone number the code was sent to
+        """
+        self.client.delete(self.prefix + key)
+
+
+class TimedCodeStore:
+    """
+    This wraps another store, recording how long each request to it takes in a metrics registry
+    """
+
+    def __init__(self, store, registry, name='chirp_code_store_seconds'):
+        """
+        param: (object) store: The store to wrap
+        param: (metrics.Registry) registry: The registry to record the timings in
+        param: (str) name: The name of the histogram, each operation is a label
+        """
+        self.store = store
+        self.registry = registry
+        self.name = name
+
+    def set(self, key, record):
+        """
+        param: (str) key: The hash of the phone number the code was sent to
+        param: (dict) record: The code, when it was issued, the attempts made and the level
+        """
+        with self.registry.time(self.name, labels={'operation': 'set'}):
+            self.store.set(key, record)
+
+    def get(self, key):
+        """
+        param: (str) key: The hash of the phone number the code was sent to
+
+        returns: (dict) record: The record, or None if there isn't one or it has expired
+        """
+        with self.registry.time(self.name, labels={'operation': 'get'}):
+            return self.store.get(key)
+
+    def increment_attempts(self, key):
+        """
+        param: (str) key: The hash of the phone number the code was sent to
+
+        returns: (int) attempts: The number of attempts before this one, or None if there isn't a record
+        """
+        with self.registry.time(self.name, labels={'operation': 'increment_attempts'}):
+            return self.store.increment_attempts(key)
+
+    def delete(self, key):
+        """
+        param: (str) key: The hash of the phone number the code was sent to
+        """
+        with self.registry.time(self.name, labels={'operation': 'delete'}):
+            self.store.delete(key)
+
+
+def create_code_store(url, ttl):
+    """
+    This creates the store for the pending verification codes from a URL
+
+    param: (str) url: Where to keep the codes, one of memory://, sqlite:///path/to/file.db
+    or redis://host:port/db, if None the codes are kept in memory
+    param: (int) ttl: The number of seconds to keep a code for
+
+    returns: (object) code_store: The store for the verification codes
+    """
+
+    if url is None or url == 'memory://':
+        return MemoryCodeStore(ttl)
+
+    scheme = urlparse(url).scheme
+
+    if scheme == 'sqlite':
+        return SQLiteCodeStore(url[len('sqlite:///'):], ttl)
+
+    if scheme in ['redis', 'rediss']:
+        # Only needed when the codes are kept in Redis
+        import redis
+        return RedisCodeStore(redis.Redis.from_url(url), ttl)
+
+    raise ValueError('The verification code store {} is not supported'.format(url))
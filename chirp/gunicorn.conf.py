@@ -0,0 +1,87 @@
+# Gunicorn configuration for serving chirp, every setting can be tuned with an environment variable
+import math
+import os
+
+bind = '0.0.0.0:{}'.format(os.getenv('PORT', 5000))
+
+# Verification requests spend most of their time waiting on Twilio and S3, so each worker runs
+# several threads to keep serving while others wait. With the gevent worker each request runs in
+# a greenlet instead, which gives way to the others whenever it waits on the network, so a few
+# processes can hold many requests in flight.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+
+def _get_cpu_limit():
+    # The CPUs the container may use from its cgroup quota, the node's CPU count says nothing about a pod's limit
+    for quota_path, period_path in [('/sys/fs/cgroup/cpu.max', None),
+                                    ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us')]:
+        try:
+            with open(quota_path) as quota_file:
+                values = quota_file.read().split()
+            if period_path is not None:
+                with open(period_path) as period_file:
+                    values += period_file.read().split()
+        except OSError:
+            continue
+        # cgroup v2 writes "max" and cgroup v1 writes -1 when there is no limit
+        if values[0] in ['max', '-1']:
+            return None
+        return max(1, math.ceil(int(values[0]) / int(values[1])))
+
+    return None
+
+
+# Codes kept in memory aren't shared between processes, so only run several workers with a shared store. Each worker
+# runs its own outbound queue threads, so without a CPU limit to size them from only run a few.
+if os.getenv('VERIFICATION_CODE_STORE_URL', 'memory://') == 'memory://':
+    workers = int(os.getenv('GUNICORN_WORKERS', 1))
+else:
+    cpu_limit = _get_cpu_limit()
+    workers = int(os.getenv('GUNICORN_WORKERS', 3 if cpu_limit is None else cpu_limit * 2 + 1))
+
+# Give requests waiting on a retried Twilio message time to finish
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+# Let requests in flight finish when the pod is stopped, within the Kubernetes grace period of 30 seconds
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 25))
+# Keep connections from the ingress open between requests
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+# Restart the workers now and then to bound any slow growth in memory
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    # Each worker saves its metrics to METRICS_DIR, clear out those left by a previous run
+    directory = os.getenv('METRICS_DIR', None)
+    if directory is not None and os.path.isdir(directory):
+        for file_name in os.listdir(directory):
+            if file_name.endswith('.json'):
+                os.remove(os.path.join(directory, file_name))
+
+
+def post_worker_init(worker):
+    # Start sending the messages left queued by a previous worker rather than waiting for a new one
+    import chirp
+    chirp.get_outbox()
+
+
+def worker_exit(server, worker):
+    # Save the metrics recorded since the last save, they are merged into the retired workers' file once it has exited
+    directory = os.getenv('METRICS_DIR', None)
+    if directory is not None:
+        import chirp
+        chirp.save_metrics(directory)
+
+
+def child_exit(server, worker):
+    # Keep the metrics of each worker which exits in one file rather than one per worker
+    directory = os.getenv('METRICS_DIR', None)
+    if directory is not None:
+        import chirp
+        chirp.retire_metrics(directory, worker.pid)
@@ -0,0 +1,308 @@
+# This module is shared with silence, keep it in step with silence/metrics.py
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# The upper bounds in seconds of the histogram buckets, from a single Twilio request up to an Athena query
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+# The help text of the metrics recorded by silence and chirp
+DESCRIPTIONS = {
+    'silence_athena_queue_seconds': 'Time Athena queries spent queued before running',
+    'silence_athena_execution_seconds': 'Time Athena spent executing queries',
+    'silence_athena_wait_seconds': 'Time spent waiting on Athena queries from submitting them to their completion',
+    'silence_athena_data_scanned_bytes_total': 'Bytes scanned by Athena queries',
+    'silence_query_cache_total': 'Athena queries answered from the query cache or run',
+    'silence_s3_get_object_seconds': 'Time taken for S3 to start returning query results',
+    'silence_csv_read_seconds': 'Time taken to download and parse query results which are read whole',
+    'silence_subscribers_checked_total': 'Subscribers checked for eligibility',
+    'silence_subscribers_eligible_total': 'Subscribers eligible for a notification',
+    'silence_twilio_send_seconds': 'Time taken to send each message including waiting on the throttle',
+    'silence_messages_total': 'Messages sent or failed to send',
+    'silence_s3_log_write_seconds': 'Time taken to write each notification log object',
+    'silence_cycle_stage_seconds': 'Time taken by each stage of the notification cycle',
+    'silence_last_cycle_timestamp_seconds': 'Time the last notification cycle finished',
+    'silence_twilio_requests': 'Requests to Twilio through the throttle by outcome since the worker started',
+    'silence_cycles_skipped_total': 'Notification cycles skipped before querying the subscribers by reason',
+    'chirp_request_seconds': 'Time taken to answer each request by route',
+    'chirp_responses_total': 'Responses by route and status code',
+    'chirp_twilio_send_seconds': 'Time taken by Twilio to create each message including waiting on the throttle',
+    'chirp_s3_seconds': 'Time taken by each S3 request by operation',
+    'chirp_code_store_seconds': 'Time taken by each verification code store request by operation'
+}
+
+
+def get_series_key(name: str, labels: dict = None) -> tuple:
+    """
+    :param str name: The name of the metric
+    :param dict labels: The labels of the series
+
+    :return: tuple key: The key of the series, the name followed by the labels sorted by name
+    """
+    return (name,) + tuple(sorted((labels or {}).items()))
+
+
+def format_labels(labels: tuple, extra: dict = None) -> str:
+    """
+    :param tuple labels: The labels of the series as pairs of name and value
+    :param dict extra: Any labels to add e.g. the bucket of a histogram
+
+    :return: str labels: The labels in the Prometheus text format
+    """
+    pairs = list(labels) + list((extra or {}).items())
+
+    if not pairs:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is only in Python 3.7 onwards
+    daemon_threads = True
+
+
+class Histogram:
+    """
+    Counts observations into cumulative buckets along with their sum, in the same way as a Prometheus histogram
+    """
+
+    def __init__(self, buckets: list = None) -> None:
+        """
+        :param list[float] buckets: The upper bounds of the buckets
+        """
+        self.buckets = sorted(buckets or DEFAULT_BUCKETS)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """
+        :param float value: The value observed
+        """
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self) -> dict:
+        """
+        :return: dict histogram: The cumulative count of each bucket keyed by its upper bound, the count and the sum
+        """
+        return {
+            'buckets': {str(upper_bound): count for upper_bound, count in zip(self.buckets, self.counts)},
+            'count': self.count,
+            'sum': self.sum
+        }
+
+
+class Registry:
+    """
+    Holds the counters, gauges and histograms describing a service. It is safe to share between threads.
+    """
+
+    def __init__(self, get_current_time_function=time.perf_counter) -> None:
+        """
+        :param func get_current_time_function: The function to use to get the current time when timing
+        """
+        self.get_current_time_function = get_current_time_function
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Removes every series
+        """
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+            self.descriptions = dict(DESCRIPTIONS)
+
+    def describe(self, name: str, description: str) -> None:
+        """
+        :param str name: The name of the metric
+        :param str description: What the metric measures, included as its help text
+        """
+        with self.lock:
+            self.descriptions[name] = description
+
+    def increment(self, name: str, amount: float = 1, labels: dict = None) -> None:
+        """
+        :param str name: The name of the counter
+        :param float amount: The amount to increment the counter by
+        :param dict labels: The labels of the series
+        """
+        key = get_series_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name: str, value: float, labels: dict = None) -> None:
+        """
+        :param str name: The name of the gauge
+        :param float value: The current value
+        :param dict labels: The labels of the series
+        """
+        with self.lock:
+            self.gauges[get_series_key(name, labels)] = value
+
+    def observe(self, name: str, value: float, labels: dict = None, buckets: list = None) -> None:
+        """
+        :param str name: The name of the histogram
+        :param float value: The value observed
+        :param dict labels: The labels of the series
+        :param list[float] buckets: The upper bounds of the buckets, only used when the series is first observed
+        """
+        key = get_series_key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def time(self, name: str, labels: dict = None):
+        """
+        Observes how long the code run inside the with block takes in seconds
+
+        :param str name: The name of the histogram
+        :param dict labels: The labels of the series
+        """
+        start = self.get_current_time_function()
+        try:
+            yield
+        finally:
+            self.observe(name, self.get_current_time_function() - start, labels)
+
+    def as_dict(self) -> dict:
+        """
+        :return: dict metrics: Every series keyed by its name and labels in the Prometheus format
+        """
+        with self.lock:
+            return {
+                'counters': {key[0] + format_labels(key[1:]): value for key, value in self.counters.items()},
+                'gauges': {key[0] + format_labels(key[1:]): value for key, value in self.gauges.items()},
+                'histograms': {
+                    key[0] + format_labels(key[1:]): histogram.as_dict() for key, histogram in self.histograms.items()}
+            }
+
+    def snapshot(self) -> dict:
+        """
+        :return: dict snapshot: Every series in a form which can be saved as JSON and merged into another registry
+        """
+        with self.lock:
+            return {
+                'counters': [[list(key), value] for key, value in self.counters.items()],
+                'gauges': [[list(key), value] for key, value in self.gauges.items()],
+                'histograms': [
+                    [list(key), histogram.buckets, histogram.counts, histogram.count, histogram.sum]
+                    for key, histogram in self.histograms.items()]
+            }
+
+    def merge(self, snapshot: dict) -> None:
+        """
+        Adds the series from another registry, e.g. another worker process, into this one. Counters and histograms
+        are summed and gauges are replaced.
+
+        :param dict snapshot: The snapshot of the other registry
+        """
+
+        def to_key(key):
+            # JSON turns the label pairs into lists
+            return (key[0],) + tuple(tuple(label) for label in key[1:])
+
+        with self.lock:
+            for key, value in snapshot['counters']:
+                self.counters[to_key(key)] = self.counters.get(to_key(key), 0) + value
+            for key, value in snapshot['gauges']:
+                self.gauges[to_key(key)] = value
+            for key, buckets, counts, count, total in snapshot['histograms']:
+                histogram = self.histograms.setdefault(to_key(key), Histogram(buckets))
+                histogram.counts = [existing + added for existing, added in zip(histogram.counts, counts)]
+                histogram.count += count
+                histogram.sum += total
+
+    def to_prometheus(self) -> str:
+        """
+        :return: str metrics: Every series in the Prometheus text exposition format
+        """
+        lines = []
+
+        with self.lock:
+            series = [('counter', key, value) for key, value in sorted(self.counters.items())]
+            series += [('gauge', key, value) for key, value in sorted(self.gauges.items())]
+            series += [('histogram', key, value) for key, value in sorted(self.histograms.items())]
+
+            described = set()
+            for metric_type, key, value in series:
+                name, labels = key[0], key[1:]
+
+                # The help and type are written once before the first series of each metric
+                if name not in described:
+                    if name in self.descriptions:
+                        lines.append('# HELP {} {}'.format(name, self.descriptions[name]))
+                    lines.append('# TYPE {} {}'.format(name, metric_type))
+                    described.add(name)
+
+                if metric_type != 'histogram':
+                    lines.append('{}{} {}'.format(name, format_labels(labels), value))
+                    continue
+
+                for upper_bound, count in zip(value.buckets, value.counts):
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels, {'le': upper_bound}), count))
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels, {'le': '+Inf'}), value.count))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), value.sum))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), value.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path: str) -> None:
+        """
+        Writes every series to a local JSON file, replacing it in one step so a reader never sees a partial file
+
+        :param str path: The path of the file
+        """
+        with open(path + '.tmp', 'w') as json_file:
+            json.dump(self.as_dict(), json_file, indent=2, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def serve(self, port: int, address: str = '0.0.0.0') -> HTTPServer:
+        """
+        Serves the metrics in the Prometheus text format on /metrics from a background thread
+
+        :param int port: The port to serve on
+        :param str address: The address to bind to
+
+        :return: HTTPServer server: The server, which can be stopped with shutdown
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Don't log every scrape
+                pass
+
+        server = _Server((address, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        return server
+
+
+# The registry the service records to
+registry = Registry()
@@ -0,0 +1,369 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+
+
+class SpoolBroker:
+    """
+    This keeps the outbound messages as files in a directory so that they survive a restart.
+    A message is claimed by renaming its file, which only one worker can do, so several
+    processes can share the same spool.
+    """
+
+    def __init__(self, directory, claim_timeout=300, get_current_time_function=time.time):
+        """
+        param: (str) directory: The directory to keep the messages in
+        param: (int) claim_timeout: The number of seconds after which a message claimed by a worker
+        which never finished with it, for example because it was stopped, is sent again
+        param: (func) get_current_time_function: The function to use to get the current time
+        """
+        self.directory = directory
+        self.claim_timeout = claim_timeout
+        self.get_current_time_function = get_current_time_function
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, message, not_before):
+        """
+        This writes a message to a temporary file then moves it into place so a reader never
+        sees a partial message
+        """
+        name = 'ready-{:017.6f}-{}.json'.format(not_before, uuid.uuid4().hex)
+        temporary_path = os.path.join(self.directory, '.' + name)
+        with open(temporary_path, 'w') as json_file:
+            json.dump(message, json_file)
+        os.replace(temporary_path, os.path.join(self.directory, name))
+
+    def put(self, message):
+        """
+        param: (dict) message: The message to queue
+        """
+        self.write(message, self.get_current_time_function())
+
+    def release_stale_claims(self, names):
+        """
+        This puts back the messages claimed longer ago than the claim timeout
+
+        returns: (bool) released: Whether any messages were put back
+        """
+        now = self.get_current_time_function()
+        released = False
+        for name in names:
+            if not name.startswith('claimed-'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > self.claim_timeout:
+                    os.rename(path, os.path.join(self.directory, 'ready-' + name.split('-', 2)[2]))
+                    released = True
+            except OSError:
+                # Another worker finished with it or released it first
+                continue
+        return released
+
+    def claim(self):
+        """
+        This claims the oldest message which is due to be sent
+
+        returns: (tuple) claimed: The ticket to acknowledge the message with and the message,
+        or None if no message is due
+        """
+        names = sorted(os.listdir(self.directory))
+        if self.release_stale_claims(names):
+            names = sorted(os.listdir(self.directory))
+        now = self.get_current_time_function()
+
+        for name in names:
+            if not name.startswith('ready-'):
+                continue
+            # The files are named by the time they are due so stop at the first which isn't
+            if float(name.split('-')[1]) > now:
+                return None
+
+            ticket = os.path.join(self.directory, 'claimed-{}-{}'.format(os.getpid(), name[len('ready-'):]))
+            try:
+                os.rename(os.path.join(self.directory, name), ticket)
+            except OSError:
+                # Another worker claimed it first
+                continue
+
+            # Mark when the message was claimed for the claim timeout
+            os.utime(ticket)
+            with open(ticket) as json_file:
+                return ticket, json.load(json_file)
+
+        return None
+
+    def ack(self, ticket):
+        """
+        This removes a message which has been sent or given up on
+
+        param: (str) ticket: The ticket returned when the message was claimed
+        """
+        os.remove(ticket)
+
+    def retry(self, ticket, message, not_before):
+        """
+        This puts a message back to be sent again later
+
+        param: (str) ticket: The ticket returned when the message was claimed
+        param: (dict) message: The message with its number of attempts updated
+        param: (float) not_before: The time before which the message shouldn't be sent again
+        """
+        self.write(message, not_before)
+        os.remove(ticket)
+
+    def __len__(self):
+        return len([name for name in os.listdir(self.directory) if not name.startswith('.')])
+
+
+class RedisBroker:
+    """
+    This keeps the outbound messages in Redis, or any server speaking the Redis protocol.
+    Messages ready to send are kept in a list and messages waiting to be retried in a sorted
+    set scored by the time they are due. A message is claimed by moving it onto a list of
+    messages being sent, so a message claimed by a worker which stopped before finishing with
+    it is sent again after the claim timeout rather than lost.
+    """
+
+    def __init__(self, client, key='outbound-messages', claim_timeout=300, get_current_time_function=time.time):
+        """
+        param: (redis.Redis) client: The Redis client to use
+        param: (str) key: The key of the list of messages ready to send
+        param: (int) claim_timeout: The number of seconds after which a message claimed by a worker
+        which never finished with it is sent again
+        param: (func) get_current_time_function: The function to use to get the current time
+        """
+        self.client = client
+        self.key = key
+        self.delayed_key = key + ':delayed'
+        self.processing_key = key + ':processing'
+        self.claimed_key = key + ':claimed'
+        self.claim_timeout = claim_timeout
+        self.get_current_time_function = get_current_time_function
+
+    def put(self, message):
+        """
+        param: (dict) message: The message to queue
+        """
+        self.client.lpush(self.key, json.dumps(message))
+
+    def release_stale_claims(self):
+        """
+        This puts back the messages claimed longer ago than the claim timeout
+        """
+        now = self.get_current_time_function()
+        # The claim times are read first so that any message claimed since is also on the processing list
+        claimed_at = self.client.hgetall(self.claimed_key)
+        processing = self.client.lrange(self.processing_key, 0, -1)
+
+        # Forget the times of messages which were finished with as the times were read
+        finished = set(claimed_at) - set(processing)
+        if finished:
+            self.client.hdel(self.claimed_key, *finished)
+
+        for value in processing:
+            # A worker which stopped between claiming a message and marking it has no time recorded,
+            # so the timeout starts now
+            if value not in claimed_at:
+                self.client.hsetnx(self.claimed_key, value, now)
+                continue
+            if now - float(claimed_at[value]) <= self.claim_timeout:
+                continue
+            # Only the worker which removes the message from the processing list puts it back
+            if self.client.lrem(self.processing_key, 1, value):
+                self.client.hdel(self.claimed_key, value)
+                self.client.lpush(self.key, value)
+
+    def claim(self):
+        """
+        This claims the oldest message which is due to be sent, moving any retries which are
+        now due onto the list first
+
+        returns: (tuple) claimed: The ticket to acknowledge the message with and the message,
+        or None if no message is due
+        """
+        self.release_stale_claims()
+
+        for value in self.client.zrangebyscore(self.delayed_key, 0, self.get_current_time_function()):
+            # Only the worker which removes the retry from the sorted set moves it onto the list
+            if self.client.zrem(self.delayed_key, value):
+                self.client.lpush(self.key, value)
+
+        value = self.client.rpoplpush(self.key, self.processing_key)
+
+        if value is None:
+            return None
+
+        self.client.hset(self.claimed_key, value, self.get_current_time_function())
+
+        return value, json.loads(value)
+
+    def ack(self, ticket):
+        """
+        This removes a message which has been sent or given up on
+
+        param: (bytes) ticket: The ticket returned when the message was claimed
+        """
+        pipeline = self.client.pipeline(transaction=True)
+        pipeline.lrem(self.processing_key, 1, ticket)
+        pipeline.hdel(self.claimed_key, ticket)
+        pipeline.execute()
+
+    def retry(self, ticket, message, not_before):
+        """
+        This puts a message back to be sent again later
+
+        param: (bytes) ticket: The ticket returned when the message was claimed
+        param: (dict) message: The message with its number of attempts updated
+        param: (float) not_before: The time before which the message shouldn't be sent again
+        """
+        pipeline = self.client.pipeline(transaction=True)
+        pipeline.zadd(self.delayed_key, {json.dumps(message): not_before})
+        pipeline.lrem(self.processing_key, 1, ticket)
+        pipeline.hdel(self.claimed_key, ticket)
+        pipeline.execute()
+
+    def __len__(self):
+        return self.client.llen(self.key) + self.client.zcard(self.delayed_key) + self.client.llen(self.processing_key)
+
+
+def create_broker(url):
+    """
+    This creates the broker for the outbound messages from a URL
+
+    param: (str) url: Where to keep the messages, either spool:///path/to/directory or
+    redis://host:port/db
+
+    returns: (object) broker: The broker for the outbound messages
+    """
+
+    scheme = urlparse(url).scheme
+
+    if scheme == 'spool':
+        return SpoolBroker(url[len('spool://'):])
+
+    if scheme in ['redis', 'rediss']:
+        # Only needed when the messages are kept in Redis
+        import redis
+        return RedisBroker(redis.Redis.from_url(url))
+
+    raise ValueError('The outbound message broker {} is not supported'.format(url))
+
+
+class OutboundQueue:
+    """
+    This sends SMS messages in the background so that a request doesn't wait on Twilio.
+    Messages which fail to send are retried with exponential backoff and jitter, and given
+    up on after a number of attempts.
+    """
+
+    def __init__(self, broker, send_function, workers=1, max_attempts=5, base_delay=5.0, max_delay=600.0,
+                 poll_interval=0.5, get_current_time_function=time.time, sleep_function=time.sleep,
+                 random_function=random.uniform):
+        """
+        param: (object) broker: The broker holding the messages
+        param: (func) send_function: The function to send a message with, called with the phone
+        number and the body of the message
+        param: (int) workers: The number of background threads sending messages
+        param: (int) max_attempts: The number of times to try sending a message before giving up
+        param: (float) base_delay: The delay in seconds before the first retry
+        param: (float) max_delay: The maximum delay in seconds between retries
+        param: (float) poll_interval: The time in seconds to wait when there are no messages due
+        param: (func) get_current_time_function: The function to use to get the current time
+        param: (func) sleep_function: The function to use to wait
+        param: (func) random_function: The function to use to add jitter to the delays
+        """
+        self.broker = broker
+        self.send_function = send_function
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.get_current_time_function = get_current_time_function
+        self.sleep_function = sleep_function
+        self.random_function = random_function
+        self.counts = {'queued': 0, 'sent': 0, 'retried': 0, 'failed': 0}
+        self.lock = threading.Lock()
+        self.started_pid = None
+
+    def increment(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def start(self):
+        """
+        This starts the background workers if they aren't running in this process. Each gunicorn
+        worker starts its own after it has been forked, so messages left queued from before a
+        restart are sent without waiting for a new one.
+        """
+        with self.lock:
+            if self.started_pid == os.getpid():
+                return
+            self.started_pid = os.getpid()
+
+        for _ in range(self.workers):
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def enqueue(self, phone_number, message_body):
+        """
+        This hands a message to the queue to be sent in the background
+
+        param: (str) phone_number: The phone number to send the message to
+        param: (str) message_body: The text of the message
+        """
+        # The id keeps two identical messages apart in the brokers
+        self.broker.put({'id': uuid.uuid4().hex, 'to': phone_number, 'body': message_body, 'attempts': 0})
+        self.increment('queued')
+
+    def process_one(self):
+        """
+        This tries to send the next message which is due
+
+        returns: (bool) processed: Whether there was a message to send
+        """
+        claimed = self.broker.claim()
+
+        if claimed is None:
+            return False
+
+        ticket, message = claimed
+
+        try:
+            self.send_function(message['to'], message['body'])
+
+        except Exception as e:
+            message['attempts'] += 1
+
+            if message['attempts'] >= self.max_attempts:
+                logging.warning('Giving up on an outbound message after {} attempts: {}'.format(
+                    message['attempts'], e))
+                self.broker.ack(ticket)
+                self.increment('failed')
+                return True
+
+            delay = self.random_function(0, min(self.max_delay, self.base_delay * 2 ** message['attempts']))
+            self.broker.retry(ticket, message, self.get_current_time_function() + delay)
+            self.increment('retried')
+            return True
+
+        self.broker.ack(ticket)
+        self.increment('sent')
+        return True
+
+    def run(self):
+        """
+        This sends messages until the process exits
+        """
+        while True:
+            try:
+                if self.process_one():
+                    continue
+            except Exception as e:
+                logging.warning('The outbound message worker failed: {}'.format(e))
+            self.sleep_function(self.poll_interval)
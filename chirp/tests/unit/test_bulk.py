@@ -0,0 +1,232 @@
+import unittest
+import hashlib
+import io
+import json
+import os
+import tempfile
+import pyarrow as pa
+import pyarrow.parquet as pq
+from parameterized import parameterized
+import bulk
+
+LEVELS = ['green', 'yellow', 'amber', 'red']
+
+
+def verify_phone_number(phone_number):
+    """
+    This is a stand in for chirp.verify_phone_number, accepting 11 digit numbers starting with 07
+    """
+    if len(phone_number) == 11 and phone_number.startswith('07'):
+        return {'success': True, 'message': 'The phone number is valid'}
+    return {'success': False, 'message': 'The phone number is of an invalid format'}
+
+
+class StopImport(Exception):
+    """
+    This stops an import part way through, as if the process were stopped
+    """
+
+
+class MockS3Resource:
+    """
+    This is a mock of the AWS S3 resource holding objects in a dictionary
+    """
+
+    class NoSuchKey(Exception):
+        pass
+
+    def __init__(self, objects):
+        """
+        param: (dict) objects: The body of each object keyed by the bucket and key
+        """
+        self.objects = objects
+        self.meta = type('Meta', (), {'client': type('Client', (), {'exceptions': type(self)})()})()
+
+    def Object(self, bucket_name, key):
+        resource = self
+
+        def get(self):
+            if (bucket_name, key) not in resource.objects:
+                raise MockS3Resource.NoSuchKey(key)
+            body = resource.objects[(bucket_name, key)]
+            return {'Body': io.BytesIO(body if isinstance(body, bytes) else body.encode('utf-8'))}
+
+        return type('Object', (), {'get': get})()
+
+    def Bucket(self, bucket_name):
+        keys = [key for bucket, key in self.objects if bucket == bucket_name]
+        summaries = lambda prefix: iter([type('ObjectSummary', (), {'key': key})() for key in keys
+                                         if key.startswith(prefix)])
+        objects = type('Objects', (), {
+            'all': lambda self: summaries(''), 'filter': lambda self, Prefix: summaries(Prefix)})()
+        return type('Bucket', (), {'objects': objects})()
+
+
+class TestBulk(unittest.TestCase):
+
+    def validate(self, subscriber):
+        return bulk.validate_subscriber(subscriber, LEVELS, verify_phone_number)
+
+    @parameterized.expand([
+        ["CSV", 'csv', ['phone,topic,opt-in\n', '07719143007,amber,true\n'],
+         [{'phone': '07719143007', 'topic': 'amber', 'opt-in': 'true'}]],
+        ["NDJSON", 'ndjson', ['{"phone": "07719143007", "topic": "amber"}\n', '\n', 'not json\n', '[1]\n'],
+         [{'phone': '07719143007', 'topic': 'amber'}, {'error': 'The line is empty'},
+          {'error': 'The line is not valid JSON'}, {'error': 'The line is not a JSON object'}]]
+    ])
+    def test_read_subscribers(self, test_name, file_format, lines, expected_subscribers):
+
+        self.assertEqual(
+            first=list(bulk.read_subscribers(lines, file_format)),
+            second=expected_subscribers)
+
+    def test_read_subscribers_unsupported_format(self):
+
+        with self.assertRaises(ValueError):
+            list(bulk.read_subscribers([], 'xml'))
+
+    @parameterized.expand([
+        ["Valid", {'phone': ' 07719143007 ', 'topic': 'Amber', 'opt-in': 'yes'},
+         {'phone': '07719143007', 'topic': 'amber', 'opt-in': 'True'}, None],
+        ["No opt-in", {'phone': '07719143007', 'topic': 'red'},
+         {'phone': '07719143007', 'topic': 'red', 'opt-in': 'False'}, None],
+        ["Invalid phone", {'phone': '12345', 'topic': 'red'}, None, 'The phone number is of an invalid format'],
+        ["Missing phone", {'topic': 'red'}, None, 'The phone number is of an invalid format'],
+        ["Invalid topic", {'phone': '07719143007', 'topic': 'purple'}, None,
+         "The topic purple is not one of ['amber', 'green', 'red', 'yellow']"],
+        ["Unreadable line", {'error': 'The line is not valid JSON'}, None, 'The line is not valid JSON']
+    ])
+    def test_validate_subscriber(self, test_name, subscriber, expected_payload, expected_message):
+
+        self.assertEqual(
+            first=self.validate(subscriber),
+            second=(expected_payload, expected_message))
+
+    def test_import_subscribers(self):
+
+        saved = []
+
+        def save_function(payload):
+            if payload['phone'] == '07719143009':
+                raise RuntimeError('S3 is down')
+            saved.append(payload['phone'])
+            return {'success': True, 'message': 'Saved'}
+
+        subscribers = [
+            {'phone': '07719143007', 'topic': 'amber'},
+            {'phone': '12345', 'topic': 'amber'},
+            {'phone': '07719143008', 'topic': 'red'},
+            {'phone': '07719143009', 'topic': 'red'}
+        ]
+
+        report = bulk.import_subscribers(subscribers, self.validate, save_function, workers=2, batch_size=3)
+
+        self.assertEqual(
+            first=(sorted(saved), report),
+            second=(['07719143007', '07719143008'], {
+                'source': None, 'processed': 4, 'saved': 2, 'invalid': 1, 'failed': 1,
+                'errors': [{'record': 2, 'message': 'The phone number is of an invalid format'},
+                           {'record': 4, 'message': 'S3 is down'}]}))
+
+    def test_import_subscribers_resumes_from_checkpoint(self):
+
+        checkpoint_path = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+        subscribers = [{'phone': '0771914300{}'.format(number), 'topic': 'red'} for number in range(5)]
+        saved = []
+
+        def save_function(payload):
+            saved.append(payload['phone'])
+            return {'success': True, 'message': 'Saved'}
+
+        def stop_after_first_batch(report):
+            raise StopImport()
+
+        with self.assertRaises(StopImport):
+            bulk.import_subscribers(
+                subscribers, self.validate, save_function, batch_size=2, checkpoint_path=checkpoint_path,
+                source='subscribers.csv', progress_function=stop_after_first_batch)
+
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+
+        report = bulk.import_subscribers(
+            subscribers, self.validate, save_function, batch_size=2, checkpoint_path=checkpoint_path,
+            source='subscribers.csv')
+
+        # The first batch was checkpointed so isn't saved again
+        self.assertEqual(
+            first=(checkpoint['processed'], sorted(saved), report['processed'], report['saved']),
+            second=(2, [subscriber['phone'] for subscriber in subscribers], 5, 5))
+
+    def test_import_subscribers_refuses_other_checkpoint(self):
+
+        checkpoint_path = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+        bulk.save_checkpoint(checkpoint_path, {'source': 'other.csv', 'processed': 2})
+
+        with self.assertRaises(ValueError):
+            bulk.import_subscribers(
+                [], self.validate, lambda payload: None, checkpoint_path=checkpoint_path, source='subscribers.csv')
+
+    def test_export_subscribers(self):
+
+        subscribers = {
+            'topic=red/subscriber-a.json': {'phone': '07719143007', 'topic': 'red', 'opt-in': 'True'},
+            'subscriber-b.json': {'phone': '07719143008', 'topic': 'amber', 'opt-in': 'False'}
+        }
+        objects = {('subscribers', key): json.dumps(subscriber) for key, subscriber in subscribers.items()}
+        # Objects which aren't subscribers are skipped
+        objects[('subscribers', 'notes.txt')] = 'not a subscriber'
+        output = io.StringIO()
+
+        exported = bulk.export_subscribers(MockS3Resource(objects), 'subscribers', output, workers=2)
+
+        self.assertEqual(
+            first=(exported, [json.loads(line) for line in output.getvalue().splitlines()]),
+            second=(2, list(subscribers.values())))
+
+    def test_export_subscribers_with_snapshot(self):
+
+        def phone_hash(phone):
+            return hashlib.md5(phone.encode('utf-8')).hexdigest()
+
+        snapshot = pa.table({
+            'phone_hash': [phone_hash(phone) for phone in ['07719143001', '07719143002', '07719143003']],
+            'phone': ['07719143001', '07719143002', '07719143003'],
+            'topic': ['amber', 'red', 'yellow'],
+            'opt_in': ['True', 'False', 'True']
+        })
+        snapshot_file = io.BytesIO()
+        pq.write_table(snapshot, snapshot_file)
+
+        # The second subscriber changed topic and the third unsubscribed since the snapshot, the fourth is new
+        saved = [{'phone': '07719143002', 'topic': 'green', 'opt-in': 'False'},
+                 {'phone': '07719143004', 'topic': 'red', 'opt-in': 'True'}]
+        objects = {('subscribers', 'subscriber-{}.json'.format(phone_hash(subscriber['phone']))): json.dumps(subscriber)
+                   for subscriber in saved}
+        objects.update({
+            ('snapshots', 'current-snapshot.json'): json.dumps({'snapshot': '20191020T100000'}),
+            ('snapshots', 'snapshots/snapshot_id=20191020T100000/part-00000.parquet'): snapshot_file.getvalue(),
+            ('snapshots', 'tombstones/tombstone-{}.json'.format(phone_hash('07719143003'))): json.dumps(
+                {'phone_hash': phone_hash('07719143003')})
+        })
+        output = io.StringIO()
+
+        exported = bulk.export_subscribers(
+            MockS3Resource(objects), 'subscribers', output, workers=2, snapshots_bucket_name='snapshots')
+
+        self.assertEqual(
+            first=(exported, [json.loads(line) for line in output.getvalue().splitlines()]),
+            second=(3, saved + [{'phone': '07719143001', 'topic': 'amber', 'opt-in': 'True'}]))
+
+    def test_export_subscribers_before_first_snapshot(self):
+
+        subscriber = {'phone': '07719143007', 'topic': 'red', 'opt-in': 'True'}
+        objects = {('subscribers', 'subscriber-a.json'): json.dumps(subscriber)}
+        output = io.StringIO()
+
+        exported = bulk.export_subscribers(
+            MockS3Resource(objects), 'subscribers', output, workers=2, snapshots_bucket_name='snapshots')
+
+        self.assertEqual(
+            first=(exported, [json.loads(line) for line in output.getvalue().splitlines()]),
+            second=(1, [subscriber]))
@@ -0,0 +1,221 @@
+import unittest
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from parameterized import parameterized
+import chirp
+
+
+class MockS3Resource:
+    """
+    This is a mock of the AWS S3 resource holding objects in a dictionary
+    """
+
+    class NoSuchKey(Exception):
+        pass
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.meta = type('Meta', (), {'client': type('Client', (), {'exceptions': type(self)})()})()
+
+    def Object(self, bucket_name, key):
+        resource = self
+
+        class Object:
+
+            def put(self, Body):
+                with resource.lock:
+                    resource.objects[(bucket_name, key)] = Body
+
+            def get(self):
+                if (bucket_name, key) not in resource.objects:
+                    raise MockS3Resource.NoSuchKey(key)
+                body = resource.objects[(bucket_name, key)]
+                return {'Body': io.BytesIO(body if isinstance(body, bytes) else body.encode('utf-8'))}
+
+            def delete(self):
+                with resource.lock:
+                    resource.objects.pop((bucket_name, key), None)
+
+        return Object()
+
+    def Bucket(self, bucket_name):
+        resource = self
+
+        class Bucket:
+
+            class objects:
+
+                @staticmethod
+                def all():
+                    return [type('ObjectSummary', (), {'key': key})()
+                            for bucket, key in list(resource.objects) if bucket == bucket_name]
+
+                @staticmethod
+                def filter(Prefix):
+                    return [summary for summary in Bucket.objects.all() if summary.key.startswith(Prefix)]
+
+            @staticmethod
+            def delete_objects(Delete):
+                for deleted_object in Delete['Objects']:
+                    resource.Object(bucket_name, deleted_object['Key']).delete()
+
+        return Bucket()
+
+
+class TestChirp(unittest.TestCase):
+
+    def setUp(self):
+        self.s3 = MockS3Resource()
+        self.saved_globals = dict(chirp.globals)
+        chirp.globals.update({
+            's3': self.s3, 'bucket_name': 'subscribers', 'snapshots_bucket_name': None, 'subscriber_layout': 'flat',
+            'bulk_token': 'secret', 'bulk_workers': 2})
+        self.client = chirp.create_app().test_client()
+
+    def tearDown(self):
+        chirp.globals.clear()
+        chirp.globals.update(self.saved_globals)
+
+    def get_saved_subscribers(self):
+        return sorted(
+            (json.loads(body) for (bucket, key), body in self.s3.objects.items() if bucket == 'subscribers'),
+            key=lambda subscriber: subscriber['phone'])
+
+    @parameterized.expand([
+        ["No token", 'secret', {}],
+        ["Not a bearer token", 'secret', {'Authorization': 'secret'}],
+        ["Wrong token", 'secret', {'Authorization': 'Bearer wrong'}],
+        ["No bulk token set", None, {'Authorization': 'Bearer '}],
+        ["Empty bulk token set", '', {'Authorization': 'Bearer '}]
+    ])
+    def test_bulk_unauthorised(self, test_name, bulk_token, headers):
+
+        chirp.globals['bulk_token'] = bulk_token
+        self.s3.Object('subscribers', 'subscriber-a.json').put(Body=json.dumps({'phone': '07719143007'}))
+
+        import_response = self.client.post(
+            '/subscribers/import', data='phone,topic\n07719143008,red\n', content_type='text/csv', headers=headers)
+        export_response = self.client.get('/subscribers/export', headers=headers)
+
+        self.assertEqual(
+            first=(import_response.status_code, export_response.status_code, len(self.s3.objects)),
+            second=(401, 401, 1))
+
+    def test_import_subscribers(self):
+
+        response = self.client.post(
+            '/subscribers/import',
+            data='phone,topic,opt-in\n07719143007,amber,yes\n12345,red,no\n07719143008,purple,no\n',
+            content_type='text/csv',
+            headers={'Authorization': 'Bearer secret'})
+
+        self.assertEqual(
+            first=(response.status_code, response.get_json(), self.get_saved_subscribers()),
+            second=(200, {
+                'success': True, 'source': None, 'processed': 3, 'saved': 1, 'invalid': 2, 'failed': 0,
+                'errors': [
+                    {'record': 2, 'message': 'The phone number is of an invalid format, please ensure that it starts '
+                                             'with 07 rather than +44 and has 11 digits'},
+                    {'record': 3, 'message': "The topic purple is not one of ['amber', 'green', 'red', 'yellow']"}]},
+                [{'phone': '07719143007', 'topic': 'amber', 'opt-in': 'True'}]))
+
+    def test_import_subscribers_unsupported_type(self):
+
+        response = self.client.post(
+            '/subscribers/import', data='{}', content_type='application/json',
+            headers={'Authorization': 'Bearer secret'})
+
+        self.assertEqual(response.status_code, 415)
+
+    def test_export_subscribers(self):
+
+        subscribers = [
+            {'phone': '07719143007', 'topic': 'amber', 'opt-in': 'True'},
+            {'phone': '07719143008', 'topic': 'red', 'opt-in': 'False'}
+        ]
+        for subscriber in subscribers:
+            chirp.save_user_to_s3(self.s3, 'subscribers', subscriber)
+
+        response = self.client.get('/subscribers/export', headers={'Authorization': 'Bearer secret'})
+        exported = sorted(
+            (json.loads(line) for line in response.get_data(as_text=True).splitlines()),
+            key=lambda subscriber: subscriber['phone'])
+
+        # The export can be imported again
+        self.s3.objects.clear()
+        import_response = self.client.post(
+            '/subscribers/import', data=response.get_data(), content_type='application/x-ndjson',
+            headers={'Authorization': 'Bearer secret'})
+
+        self.assertEqual(
+            first=(response.status_code, response.mimetype, exported, import_response.get_json()['saved'],
+                   self.get_saved_subscribers()),
+            second=(200, 'application/x-ndjson', subscribers, 2, subscribers))
+
+    def test_get_outbox_starts_workers(self):
+
+        directory = os.path.join(tempfile.mkdtemp(), 'outbox')
+        chirp.globals.pop('outbox', None)
+        chirp.globals.update({'outbound_queue_url': 'spool://' + directory, 'twilio_throttle': None})
+
+        sent = threading.Event()
+        # A message left queued before the worker started is sent without a new one being queued
+        chirp.outbox.create_broker('spool://' + directory).put(
+            {'id': 'abc', 'to': '07719143007', 'body': 'Your code is 123456', 'attempts': 0})
+        original_send_message = chirp.send_message
+        chirp.send_message = lambda twilio_client, phone_number, message_body, throttle: sent.set()
+        chirp.globals['twilio_client'] = None
+
+        try:
+            outbound_queue = chirp.get_outbox()
+            self.assertEqual(
+                first=(sent.wait(timeout=5), outbound_queue.started_pid),
+                second=(True, os.getpid()))
+        finally:
+            chirp.send_message = original_send_message
+
+    def test_retire_metrics(self):
+
+        chirp.metrics.registry.reset()
+        directory = tempfile.mkdtemp()
+        for pid, requests in [(101, 2), (102, 3), (103, 5)]:
+            registry = chirp.metrics.Registry()
+            registry.increment('chirp_responses_total', requests, labels={'route': '/subscribe'})
+            with open(os.path.join(directory, '{}.json'.format(pid)), 'w') as metrics_file:
+                json.dump(registry.snapshot(), metrics_file)
+
+        def count_requests():
+            return chirp.load_metrics(directory).as_dict()['counters'].get(
+                'chirp_responses_total{route="/subscribe"}', 0)
+
+        before = count_requests()
+        chirp.retire_metrics(directory, 101)
+        chirp.retire_metrics(directory, 102)
+        # A worker which never saved its metrics leaves nothing to retire
+        chirp.retire_metrics(directory, 104)
+
+        self.assertEqual(
+            first=(before, count_requests(), sorted(name for name in os.listdir(directory) if name.endswith('.json'))),
+            second=(10, 10, ['103.json', chirp.RETIRED_METRICS_FILE]))
+
+    def test_import_has_no_side_effects(self):
+
+        directory = os.path.join(tempfile.mkdtemp(), 'outbox')
+        chirp_directory = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+        # Import chirp in a fresh process as this process may have already created them
+        output = subprocess.run(
+            [sys.executable, '-c', 'import chirp; print(sorted(set(chirp.globals) & {"outbox", "verification_codes", '
+                                   '"s3", "twilio_client"}), hasattr(chirp, "app"))'],
+            cwd=chirp_directory, env=dict(os.environ, OUTBOUND_QUEUE_URL='spool://' + directory),
+            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+        self.assertEqual(
+            first=(output, os.path.exists(directory)),
+            second=('[] False\n', False))
@@ -0,0 +1,260 @@
+import unittest
+import os
+import tempfile
+import threading
+from parameterized import parameterized
+import code_store
+
+
+class MockClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class FakeRedis:
+    """
+    This is a fake of the Redis client holding hashes in a dictionary, expiring them with a mock
+    clock and running each pipeline in one step in the same way as MULTI and EXEC. The script
+    counting an attempt is run in one step as well, in the same way as Redis runs Lua scripts.
+    """
+
+    class Pipeline:
+
+        def __init__(self, client):
+            self.client = client
+            self.commands = []
+
+        def __getattr__(self, name):
+            return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+        def execute(self):
+            with self.client.lock:
+                return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.hashes = {}
+        self.expires_at = {}
+        self.lock = threading.RLock()
+
+    def pipeline(self, transaction=True):
+        return self.Pipeline(self)
+
+    def register_script(self, script):
+        assert script == code_store.RedisCodeStore.INCREMENT_ATTEMPTS_SCRIPT
+
+        def increment_attempts(keys, args=()):
+            with self.lock:
+                return self.hincrby(keys[0], 'attempts', 1) if self.exists(keys[0]) else None
+
+        return increment_attempts
+
+    def remove_expired(self, key):
+        if key in self.expires_at and self.expires_at[key] <= self.clock.time():
+            self.hashes.pop(key, None)
+            self.expires_at.pop(key, None)
+
+    def exists(self, key):
+        self.remove_expired(key)
+        return int(key in self.hashes)
+
+    def hset(self, key, mapping):
+        self.remove_expired(key)
+        self.hashes.setdefault(key, {}).update({name: str(value).encode('utf-8') for name, value in mapping.items()})
+
+    def hgetall(self, key):
+        self.remove_expired(key)
+        return {name.encode('utf-8'): value for name, value in self.hashes.get(key, {}).items()}
+
+    def hincrby(self, key, name, amount):
+        self.remove_expired(key)
+        values = self.hashes.setdefault(key, {})
+        values[name] = str(int(values.get(name, 0)) + amount).encode('utf-8')
+        return int(values[name])
+
+    def expire(self, key, seconds):
+        self.expires_at[key] = self.clock.time() + seconds
+
+    def delete(self, key):
+        self.hashes.pop(key, None)
+        self.expires_at.pop(key, None)
+
+
+def create_store(store_type, clock, ttl=60):
+    """
+    param: (str) store_type: The type of store, one of memory, sqlite or redis
+    param: (MockClock) clock: The clock the store expires the codes with
+    param: (int) ttl: The number of seconds to keep a code for
+
+    returns: (object) store: The store
+    """
+
+    if store_type == 'memory':
+        return code_store.MemoryCodeStore(ttl, get_current_time_function=clock.time)
+
+    if store_type == 'sqlite':
+        path = os.path.join(tempfile.mkdtemp(), 'codes.db')
+        return code_store.SQLiteCodeStore(path, ttl, get_current_time_function=clock.time)
+
+    return code_store.RedisCodeStore(FakeRedis(clock), ttl)
+
+
+STORE_TYPES = [["Memory", 'memory'], ["SQLite", 'sqlite'], ["Redis", 'redis']]
+
+
+class TestCodeStore(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = MockClock()
+        self.record = {'verify_code': '123456', 'verification_timestamp': 1000.0, 'attempts': 0, 'level': 'amber'}
+
+    @parameterized.expand(STORE_TYPES)
+    def test_set_and_get(self, test_name, store_type):
+
+        store = create_store(store_type, self.clock)
+        store.set('hash', self.record)
+
+        self.assertEqual(
+            first=(store.get('hash'), store.get('other')),
+            second=(self.record, None))
+
+    @parameterized.expand(STORE_TYPES)
+    def test_expiry(self, test_name, store_type):
+
+        store = create_store(store_type, self.clock, ttl=60)
+        store.set('hash', self.record)
+
+        self.clock.now += 59
+        before_expiry = store.get('hash')
+        self.clock.now += 1
+
+        self.assertEqual(
+            first=(before_expiry is not None, store.get('hash'), store.increment_attempts('hash')),
+            second=(True, None, None))
+
+        # The increment mustn't bring an expired code back
+        self.assertIsNone(store.get('hash'))
+
+    @parameterized.expand(STORE_TYPES)
+    def test_increment_attempts(self, test_name, store_type):
+
+        store = create_store(store_type, self.clock)
+        store.set('hash', self.record)
+
+        # Each attempt returns the number made before it, which chirp compares with the maximum attempts
+        attempts = [store.increment_attempts('hash') for _ in range(4)]
+
+        self.assertEqual(
+            first=(attempts, store.get('hash')['attempts']),
+            second=([0, 1, 2, 3], 4))
+
+    @parameterized.expand(STORE_TYPES)
+    def test_set_resets_attempts(self, test_name, store_type):
+
+        store = create_store(store_type, self.clock)
+        store.set('hash', self.record)
+        for _ in range(3):
+            store.increment_attempts('hash')
+
+        store.set('hash', dict(self.record, verify_code='654321'))
+
+        self.assertEqual(
+            first=(store.get('hash')['verify_code'], store.increment_attempts('hash')),
+            second=('654321', 0))
+
+    @parameterized.expand(STORE_TYPES)
+    def test_consume_once(self, test_name, store_type):
+
+        store = create_store(store_type, self.clock)
+        store.set('hash', self.record)
+
+        # chirp deletes a code once it has been used
+        self.assertEqual(store.increment_attempts('hash'), 0)
+        store.delete('hash')
+
+        self.assertEqual(
+            first=(store.get('hash'), store.increment_attempts('hash'), store.get('hash')),
+            second=(None, None, None))
+
+    def test_sqlite_concurrent_attempts(self):
+
+        path = os.path.join(tempfile.mkdtemp(), 'codes.db')
+        code_store.SQLiteCodeStore(path, 60).set('hash', self.record)
+
+        # Each thread has its own connection, and each store stands in for another worker process
+        stores = [code_store.SQLiteCodeStore(path, 60) for _ in range(4)]
+        attempts = []
+        lock = threading.Lock()
+
+        def attempt(store):
+            for _ in range(10):
+                value = store.increment_attempts('hash')
+                with lock:
+                    attempts.append(value)
+
+        threads = [threading.Thread(target=attempt, args=(store,)) for store in stores for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # No two attempts can see the same count
+        self.assertEqual(
+            first=(sorted(attempts), stores[0].get('hash')['attempts']),
+            second=(list(range(80)), 80))
+
+    def test_sqlite_shared_between_stores(self):
+
+        path = os.path.join(tempfile.mkdtemp(), 'codes.db')
+        writer = code_store.SQLiteCodeStore(path, 60, get_current_time_function=self.clock.time)
+        reader = code_store.SQLiteCodeStore(path, 60, get_current_time_function=self.clock.time)
+
+        writer.set('hash', self.record)
+        self.clock.now += 60
+        writer.set('other', self.record)
+
+        # Saving a code removes those which have expired
+        self.assertEqual(
+            first=(reader.get('hash'), len(reader)),
+            second=(None, 1))
+
+    def test_memory_store_len(self):
+
+        store = code_store.MemoryCodeStore(60, get_current_time_function=self.clock.time)
+        store.set('hash', self.record)
+        store.set('other', self.record)
+        self.clock.now += 60
+
+        self.assertEqual(len(store), 0)
+
+    def test_memory_store_saved_again(self):
+
+        store = code_store.MemoryCodeStore(60, get_current_time_function=self.clock.time)
+        store.set('hash', self.record)
+        self.clock.now += 30
+        store.set('hash', dict(self.record, verify_code='654321'))
+        store.set('other', self.record)
+        self.clock.now += 40
+
+        # Only the expiry of the code as first saved has passed, so only that is dropped from the queue
+        self.assertEqual(
+            first=(store.get('hash')['verify_code'], len(store), len(store.expiries)),
+            second=('654321', 2, 2))
+
+    @parameterized.expand([
+        ["No URL", None, code_store.MemoryCodeStore],
+        ["Memory", 'memory://', code_store.MemoryCodeStore],
+        ["SQLite", 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'codes.db'), code_store.SQLiteCodeStore]
+    ])
+    def test_create_code_store(self, test_name, url, expected_type):
+
+        self.assertIsInstance(code_store.create_code_store(url, 60), expected_type)
+
+    def test_create_code_store_unsupported(self):
+
+        with self.assertRaises(ValueError):
+            code_store.create_code_store('memcached://localhost', 60)
@@ -0,0 +1,295 @@
+import unittest
+import os
+import tempfile
+import threading
+import time
+from parameterized import parameterized
+import outbox
+
+
+class MockClock:
+
+    def __init__(self):
+        # The spool compares the claim time with the modification time of the files, so start at the real time.
+        # It is a whole second so the due times in the names of the files aren't rounded up past it.
+        self.now = float(int(time.time()))
+
+    def time(self):
+        return self.now
+
+
+class FakeRedis:
+    """
+    This is a fake of the Redis client holding lists, sorted sets and hashes of bytes in
+    dictionaries, running each pipeline in one step in the same way as MULTI and EXEC
+    """
+
+    class Pipeline:
+
+        def __init__(self, client):
+            self.client = client
+            self.commands = []
+
+        def __getattr__(self, name):
+            return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+        def execute(self):
+            with self.client.lock:
+                return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+    def __init__(self):
+        self.lists = {}
+        self.sorted_sets = {}
+        self.hashes = {}
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def encode(value):
+        return value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+    def pipeline(self, transaction=True):
+        return self.Pipeline(self)
+
+    def lpush(self, key, value):
+        self.lists.setdefault(key, []).insert(0, self.encode(value))
+
+    def rpoplpush(self, source, destination):
+        if not self.lists.get(source):
+            return None
+        value = self.lists[source].pop()
+        self.lists.setdefault(destination, []).insert(0, value)
+        return value
+
+    def lrem(self, key, count, value):
+        values = self.lists.get(key, [])
+        if self.encode(value) not in values:
+            return 0
+        values.remove(self.encode(value))
+        return 1
+
+    def lrange(self, key, start, end):
+        return list(self.lists.get(key, []))
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    def zadd(self, key, mapping):
+        self.sorted_sets.setdefault(key, {}).update({self.encode(value): score for value, score in mapping.items()})
+
+    def zrangebyscore(self, key, minimum, maximum):
+        values = self.sorted_sets.get(key, {})
+        return sorted([value for value, score in values.items() if minimum <= score <= maximum], key=values.get)
+
+    def zrem(self, key, value):
+        return int(self.sorted_sets.get(key, {}).pop(self.encode(value), None) is not None)
+
+    def zcard(self, key):
+        return len(self.sorted_sets.get(key, {}))
+
+    def hset(self, key, name, value):
+        self.hashes.setdefault(key, {})[self.encode(name)] = self.encode(value)
+
+    def hsetnx(self, key, name, value):
+        if self.encode(name) not in self.hashes.get(key, {}):
+            self.hset(key, name, value)
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hdel(self, key, *names):
+        for name in names:
+            self.hashes.get(key, {}).pop(self.encode(name), None)
+
+
+def create_broker(broker_type, clock):
+    """
+    param: (str) broker_type: The type of broker, spool or redis
+    param: (MockClock) clock: The clock the broker schedules the messages with
+
+    returns: (object) broker: The broker with a claim timeout of 60 seconds
+    """
+
+    if broker_type == 'spool':
+        return outbox.SpoolBroker(tempfile.mkdtemp(), claim_timeout=60, get_current_time_function=clock.time)
+
+    return outbox.RedisBroker(FakeRedis(), claim_timeout=60, get_current_time_function=clock.time)
+
+
+BROKER_TYPES = [["Spool", 'spool'], ["Redis", 'redis']]
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = MockClock()
+        self.message = {'id': 'a', 'to': '07719143007', 'body': 'Your code is 123456', 'attempts': 0}
+
+    @parameterized.expand(BROKER_TYPES)
+    def test_claim_and_ack(self, test_name, broker_type):
+
+        broker = create_broker(broker_type, self.clock)
+        broker.put(self.message)
+
+        ticket, message = broker.claim()
+
+        # A claimed message can't be claimed again and stays in the broker until it is acknowledged
+        self.assertEqual(
+            first=(message, broker.claim(), len(broker)),
+            second=(self.message, None, 1))
+
+        broker.ack(ticket)
+
+        self.assertEqual(
+            first=(broker.claim(), len(broker)),
+            second=(None, 0))
+
+    @parameterized.expand(BROKER_TYPES)
+    def test_claim_oldest_first(self, test_name, broker_type):
+
+        broker = create_broker(broker_type, self.clock)
+        for message_id in ['a', 'b', 'c']:
+            broker.put(dict(self.message, id=message_id))
+            self.clock.now += 1
+
+        claimed = [broker.claim() for _ in range(3)]
+
+        self.assertEqual(
+            first=[message['id'] for ticket, message in claimed],
+            second=['a', 'b', 'c'])
+
+    @parameterized.expand(BROKER_TYPES)
+    def test_retry(self, test_name, broker_type):
+
+        broker = create_broker(broker_type, self.clock)
+        broker.put(self.message)
+        ticket, message = broker.claim()
+
+        broker.retry(ticket, dict(message, attempts=1), self.clock.now + 30)
+
+        # The retry isn't due yet
+        not_due = broker.claim()
+        self.clock.now += 30
+        ticket, message = broker.claim()
+
+        self.assertEqual(
+            first=(not_due, message['attempts'], len(broker)),
+            second=(None, 1, 1))
+
+    @parameterized.expand(BROKER_TYPES)
+    def test_release_stale_claims(self, test_name, broker_type):
+
+        broker = create_broker(broker_type, self.clock)
+        broker.put(self.message)
+
+        # The worker which claimed the message stops without acknowledging it
+        broker.claim()
+
+        self.clock.now += 30
+        before_timeout = broker.claim()
+        self.clock.now += 40
+        ticket, message = broker.claim()
+        broker.ack(ticket)
+
+        self.assertEqual(
+            first=(before_timeout, message, len(broker)),
+            second=(None, self.message, 0))
+
+    def test_redis_claim_without_time(self):
+
+        broker = create_broker('redis', self.clock)
+        broker.put(self.message)
+
+        # The worker stops between moving the message onto the processing list and recording the time
+        broker.client.rpoplpush(broker.key, broker.processing_key)
+
+        first_claim = broker.claim()
+        self.clock.now += 61
+
+        self.assertEqual(
+            first=(first_claim, broker.claim()[1]),
+            second=(None, self.message))
+
+    def test_create_broker(self):
+
+        directory = os.path.join(tempfile.mkdtemp(), 'outbox')
+        broker = outbox.create_broker('spool://' + directory)
+
+        self.assertEqual(
+            first=(type(broker), os.path.isdir(directory)),
+            second=(outbox.SpoolBroker, True))
+
+        with self.assertRaises(ValueError):
+            outbox.create_broker('sqs://queue')
+
+    def create_queue(self, send_function, max_attempts=3):
+        return outbox.OutboundQueue(
+            broker=create_broker('spool', self.clock),
+            send_function=send_function,
+            max_attempts=max_attempts,
+            base_delay=5,
+            max_delay=600,
+            get_current_time_function=self.clock.time,
+            random_function=lambda low, high: high)
+
+    def test_process_one_retries(self):
+
+        sent = []
+        failures = [RuntimeError('Twilio is down')] * 2
+
+        def send_function(phone_number, message_body):
+            if failures:
+                raise failures.pop()
+            sent.append((phone_number, message_body))
+
+        queue = self.create_queue(send_function)
+        queue.broker.put(self.message)
+
+        # The delays double from the base delay after each failure, 10 then 20 seconds
+        processed = [queue.process_one(), queue.process_one()]
+        self.clock.now += 10
+        processed += [queue.process_one()]
+        self.clock.now += 10
+        processed += [queue.process_one()]
+        self.clock.now += 10
+        processed += [queue.process_one(), queue.process_one()]
+
+        self.assertEqual(
+            first=(processed, sent, queue.counts, len(queue.broker)),
+            second=([True, False, True, False, True, False], [('07719143007', 'Your code is 123456')],
+                    {'queued': 0, 'sent': 1, 'retried': 2, 'failed': 0}, 0))
+
+    def test_process_one_gives_up(self):
+
+        def send_function(phone_number, message_body):
+            raise RuntimeError('Invalid number')
+
+        queue = self.create_queue(send_function, max_attempts=2)
+        queue.broker.put(self.message)
+
+        queue.process_one()
+        self.clock.now += 600
+        with self.assertLogs(level='WARNING'):
+            queue.process_one()
+
+        self.assertEqual(
+            first=(queue.counts, len(queue.broker)),
+            second=({'queued': 0, 'sent': 0, 'retried': 1, 'failed': 1}, 0))
+
+    def test_start_once_per_process(self):
+
+        queue = self.create_queue(lambda phone_number, message_body: None)
+        runs = threading.Semaphore(0)
+        queue.run = runs.release
+
+        queue.start()
+        queue.start()
+        started = runs.acquire(timeout=5)
+        started_again = runs.acquire(timeout=0.1)
+
+        # A forked worker has a different process id so starts its own workers
+        queue.started_pid = -1
+        queue.start()
+
+        self.assertEqual(
+            first=(started, started_again, runs.acquire(timeout=5)),
+            second=(True, False, True))
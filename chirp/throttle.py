@@ -0,0 +1,197 @@
+# This module is shared with silence, keep it in step with silence/throttle.py
+import logging
+import random
+import threading
+import time
+
+# Twilio returns this error code alongside a 429 status when too many requests are made
+TWILIO_TOO_MANY_REQUESTS_CODE = 20429
+
+
+class TokenBucket:
+    """
+    A token bucket which limits the rate of outbound requests. Tokens are added at a fixed rate up to the capacity
+    of the bucket and each request takes a token, so short bursts up to the capacity are allowed while the long
+    run rate stays at the refill rate. It is safe to share between threads.
+    """
+
+    def __init__(self, rate: float, capacity: int = None, get_current_time_function=time.monotonic,
+                 sleep_function=time.sleep) -> None:
+        """
+        :param float rate: The number of tokens added to the bucket per second
+        :param int capacity: The maximum number of tokens the bucket can hold, defaults to one second of tokens
+        :param func get_current_time_function: The function to use to get the current time in seconds
+        :param func sleep_function: The function to use to wait
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, int(rate))
+        self.get_current_time_function = get_current_time_function
+        self.sleep_function = sleep_function
+        self.tokens = float(self.capacity)
+        self.last_refill_time = get_current_time_function()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Takes a token from the bucket, blocking until one is available
+
+        :return: float wait_time: The time in seconds spent waiting for the token
+        """
+
+        with self.lock:
+            # Refill the bucket for the time that has passed since it was last refilled
+            now = self.get_current_time_function()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill_time) * self.rate)
+            self.last_refill_time = now
+
+            # Take the token now, going into debt if the bucket is empty so each thread waits its own turn
+            self.tokens -= 1
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if wait_time > 0:
+            self.sleep_function(wait_time)
+
+        return wait_time
+
+
+class ThrottleCounters:
+    """
+    Thread safe counters describing the outbound traffic passing through a throttle
+    """
+
+    names = ['sent', 'queued', 'throttled', 'retried', 'failed']
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counts = {name: 0 for name in self.names}
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        """
+        :param str name: The name of the counter to increment
+        :param int amount: The amount to increment the counter by
+        """
+        with self.lock:
+            self.counts[name] += amount
+
+    def as_dict(self) -> dict:
+        """
+        :return: dict counts: A copy of the current counts
+        """
+        with self.lock:
+            return dict(self.counts)
+
+
+def is_throttled(error: Exception) -> bool:
+    """
+    Checks whether an error was caused by the provider rejecting a request for exceeding its rate limit
+
+    :param Exception error: The error raised by the request
+
+    :return: bool: Whether the request was throttled
+    """
+    return getattr(error, 'status', None) == 429 or getattr(error, 'code', None) == TWILIO_TOO_MANY_REQUESTS_CODE
+
+
+def get_retry_after(error: Exception):
+    """
+    Gets the number of seconds the provider asked us to wait from the Retry-After header, where the error exposes
+    the headers of the response. The Twilio client does not, in which case None is returned.
+
+    :param Exception error: The error raised by the request
+
+    :return: float retry_after: The number of seconds to wait, or None if not available
+    """
+    headers = getattr(error, 'headers', None) or getattr(getattr(error, 'response', None), 'headers', None)
+
+    if not headers or 'Retry-After' not in headers:
+        return None
+
+    try:
+        return float(headers['Retry-After'])
+    except (TypeError, ValueError):
+        return None
+
+
+class Throttle:
+    """
+    Sends requests through a token bucket and retries those rejected by the provider for exceeding its rate limit,
+    backing off with jitter between attempts
+    """
+
+    def __init__(self, bucket: TokenBucket, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0,
+                 sleep_function=time.sleep, random_function=random.uniform) -> None:
+        """
+        :param TokenBucket bucket: The token bucket to take a token from before each attempt
+        :param int max_retries: The maximum number of times to retry a throttled request
+        :param float base_delay: The delay in seconds before the first retry
+        :param float max_delay: The maximum delay in seconds between retries
+        :param func sleep_function: The function to use to wait between retries
+        :param func random_function: The function to use to add jitter to the delays
+        """
+        self.bucket = bucket
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep_function = sleep_function
+        self.random_function = random_function
+        self.counters = ThrottleCounters()
+
+    def backoff_delay(self, attempt: int, retry_after: float = None) -> float:
+        """
+        Calculates how long to wait before retrying
+
+        :param int attempt: The number of the retry, starting from 0
+        :param float retry_after: The number of seconds the provider asked us to wait, if any
+
+        :return: float delay: The delay in seconds, never more than the maximum delay
+        """
+
+        # Honour the provider's request, with a little jitter so waiting threads don't all retry together
+        if retry_after is not None:
+            return min(self.max_delay, retry_after + self.random_function(0, self.base_delay))
+
+        # Otherwise use exponential backoff with full jitter
+        return self.random_function(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, function, *args, **kwargs):
+        """
+        Calls the function once a token is available, retrying if the provider throttles the request
+
+        :param func function: The function making the request
+        :param args: The positional arguments to call the function with
+        :param kwargs: The keyword arguments to call the function with
+
+        :return: The result of the function
+        """
+
+        attempt = 0
+
+        while True:
+            # Count the request as queued if it had to wait for a token
+            if self.bucket.acquire() > 0:
+                self.counters.increment('queued')
+
+            try:
+                result = function(*args, **kwargs)
+                self.counters.increment('sent')
+                return result
+
+            except Exception as e:
+                if not is_throttled(e):
+                    self.counters.increment('failed')
+                    raise
+
+                self.counters.increment('throttled')
+                retry_after = get_retry_after(e)
+
+                # Give up rather than hold the caller for longer than the maximum delay
+                if attempt >= self.max_retries or (retry_after is not None and retry_after > self.max_delay):
+                    self.counters.increment('failed')
+                    raise
+
+                delay = self.backoff_delay(attempt, retry_after)
+                logging.debug(f"Request throttled, retrying in {delay:.2f} secs")
+
+                self.counters.increment('retried')
+                self.sleep_function(delay)
+                attempt += 1
@@ -0,0 +1,120 @@
+"""
+Measures the peak resident memory of loading and filtering the subscriber data, with the previous types (only the
+phone as a string) and with the compact types from quiet.get_subscriber_read_options, read whole and in batches.
+
+Each measurement runs in a fresh process so that the peaks don't mix. Run from the silence directory:
+
+    python benchmarks/benchmark_memory.py --sizes 100000 1000000 --chunksize 50000
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LEVELS = ['green', 'yellow', 'amber', 'red']
+
+
+def get_peak_rss_mb() -> float:
+    """
+    :return: float peak_rss: The peak resident memory of this process in MB
+    """
+
+    # ru_maxrss carries over the parent's peak into a child process on Linux, VmHWM starts afresh
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(file_path: str, typed: bool, chunksize: int = None) -> None:
+    """
+    Loads and filters the subscribers then prints the peak resident memory before and after
+
+    :param str file_path: The path of the subscriber CSV
+    :param bool typed: Whether to use the compact types
+    :param int chunksize: If provided the subscribers are read and checked for eligibility in batches of this size
+    """
+
+    import pandas as pd
+    import quiet
+
+    # The memory used by the interpreter and libraries alone
+    baseline = get_peak_rss_mb()
+
+    # The default types are those main reads the subscribers with unless compact_subscriber_types is set
+    read_options = quiet.get_subscriber_read_options(LEVELS) if typed else {'dtype': {'phone': str}}
+    subscribers = pd.read_csv(file_path, chunksize=chunksize, **read_options)
+
+    # Check eligibility a batch at a time in the same way as main.send_notifications
+    eligible_subscribers = pd.concat([
+        quiet.check_eligibility(
+            subscriber_df_with_last_message=subscriber_chunk,
+            start_hour=8,
+            end_hour=20,
+            get_current_time_function=lambda: datetime(year=2019, month=10, day=20, hour=10, tzinfo=pytz.UTC))
+        for subscriber_chunk in ([subscribers] if chunksize is None else subscribers)])
+
+    quiet.send_notifications(
+        topic='green',
+        level=20.0,
+        subscriber_df=eligible_subscribers[eligible_subscribers['topic'] != 'green'],
+        client=None,
+        messages={level: '' for level in LEVELS},
+        levels=LEVELS)
+
+    print(baseline, get_peak_rss_mb(), eligible_subscribers.memory_usage(deep=True).sum() / 1024 ** 2)
+
+
+def main(sizes: list, chunksize: int) -> None:
+
+    from benchmark_quiet import create_subscribers
+
+    print('{:>10} {:>8} {:>10} {:>20} {:>18} {:>22}'.format(
+        'rows', 'types', 'chunksize', 'eligible frame MB', 'peak RSS delta MB', 'peak RSS MB per 100k'))
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'subscribers.csv')
+            create_subscribers(size).to_csv(file_path, index=False)
+
+            for typed, chunked in [(False, False), (False, True), (True, False), (True, True)]:
+                command = [sys.executable, os.path.abspath(__file__), '--measure', file_path]
+                if typed:
+                    command.append('--typed')
+                if chunked:
+                    command.extend(['--chunksize', str(chunksize)])
+
+                output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+                baseline, peak, frame_size = [float(value) for value in output.split()]
+
+                print('{:>10} {:>8} {:>10} {:>20.1f} {:>18.1f} {:>22.1f}'.format(
+                    size, 'compact' if typed else 'default', chunksize if chunked else '-', frame_size,
+                    peak - baseline, (peak - baseline) / size * 100000))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks the memory used by the subscriber data in quiet')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000],
+                        help='The numbers of subscribers to benchmark with')
+    parser.add_argument('--chunksize', type=int, default=50000,
+                        help='The batch size to read the subscribers in for the chunked measurement')
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    parser.add_argument('--typed', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure, args.typed, args.chunksize if '--chunksize' in sys.argv else None)
+    else:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        main(args.sizes, args.chunksize)
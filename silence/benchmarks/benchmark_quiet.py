@@ -0,0 +1,117 @@
+"""
+Measures the throughput of the subscriber filtering in quiet.check_eligibility and quiet.send_notifications.
+
+Run from the silence directory:
+
+    python benchmarks/benchmark_quiet.py --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import quiet
+
+LEVELS = ['green', 'yellow', 'amber', 'red']
+
+
+class NullTwilioClient:
+    """
+    A Twilio client which sends nothing, so only the filtering is measured
+    """
+
+    class Messages:
+
+        def create(self, from_, to, body):
+            raise RuntimeError("Not sent")
+
+    def __init__(self):
+        self.messages = self.Messages()
+
+
+def create_subscribers(size: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Creates a subscriber table like the one returned by the subscriber query, a third of whom were messaged today
+
+    :param int size: The number of subscribers
+    :param int seed: The random seed
+
+    :return: pd.DataFrame subscribers: The subscribers
+    """
+
+    random_state = np.random.RandomState(seed)
+    last_message = pd.Series(pd.to_datetime('2019-10-18') + pd.to_timedelta(
+        random_state.randint(0, 3 * 24 * 3600, size), unit='s')).dt.strftime('%Y-%m-%d %H:%M:%S.000')
+    # Some subscribers have never been messaged
+    last_message = last_message.mask(random_state.rand(size) < 0.1)
+
+    return pd.DataFrame({
+        'last_message': last_message,
+        'phone': ['07{:09d}'.format(i) for i in range(size)],
+        'topic': random_state.choice(LEVELS, size)
+    })
+
+
+def time_function(function, repeats: int) -> float:
+    """
+    :param func function: The function to time
+    :param int repeats: The number of times to run it
+
+    :return: float seconds: The fastest run in seconds
+    """
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def main(sizes: list, repeats: int) -> None:
+
+    current_time = datetime(year=2019, month=10, day=20, hour=10, tzinfo=pytz.UTC)
+
+    print('{:>10} {:>24} {:>24}'.format('rows', 'check_eligibility rows/s', 'send_notifications rows/s'))
+
+    for size in sizes:
+        subscribers = create_subscribers(size)
+
+        eligibility_time = time_function(
+            lambda: quiet.check_eligibility(
+                subscriber_df_with_last_message=subscribers.copy(),
+                start_hour=8,
+                end_hour=20,
+                get_current_time_function=lambda: current_time),
+            repeats)
+
+        # A green alert reaches no one subscribed to a higher level, so this times the topic filtering alone
+        notification_time = time_function(
+            lambda: quiet.send_notifications(
+                topic='green',
+                level=20.0,
+                subscriber_df=subscribers[subscribers['topic'] != 'green'].copy(),
+                client=NullTwilioClient(),
+                messages={level: '' for level in LEVELS},
+                levels=LEVELS),
+            repeats)
+
+        print('{:>10} {:>24,.0f} {:>24,.0f}'.format(size, size / eligibility_time, size / notification_time))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks the subscriber filtering in quiet')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='The numbers of subscribers to benchmark with')
+    parser.add_argument('--repeats', type=int, default=3, help='The number of runs to take the fastest of')
+    args = parser.parse_args()
+
+    main(args.sizes, args.repeats)
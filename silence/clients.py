@@ -0,0 +1,93 @@
+# This module is shared with chirp, keep it in step with chirp/clients.py
+import threading
+import boto3
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+from urllib3.util.retry import Retry
+
+# Sessions aren't thread-safe so each client is created from its own session under the lock, only the clients are
+# shared between threads, they are thread-safe and sharing them reuses their connection pools
+_aws_clients = {}
+_lock = threading.Lock()
+
+
+def create_aws_config(max_pool_connections: int = 10, connect_timeout: float = 5, read_timeout: float = 60,
+                      max_attempts: int = 5, retry_mode: str = 'adaptive') -> Config:
+    """
+    Creates the configuration for an AWS client
+
+    :param int max_pool_connections: The maximum number of connections to keep in the client's pool, this should be
+    at least the number of threads sharing the client
+    :param float connect_timeout: The number of seconds to wait to make a connection
+    :param float read_timeout: The number of seconds to wait for a response
+    :param int max_attempts: The maximum number of attempts to make for each request, including the first
+    :param str retry_mode: How to retry requests, adaptive also slows the client down when AWS is throttling it
+
+    :return: botocore.config.Config config: The configuration
+    """
+
+    return Config(
+        max_pool_connections=max_pool_connections,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        retries={'total_max_attempts': max_attempts, 'mode': retry_mode})
+
+
+def create_aws_client(service_name: str, resource: bool = False, public_key: str = None, secret_key: str = None,
+                      region: str = None, max_pool_connections: int = 10, connect_timeout: float = 5,
+                      read_timeout: float = 60, max_attempts: int = 5, retry_mode: str = 'adaptive'):
+    """
+    Gets a pooled AWS client, creating it the first time it is asked for with these settings
+
+    :param str service_name: The AWS service e.g. s3
+    :param bool resource: Whether to create a resource rather than a low level client
+    :param str public_key: The public key to use, if None the credentials are found by boto3 e.g. from a role
+    :param str secret_key: The secret key to use
+    :param str region: The AWS region to use
+    :param int max_pool_connections: The maximum number of connections to keep in the client's pool
+    :param float connect_timeout: The number of seconds to wait to make a connection
+    :param float read_timeout: The number of seconds to wait for a response
+    :param int max_attempts: The maximum number of attempts to make for each request, including the first
+    :param str retry_mode: How to retry requests
+
+    :return: The AWS client or resource
+    """
+
+    key = (service_name, resource, public_key, secret_key, region, max_pool_connections, connect_timeout,
+           read_timeout, max_attempts, retry_mode)
+
+    with _lock:
+        if key not in _aws_clients:
+            session = boto3.Session(aws_access_key_id=public_key, aws_secret_access_key=secret_key, region_name=region)
+            config = create_aws_config(max_pool_connections, connect_timeout, read_timeout, max_attempts, retry_mode)
+
+            _aws_clients[key] = (session.resource if resource else session.client)(service_name, config=config)
+
+        return _aws_clients[key]
+
+
+def create_twilio_client(account_sid: str, auth_token: str, pool_connections: int = 10, timeout: float = 30,
+                         connect_retries: int = 3) -> Client:
+    """
+    Creates a Twilio client which keeps its connections to Twilio open between requests
+
+    :param str account_sid: The Twilio account id
+    :param str auth_token: The Twilio authorisation token
+    :param int pool_connections: The maximum number of connections to keep open, this should be at least the number
+    of threads sharing the client
+    :param float timeout: The number of seconds to wait for Twilio to respond
+    :param int connect_retries: The number of times to retry failing to connect. Requests which reached Twilio
+    aren't retried here as that could send a message twice, throttled requests are retried by throttle.Throttle.
+
+    :return: twilio.rest.Client client: The Twilio client
+    """
+
+    http_client = TwilioHttpClient(pool_connections=True, timeout=timeout)
+    http_client.session.mount('https://', HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_connections,
+        max_retries=Retry(total=connect_retries, connect=connect_retries, read=0, status=0, backoff_factor=0.5)))
+
+    return Client(account_sid, auth_token, http_client=http_client)
@@ -0,0 +1,140 @@
+import argparse
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import pandas as pd
+import quiet
+import utilities
+
+
+def list_message_log_keys(s3, bucket_name: str, prefix: str = 'message-') -> list:
+    """
+    Lists the keys of the per message JSON notification logs
+
+    :param boto3.resource s3: The S3 resource to use
+    :param str bucket_name: The bucket holding the JSON notification logs
+    :param str prefix: The prefix of the per message log objects
+
+    :return: list[str] keys: The keys of the log objects
+    """
+
+    keys = []
+    paginator = s3.meta.client.get_paginator('list_objects_v2')
+
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        keys.extend(s3_object['Key'] for s3_object in page.get('Contents', []))
+
+    return keys
+
+
+def read_message_logs(s3, bucket_name: str, keys: list, max_workers: int = 8) -> list:
+    """
+    Reads the per message JSON notification logs in parallel
+
+    :param boto3.resource s3: The S3 resource to use
+    :param str bucket_name: The bucket holding the JSON notification logs
+    :param list[str] keys: The keys of the log objects to read
+    :param int max_workers: The maximum number of objects to read concurrently
+
+    :return: list[dict] message_logs: The message logs in the same order as the keys
+    """
+
+    client = s3.meta.client
+
+    def read(key):
+        return json.loads(client.get_object(Bucket=bucket_name, Key=key)['Body'].read())
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(read, keys))
+
+
+def compact_notification_logs(s3, source_bucket: str, destination_bucket: str, max_workers: int = 8,
+                              batch_size: int = 10000, delete_source: bool = False,
+                              get_current_time_function=datetime.now) -> dict:
+    """
+    Rewrites the per message JSON notification logs as Parquet files partitioned by the date each message was
+    created, the layout written by quiet.write_notification_logs with the parquet log format
+
+    :param boto3.resource s3: The S3 resource to use
+    :param str source_bucket: The bucket holding the JSON notification logs
+    :param str destination_bucket: The bucket to write the Parquet notification logs to
+    :param int max_workers: The maximum number of objects to read concurrently
+    :param int batch_size: The number of JSON objects to read before writing them out
+    :param bool delete_source: Whether to delete the JSON objects once they have been compacted
+    :param func get_current_time_function: The function to use to get the current time
+
+    :return: dict compaction_status: The number of messages compacted, the Parquet keys written and the number of
+    JSON objects deleted
+    """
+
+    compaction_status = {'messages': 0, 'written': [], 'deleted': 0}
+
+    keys = list_message_log_keys(s3, source_bucket)
+    logging.debug(f"There are {len(keys)} message logs to compact")
+
+    client = s3.meta.client
+    run_time = get_current_time_function().strftime('%Y%m%dT%H%M%S')
+
+    for batch_number, start in enumerate(range(0, len(keys), batch_size)):
+        batch_keys = keys[start:start + batch_size]
+        message_logs = read_message_logs(s3, source_bucket, batch_keys, max_workers)
+
+        # Partition the messages by the day they were created
+        days = pd.to_datetime([message['date_created'] for message in message_logs]).strftime('%Y-%m-%d')
+        partitions = {}
+        for day, message in zip(days, message_logs):
+            partitions.setdefault(day, []).append(message)
+
+        for day, partition_logs in partitions.items():
+            table = quiet.create_notification_log_table(partition_logs)
+            key = 'dt={}/compacted-{}-{}.parquet'.format(day, run_time, batch_number)
+
+            client.put_object(
+                Bucket=destination_bucket,
+                Key=key,
+                Body=quiet.write_parquet_bytes(table))
+
+            compaction_status['written'].append(key)
+
+        compaction_status['messages'] += len(message_logs)
+
+        # Only delete the JSON objects once every partition they were written to has been saved
+        if delete_source:
+            for delete_start in range(0, len(batch_keys), 1000):
+                client.delete_objects(
+                    Bucket=source_bucket,
+                    Delete={'Objects': [{'Key': key} for key in batch_keys[delete_start:delete_start + 1000]]})
+            compaction_status['deleted'] += len(batch_keys)
+
+        logging.debug(f"Compacted {compaction_status['messages']} of {len(keys)} message logs")
+
+    return compaction_status
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Compacts the per message JSON notification logs into Parquet files partitioned by date')
+    parser.add_argument('source_bucket', help='The bucket holding the JSON notification logs')
+    parser.add_argument('destination_bucket', help='The bucket to write the Parquet notification logs to')
+    parser.add_argument('--region', default=None, help='The AWS region of the buckets')
+    parser.add_argument('--max-workers', type=int, default=8, help='The number of objects to read concurrently')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='The number of JSON objects to read before writing them out')
+    parser.add_argument('--delete-source', action='store_true',
+                        help='Delete the JSON objects once they have been compacted')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.DEBUG)
+
+    print(compact_notification_logs(
+        s3=utilities.create_aws_client(
+            client_type='s3',
+            region=args.region,
+            max_pool_connections=args.max_workers),
+        source_bucket=args.source_bucket,
+        destination_bucket=args.destination_bucket,
+        max_workers=args.max_workers,
+        batch_size=args.batch_size,
+        delete_source=args.delete_source))
@@ -1,20 +1,64 @@
-import botocore
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
 import time
 import uuid
+import metrics
 
 
-def generate_data_view(client, results_bucket: str, database_name: str, sql_query: str, retry_time: int):
+class QueryFailedError(Exception):
+    """
+    Raised when an Athena query fails, is cancelled or does not complete in time
+    """
+    pass
+
+
+def supports_parameter(client, operation_name: str, parameter_name: str) -> bool:
+    """
+    param (boto3.client) client: The AWS client
+    param (str) operation_name: The name of the API operation e.g. StartQueryExecution
+    param (str) parameter_name: The name of the parameter
+
+    returns (bool) supported: Whether the installed botocore knows the parameter, True if the client has no model
+    """
+
+    try:
+        return parameter_name in client.meta.service_model.operation_model(operation_name).input_shape.members
+    except AttributeError:
+        return True
+
+
+def start_query(client, results_bucket: str, database_name: str, sql_query: str, result_reuse_minutes: int = None):
     """
     param (boto3.client) client: The Athena client
     param (str) results_bucket: The bucket to contain the Athena results
     param (str) database_name: The name of the database to execute the query against
     param (str) sql_query: The query to execute
-    param (int) retry_time: The retry time in seconds to check that the query has succeeded
+    param (int) result_reuse_minutes: If provided Athena returns the results of an identical query run within this
+    many minutes instead of scanning again. This needs Athena engine version 3 and a botocore release which knows
+    the parameter, with an older botocore the results aren't reused.
 
-    returns (str) output_bucket: The bucket containing the output of the Athena query
-    returns (str) output_file_path: The path of the output file from the Athena query
+    returns (str) query_id: The id of the query execution
     """
 
+    # Only ask Athena to reuse results if configured, older clients reject the parameter
+    extra_parameters = {}
+    if result_reuse_minutes is not None and not supports_parameter(
+            client, 'StartQueryExecution', 'ResultReuseConfiguration'):
+        logging.warning('The installed botocore does not support Athena result reuse, running the query afresh')
+    elif result_reuse_minutes is not None:
+        extra_parameters['ResultReuseConfiguration'] = {
+            'ResultReuseByAgeConfiguration': {
+                'Enabled': True,
+                'MaxAgeInMinutes': result_reuse_minutes
+            }
+        }
+
     # Start a new execution query
     response = client.start_query_execution(
         # The SQL query statements to be executed.
@@ -31,11 +75,34 @@ def generate_data_view(client, results_bucket: str, database_name: str, sql_quer
             'EncryptionConfiguration': {
                 'EncryptionOption': 'SSE_S3'
             }
-        }
+        },
+        **extra_parameters
     )
 
-    # Get the id of the query
-    query_id = response['QueryExecutionId']
+    # Return the id of the query
+    return response['QueryExecutionId']
+
+
+def wait_for_query(client, query_id: str, max_delay: float, initial_delay: float = 0.25, backoff: float = 2,
+                   timeout: float = None, sleep_function=time.sleep, get_current_time_function=time.monotonic):
+    """
+    Waits for a query to complete, polling quickly at first so short queries return promptly and then backing off
+    up to the maximum delay so long queries don't make needless requests
+
+    param (boto3.client) client: The Athena client
+    param (str) query_id: The id of the query execution
+    param (float) max_delay: The maximum time in seconds between checks on the query
+    param (float) initial_delay: The time in seconds before the first check on the query
+    param (float) backoff: The factor to increase the delay by after each check
+    param (float) timeout: The time in seconds after which to give up and cancel the query, None waits forever
+    param (func) sleep_function: The function to use to wait between checks
+    param (func) get_current_time_function: The function to use to get the current time in seconds
+
+    returns (dict) query_execution: The details of the completed query execution
+    """
+
+    start_time = get_current_time_function()
+    delay = min(initial_delay, max_delay)
 
     while True:
         # Check the status of the query's execution
@@ -45,42 +112,303 @@ def generate_data_view(client, results_bucket: str, database_name: str, sql_quer
         # Get the state and output details
         query_state = response['QueryExecution']['Status']['State']
 
-        # If the query has succeeded break the loop
+        # If the query has succeeded return the details of its execution
         if query_state == "SUCCEEDED":
-            output_file_details = response['QueryExecution']['ResultConfiguration']['OutputLocation'].split('/')
-            output_file_path = output_file_details[3]
-            output_bucket = output_file_details[2]
-            break
+            return response['QueryExecution']
+
+        elif query_state in ["FAILED", "CANCELLED"]:
+            raise QueryFailedError(response)
+
+        # Give up if the query has run for too long, cancelling it so that it stops costing money
+        if timeout is not None and get_current_time_function() - start_time + delay > timeout:
+            client.stop_query_execution(QueryExecutionId=query_id)
+            raise QueryFailedError(f"The query {query_id} did not complete within {timeout} secs")
+
+        # If it has not completed try again after the delay, backing off up to the maximum delay
+        sleep_function(delay)
+        delay = min(delay * backoff, max_delay)
+
+
+def get_query_statistics(query_execution: dict) -> dict:
+    """
+    param (dict) query_execution: The details of the completed query execution
+
+    returns (dict) statistics: The cost and timing of the query execution
+    """
+
+    statistics = query_execution.get('Statistics', {})
+
+    return {
+        'data_scanned_bytes': statistics.get('DataScannedInBytes'),
+        'engine_execution_time_ms': statistics.get('EngineExecutionTimeInMillis'),
+        'queue_time_ms': statistics.get('QueryQueueTimeInMillis'),
+        'total_execution_time_ms': statistics.get('TotalExecutionTimeInMillis')
+    }
+
+
+def run_query(client, results_bucket: str, database_name: str, sql_query: str, retry_time: float,
+              timeout: float = None, sleep_function=time.sleep, cache=None, cache_params: dict = None,
+              result_reuse_minutes: int = None):
+    """
+    param (boto3.client) client: The Athena client
+    param (str) results_bucket: The bucket to contain the Athena results
+    param (str) database_name: The name of the database to execute the query against
+    param (str) sql_query: The query to execute
+    param (float) retry_time: The maximum time in seconds between checks that the query has succeeded
+    param (float) timeout: The time in seconds after which to give up and cancel the query, None waits forever
+    param (func) sleep_function: The function to use to wait between checks
+    param (QueryCache) cache: If provided along with cache_params the results of an identical recent query are reused
+    param (dict) cache_params: Anything other than the query which the results depend on, such as the time window,
+    None if the results must never be reused
+    param (int) result_reuse_minutes: If provided along with cache_params Athena reuses the results of an identical
+    recent query
+
+    returns (dict) query_result: The query id, the bucket and path of the output file and the query statistics
+    """
+
+    query_request = {'results_bucket': results_bucket, 'sql_query': sql_query}
+
+    # Only queries which say what their results depend on may be reused
+    if cache_params is not None:
+        query_request['cache_params'] = cache_params
+
+    return run_queries(
+        client=client,
+        database_name=database_name,
+        query_requests=[query_request],
+        retry_time=retry_time,
+        timeout=timeout,
+        sleep_function=sleep_function,
+        cache=cache,
+        result_reuse_minutes=result_reuse_minutes)[0]
+
+
+def run_queries(client, database_name: str, query_requests: list, retry_time: float, timeout: float = None,
+                sleep_function=time.sleep, cache=None, result_reuse_minutes: int = None):
+    """
+    Runs several independent queries at the same time. All of the queries are submitted before waiting on any of
+    them so that Athena executes them concurrently, then they are waited on in parallel.
+
+    param (boto3.client) client: The Athena client, which is safe to share between threads
+    param (str) database_name: The name of the database to execute the queries against
+    param (list[dict]) query_requests: The results_bucket and sql_query of each query to run, along with
+    cache_params if the results of the query may be cached
+    param (float) retry_time: The maximum time in seconds between checks that a query has succeeded
+    param (float) timeout: The time in seconds after which to give up and cancel a query, None waits forever
+    param (func) sleep_function: The function to use to wait between checks
+    param (QueryCache) cache: If provided the results of identical recent queries with cache_params are reused
+    param (int) result_reuse_minutes: If provided Athena reuses the results of identical recent queries with
+    cache_params, the others are always run afresh
+
+    returns (list[dict]) query_results: The result of each query in the same order as the requests
+    """
+
+    query_results = [None] * len(query_requests)
+    cache_keys = [None] * len(query_requests)
+
+    # Reuse the results of any cacheable queries which have been run recently
+    if cache is not None:
+        for index, query_request in enumerate(query_requests):
+            if 'cache_params' not in query_request:
+                continue
+            cache_keys[index] = cache.make_key(
+                query_request['sql_query'], database_name, query_request['results_bucket'],
+                query_request['cache_params'])
+            query_results[index] = cache.get(cache_keys[index])
+            metrics.registry.increment(
+                'silence_query_cache_total', labels={'result': 'miss' if query_results[index] is None else 'hit'})
 
-        elif query_state == "FAILED":
-            raise Exception(response)
+    pending = [index for index, query_result in enumerate(query_results) if query_result is None]
 
-        # If it has not succeeded try again after the retry time
-        time.sleep(retry_time)
+    query_ids = [
+        start_query(
+            client, query_requests[index]['results_bucket'], database_name, query_requests[index]['sql_query'],
+            result_reuse_minutes if 'cache_params' in query_requests[index] else None)
+        for index in pending]
+
+    def wait(query_id):
+        with metrics.registry.time('silence_athena_wait_seconds'):
+            return wait_for_query(
+                client=client,
+                query_id=query_id,
+                max_delay=retry_time,
+                timeout=timeout,
+                sleep_function=sleep_function)
+
+    with ThreadPoolExecutor(max_workers=max(1, len(query_ids))) as executor:
+        query_executions = list(executor.map(wait, query_ids))
+
+    for index, query_execution in zip(pending, query_executions):
+        query_results[index] = create_query_result(query_execution)
+        record_query_metrics(query_results[index]['statistics'])
+        if cache_keys[index] is not None:
+            cache.put(cache_keys[index], query_results[index])
+
+    return query_results
+
+
+def record_query_metrics(statistics: dict) -> None:
+    """
+    param (dict) statistics: The cost and timing of a query execution from get_query_statistics
+    """
+
+    # Athena may leave out any of the statistics
+    if statistics['queue_time_ms'] is not None:
+        metrics.registry.observe('silence_athena_queue_seconds', statistics['queue_time_ms'] / 1000)
+    if statistics['engine_execution_time_ms'] is not None:
+        metrics.registry.observe('silence_athena_execution_seconds', statistics['engine_execution_time_ms'] / 1000)
+    if statistics['data_scanned_bytes'] is not None:
+        metrics.registry.increment('silence_athena_data_scanned_bytes_total', statistics['data_scanned_bytes'])
+
+
+def create_query_result(query_execution: dict) -> dict:
+    """
+    param (dict) query_execution: The details of the completed query execution
+
+    returns (dict) query_result: The query id, the bucket and path of the output file and the query statistics
+    """
+
+    # The output location is of the form s3://bucket/path
+    output_file_details = query_execution['ResultConfiguration']['OutputLocation'].split('/')
+
+    query_result = {
+        'query_id': query_execution['QueryExecutionId'],
+        'bucket': output_file_details[2],
+        'file_path': '/'.join(output_file_details[3:]),
+        'statistics': get_query_statistics(query_execution)
+    }
+
+    logging.debug(f"Query {query_result['query_id']} completed with statistics {query_result['statistics']}")
+
+    return query_result
+
+
+class QueryCache:
+    """
+    Caches the output locations of Athena queries so that an identical query run again within the time to live
+    reuses the results already in S3 instead of scanning again. The least recently used entries are evicted once
+    the cache is full. If a path is provided the cache is saved to a local file so that it survives restarts.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 32, path: str = None, get_current_time_function=time.time):
+        """
+        param (float) ttl: The time in seconds for which a result may be reused
+        param (int) max_entries: The maximum number of results to hold
+        param (str) path: The path of a local file to save the cache to, None keeps it in memory only
+        param (func) get_current_time_function: The function to use to get the current time in seconds
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.get_current_time_function = get_current_time_function
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+        if path is not None and os.path.exists(path):
+            with open(path) as json_file:
+                self.entries = OrderedDict(json.load(json_file))
+
+    @staticmethod
+    def make_key(sql_query: str, database_name: str, results_bucket: str, params: dict = None) -> str:
+        """
+        param (str) sql_query: The query
+        param (str) database_name: The name of the database the query is executed against
+        param (str) results_bucket: The bucket to contain the Athena results
+        param (dict) params: Anything other than the query which the results depend on
+
+        returns (str) key: The cache key
+        """
+
+        # Collapse whitespace so that queries differing only in layout share an entry
+        normalised_query = ' '.join(sql_query.split())
+
+        return hashlib.sha256(json.dumps(
+            [normalised_query, database_name, results_bucket, params or {}], sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
+    def get(self, key: str):
+        """
+        param (str) key: The cache key
+
+        returns (dict) query_result: The cached result, or None if there isn't one or it has expired
+        """
+
+        with self.lock:
+            if key not in self.entries:
+                return None
+
+            stored_time, query_result = self.entries[key]
+
+            if self.get_current_time_function() - stored_time > self.ttl:
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+
+        logging.debug(f"Reusing the results of query {query_result['query_id']}")
+
+        return dict(query_result, cached=True)
+
+    def put(self, key: str, query_result: dict) -> None:
+        """
+        param (str) key: The cache key
+        param (dict) query_result: The result to cache
+        """
+
+        with self.lock:
+            self.entries[key] = (self.get_current_time_function(), query_result)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+            if self.path is not None:
+                with open(self.path + '.tmp', 'w') as json_file:
+                    json.dump(list(self.entries.items()), json_file)
+                os.replace(self.path + '.tmp', self.path)
+
+
+def generate_data_view(client, results_bucket: str, database_name: str, sql_query: str, retry_time: int,
+                       timeout: float = None):
+    """
+    param (boto3.client) client: The Athena client
+    param (str) results_bucket: The bucket to contain the Athena results
+    param (str) database_name: The name of the database to execute the query against
+    param (str) sql_query: The query to execute
+    param (int) retry_time: The maximum time in seconds between checks that the query has succeeded
+    param (float) timeout: The time in seconds after which to give up and cancel the query, None waits forever
+
+    returns (str) output_bucket: The bucket containing the output of the Athena query
+    returns (str) output_file_path: The path of the output file from the Athena query
+    """
+
+    query_result = run_query(client, results_bucket, database_name, sql_query, retry_time, timeout)
 
     # Return the output bucket and file path
-    return output_bucket, output_file_path
+    return query_result['bucket'], query_result['file_path']
 
 
-def fetch_data_view(s3, bucket, file_path: str, output_path: str):
+def read_data_view(s3, bucket: str, file_path: str, dtype=None, chunksize: int = None, usecols: list = None,
+                   parse_dates: list = None):
     """
     param (boto3.resource) s3: The s3 resource
-    param (str) bucket: The bucket to retrieve the file from
-    param (str) file_path: The path to the file to retrieve
-    param (str) output_path: The path to save the file to
-    param (int) retry_time: The time to take before retrying to get the file
+    param (str) bucket: The bucket containing the output of the Athena query
+    param (str) file_path: The path of the output file from the Athena query
+    param (dict) dtype: The types of the columns, any not specified are inferred
+    param (int) chunksize: If provided the rows are read in batches of this size rather than all at once
+    param (list[str]) usecols: If provided only these columns are read
+    param (list[str]) parse_dates: The columns to parse as datetimes
+
+    returns (pd.DataFrame) data: The output of the query, or an iterator of DataFrames if a chunksize is provided
     """
 
-    while True:
+    # Stream the object straight into the parser rather than downloading it to disk first
+    with metrics.registry.time('silence_s3_get_object_seconds'):
+        body = s3.meta.client.get_object(Bucket=bucket, Key=file_path)['Body']
 
-        try:
-            # Try and retrieve the file
-            s3.Bucket(bucket).download_file(
-                file_path, output_path)
-            break
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                print("The object does not exist.")
-            else:
-                raise
+    # In batches the download and parsing happen as the batches are used so can't be timed here
+    if chunksize is not None:
+        return pd.read_csv(body, dtype=dtype, chunksize=chunksize, usecols=usecols, parse_dates=parse_dates)
 
+    with metrics.registry.time('silence_csv_read_seconds'):
+        return pd.read_csv(body, dtype=dtype, usecols=usecols, parse_dates=parse_dates)
@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+
+def load_last_notified(s3=None, bucket_name: str = None, key: str = None, local_path: str = None) -> dict:
+    """
+    Loads the index of when each subscriber was last sent a message, either from an object in S3 or from a local
+    file standing in for it
+
+    :param boto3.resource s3: The S3 resource to use
+    :param str bucket_name: The bucket holding the index
+    :param str key: The key of the index object
+    :param str local_path: The path of a local file to use instead of S3
+
+    :return: dict last_notified: The time each subscriber was last messaged keyed by the hash of their phone number
+    """
+
+    if local_path is not None:
+        if not os.path.exists(local_path):
+            logging.debug(f"No last notified index at {local_path}, starting a new one")
+            return {}
+        with open(local_path) as json_file:
+            return json.load(json_file)
+
+    try:
+        body = s3.meta.client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+    except s3.meta.client.exceptions.NoSuchKey:
+        logging.debug(f"No last notified index at s3://{bucket_name}/{key}, starting a new one")
+        return {}
+
+    return json.loads(body)
+
+
+def save_last_notified(last_notified: dict, s3=None, bucket_name: str = None, key: str = None,
+                       local_path: str = None) -> None:
+    """
+    Saves the index of when each subscriber was last sent a message
+
+    :param dict last_notified: The time each subscriber was last messaged keyed by the hash of their phone number
+    :param boto3.resource s3: The S3 resource to use
+    :param str bucket_name: The bucket to hold the index
+    :param str key: The key of the index object
+    :param str local_path: The path of a local file to use instead of S3
+    """
+
+    body = json.dumps(last_notified, separators=(',', ':'), sort_keys=True)
+
+    if local_path is not None:
+        # Write to a temporary file first so a crash part way through can't leave a corrupt index
+        with open(local_path + '.tmp', 'w') as json_file:
+            json_file.write(body)
+        os.replace(local_path + '.tmp', local_path)
+        return
+
+    s3.meta.client.put_object(Bucket=bucket_name, Key=key, Body=body.encode('utf-8'))
+
+
+def update_last_notified(last_notified: dict, message_logs: list) -> dict:
+    """
+    Updates the index with the messages sent in this cycle
+
+    :param dict last_notified: The time each subscriber was last messaged keyed by the hash of their phone number
+    :param list[dict] message_logs: The logs of the messages sent in this cycle, the 'to' field holds the hash of the
+    phone number
+
+    :return: dict last_notified: The updated index
+    """
+
+    for message in message_logs:
+        date_created = str(message['date_created'])
+        # The timestamps are all in the same format so compare as strings
+        if message['to'] not in last_notified or last_notified[message['to']] < date_created:
+            last_notified[message['to']] = date_created
+
+    return last_notified
+
+
+def prune_last_notified(last_notified: dict, retention_days: int, get_current_time_function=datetime.utcnow) -> dict:
+    """
+    Removes subscribers who have not been messaged within the retention period to keep the index small. The
+    eligibility check only needs to know who has been messaged today.
+
+    :param dict last_notified: The time each subscriber was last messaged keyed by the hash of their phone number
+    :param int retention_days: The number of days to keep entries for
+    :param func get_current_time_function: The function to use to get the current time
+
+    :return: dict last_notified: The pruned index
+    """
+
+    cutoff = str(get_current_time_function() - timedelta(days=retention_days))
+
+    return {phone_hash: date_created for phone_hash, date_created in last_notified.items() if date_created >= cutoff}
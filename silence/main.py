@@ -1,12 +1,20 @@
 import os
 import utilities
+import clients
 import feathers
 import quiet
-from twilio.rest import Client
-import time
+import queries
+import snapshots
+import last_notified
+import throttle
+import scheduler
+import metrics
 import logging
 from datetime import datetime, timedelta
+import time
+import pandas as pd
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 
 def generate_config() -> dict:
@@ -17,10 +25,21 @@ def generate_config() -> dict:
         'pollution_bucket': os.getenv("POLLUTION_QUERY_RESULTS_S3_BUCKET_NAME", None),
         'subscribers_bucket': os.getenv("SUBSCRIBERS_QUERY_RESULTS_S3_BUCKET_NAME", None),
         'logs_bucket': os.getenv("NOTIFICATION_LOGS_S3_BUCKET_NAME", None),
+        'parquet_logs_bucket': os.getenv("PARQUET_NOTIFICATION_LOGS_S3_BUCKET_NAME", None),
+        # The Parquet subscriber snapshots and the tombstones written by chirp
+        'subscriber_snapshots_bucket': os.getenv("SUBSCRIBER_SNAPSHOTS_S3_BUCKET_NAME", None),
+
+        # The last notified index is kept out of the logs bucket so Athena doesn't read it as a log
+        'last_notified_bucket': os.getenv("LAST_NOTIFIED_S3_BUCKET_NAME", None),
+        # A local file to hold the last notified index instead of S3
+        'last_notified_local_path': os.getenv("LAST_NOTIFIED_LOCAL_PATH", None),
+
+        # A local file to save the Athena query cache to
+        'query_cache_path': os.getenv("QUERY_CACHE_PATH", None),
 
-        # File names for database query results
-        'pollution_output_name': os.getenv("POLLUTION_OUTPUT_NAME", None),
-        'subscribers_output_name': os.getenv("SUBSCRIBERS_OUTPUT_NAME", None),
+        # A local file to write the metrics to after each cycle and a port to serve them on for Prometheus
+        'metrics_json_path': os.getenv("METRICS_JSON_PATH", None),
+        'metrics_port': int(os.getenv("METRICS_PORT")) if os.getenv("METRICS_PORT") else None,
 
         # Database name
         'database': os.getenv("POLLUTION_DATABASE_NAME", None),
@@ -46,130 +65,375 @@ def generate_config() -> dict:
 
 
 def create_clients(global_config: dict) -> dict:
-    # Create the AWS and Twilio clients
+    # The connection settings shared by the AWS clients
+    aws_settings = {
+        'region': global_config["AWS_REGION"],
+        'connect_timeout': global_config['aws_connect_timeout'],
+        'read_timeout': global_config['aws_read_timeout'],
+        'max_attempts': global_config['aws_max_attempts'],
+        'retry_mode': global_config['aws_retry_mode']
+    }
+
+    # Create the AWS and Twilio clients, the Athena and query results clients share a session
     global_config['s3_athena'] = utilities.create_aws_client(
         client_type="s3",
         public_key=global_config["AWS_SERVER_PUBLIC_KEY_ATHENA"],
         secret_key=global_config["AWS_SERVER_SECRET_KEY_ATHENA"],
-        region=global_config["AWS_REGION"])
+        **aws_settings)
 
     global_config['athena'] = utilities.create_aws_client(
         client_type="athena",
         public_key=global_config["AWS_SERVER_PUBLIC_KEY_ATHENA"],
         secret_key=global_config["AWS_SERVER_SECRET_KEY_ATHENA"],
-        region=global_config["AWS_REGION"])
+        **aws_settings)
 
     global_config['s3_logs'] = utilities.create_aws_client(
         client_type="s3",
         public_key=global_config["AWS_SERVER_PUBLIC_KEY_LOGS"],
         secret_key=global_config["AWS_SERVER_SECRET_KEY_LOGS"],
-        region=global_config["AWS_REGION"])
-
-    global_config['twilio'] = Client(
-        global_config['TWILIO_ACCOUNT_SID'],
-        global_config['TWILIO_AUTH_TOKEN'])
+        max_pool_connections=global_config['log_workers'],
+        **aws_settings)
+
+    # Keep a connection open to Twilio for each worker sending messages
+    global_config['twilio'] = clients.create_twilio_client(
+        account_sid=global_config['TWILIO_ACCOUNT_SID'],
+        auth_token=global_config['TWILIO_AUTH_TOKEN'],
+        pool_connections=global_config['max_workers'],
+        timeout=global_config['twilio_timeout'])
+
+    # Shared by every worker sending through the Twilio account
+    global_config['twilio_throttle'] = throttle.Throttle(
+        bucket=throttle.TokenBucket(
+            rate=global_config['messages_per_second'],
+            capacity=global_config['messages_burst']),
+        max_retries=global_config['max_send_retries'])
+
+    # Reuses the results of recent identical Athena queries, saved to a local file if provided to survive restarts
+    global_config['query_cache'] = feathers.QueryCache(
+        ttl=global_config['query_cache_ttl'],
+        max_entries=global_config['query_cache_size'],
+        path=global_config['query_cache_path'])
 
     return global_config
 
 
-def send_notifications(global_config: dict, retry_time: int = 60, notification_interval: int = 3600) -> None:
-
-    current_time = (datetime.now()-timedelta(days=1)).strftime("%Y-%m-%d")
-
-    output_bucket, output_file_path = feathers.generate_data_view(
-        client=global_config['athena'],
-        results_bucket=global_config['pollution_bucket'],
-        database_name=global_config['database'],
-        sql_query=f"""
-        SELECT * FROM (
-          SELECT 
-          time, 
-          dt, 
-          avg("air_quality_index (aqi)") as "average", 
-          count("air_quality_index (aqi)") as "count" 
-          FROM airpollution 
-          WHERE dt>='{current_time}' 
-          GROUP BY time, dt 
-          ORDER BY time DESC) 
-        LIMIT 1;
-        """,
-        retry_time=retry_time)
-
-    feathers.fetch_data_view(
-        s3=global_config['s3_athena'],
-        bucket=output_bucket,
-        file_path=output_file_path,
-        output_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), global_config['pollution_output_name']))
-
-    output_bucket, output_file_path = feathers.generate_data_view(
-        client=global_config['athena'],
-        results_bucket=global_config['subscribers_bucket'],
-        database_name=global_config['database'],
-        sql_query="""
-        SELECT max(date_created) as last_message, phone, a.topic from 
-        (
-          SELECT lower(to_hex(md5(to_utf8(phone)))) as phone_hash, phone, subscribers.topic 
-          FROM subscribers
-        ) AS a 
-
-        LEFT JOIN notificationlogs 
-
-        ON a.phone_hash = notificationlogs.to 
-
-        GROUP BY a.phone_hash, a.phone, a.topic
-        """,
-        retry_time=retry_time)
-
-    feathers.fetch_data_view(
-        s3=global_config['s3_athena'],
-        bucket=output_bucket,
-        file_path=output_file_path,
-        output_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), global_config['subscribers_output_name']))
-
-    # Import the latest pollution data with a 60 second retry time, this is populated by the feathers application
-    air_pollution_data = quiet.import_data(
-        file_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), global_config['pollution_output_name']),
-        retry_time=retry_time)
-
-    # Import the latest subscriber data with a 60 second rety time, also populated by the feathers application
-    subscriber_data = quiet.import_data(
-        file_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), global_config['subscribers_output_name']),
-        retry_time=retry_time)
-
-    utilities.delete_files(
-        [
-            os.path.join(os.path.dirname(os.path.abspath(__file__)), global_config['pollution_output_name']),
-            os.path.join(os.path.dirname(os.path.abspath(__file__)), global_config['subscribers_output_name'])
-        ]
-    )
-
-    # Check which users are eligible for a notification based on past activity
-    subscriber_data_eligible = quiet.check_eligibility(
-        subscriber_df_with_last_message=subscriber_data,
+def get_last_notified_location(global_config: dict) -> dict:
+    # A local file stands in for the index in S3 if a path is provided, e.g. for testing
+    if global_config['last_notified_local_path'] is not None:
+        return {'local_path': global_config['last_notified_local_path']}
+
+    return {
+        's3': global_config['s3_logs'],
+        'bucket_name': global_config['last_notified_bucket'],
+        'key': global_config['last_notified_key']
+    }
+
+
+def get_subscribers_query(global_config: dict, since: str, snapshot: str = None, topics: list = None,
+                          eligibility: dict = None) -> str:
+    # Read the subscriber snapshot plus the changes since it if there is one, and only the topics given if any
+    subscribers = queries.current_subscribers(
+        subscribers_table=global_config['subscribers_table'],
+        topics=topics,
+        snapshot=snapshot,
+        snapshots_table=global_config['subscriber_snapshots_table'],
+        tombstones_table=global_config['subscriber_tombstones_table'])
+
+    # With the last notified index the subscribers no longer need joining against the notification logs
+    if global_config['use_last_notified_index']:
+        return queries.subscribers_only_query(subscribers=subscribers, eligibility=eligibility)
+
+    # The Parquet logs are partitioned by date so only the partitions which affect eligibility need to be read
+    if global_config['notification_log_format'] == 'parquet':
+        return queries.subscribers_query(
+            logs_table=global_config['parquet_logs_table'],
+            logs_since=since,
+            subscribers=subscribers,
+            eligibility=eligibility)
+
+    return queries.subscribers_query(
+        logs_table=global_config['logs_table'], subscribers=subscribers, eligibility=eligibility)
+
+
+def get_eligibility_predicates(global_config: dict, air_pollution_data: pd.DataFrame, current_time: datetime) -> dict:
+    # Subscribers are sent a message when the level is at or above their topic, within the window, once a day
+    current_level, level_category = quiet.process_air_pollution_data(air_pollution_data)
+
+    return quiet.get_eligibility_predicates(
+        current_time=current_time,
         start_hour=global_config['start_hour'],
-        end_hour=global_config['end_hour'])
+        end_hour=global_config['end_hour'],
+        levels=global_config['levels'],
+        level_category=level_category)
+
+
+def run_and_read_queries(global_config: dict, query_requests: list, read_requests: list, retry_time: int) -> tuple:
+    # Run the queries at once and read their results at once
+    if global_config['concurrent_queries']:
+        query_results = feathers.run_queries(
+            client=global_config['athena'],
+            database_name=global_config['database'],
+            query_requests=query_requests,
+            retry_time=retry_time,
+            timeout=global_config['query_timeout'],
+            cache=global_config['query_cache'],
+            result_reuse_minutes=global_config['athena_result_reuse_minutes'])
+
+        with ThreadPoolExecutor(max_workers=len(query_requests)) as executor:
+            data = list(executor.map(
+                lambda query_result, read_request: feathers.read_data_view(
+                    s3=global_config['s3_athena'],
+                    bucket=query_result['bucket'],
+                    file_path=query_result['file_path'],
+                    **read_request),
+                query_results,
+                read_requests))
+
+    # Otherwise run each query and read its results in turn
+    else:
+        query_results = []
+        data = []
+        for query_request, read_request in zip(query_requests, read_requests):
+            query_result = feathers.run_query(
+                client=global_config['athena'],
+                database_name=global_config['database'],
+                retry_time=retry_time,
+                timeout=global_config['query_timeout'],
+                cache=global_config['query_cache'],
+                result_reuse_minutes=global_config['athena_result_reuse_minutes'],
+                **query_request)
+
+            # Read the data straight from the query results
+            data.append(feathers.read_data_view(
+                s3=global_config['s3_athena'],
+                bucket=query_result['bucket'],
+                file_path=query_result['file_path'],
+                **read_request))
+            query_results.append(query_result)
+
+    return query_results, data
+
+
+def get_window_skip_reason(global_config: dict, current_time: datetime) -> str:
+    # Nobody is sent a message outside the notification window, the same check as quiet.check_eligibility
+    hour = int(current_time.strftime('%H'))
+
+    if hour < global_config['start_hour'] or hour > global_config['end_hour']:
+        return 'outside_window'
+
+    return None
+
+
+def get_level_skip_reason(global_config: dict, air_pollution_data: pd.DataFrame, current_time: datetime) -> str:
+    # Subscribers are sent at most one message a day, so if the previous cycle today messaged everyone at the same
+    # level this cycle could only reach those who subscribed since. The previous cycle is only held in memory, after
+    # a restart the first cycle runs in full.
+    current_level, level_category = quiet.process_air_pollution_data(air_pollution_data)
+    previous_cycle = global_config.get('previous_cycle')
+
+    if (previous_cycle is not None and previous_cycle['day'] == current_time.strftime('%Y-%m-%d')
+            and level_category == previous_cycle['level_category']):
+        return 'level_unchanged'
+
+    return None
+
+
+def fetch_cycle_data(global_config: dict, since: str, retry_time: int, current_time: datetime,
+                     gate_function=None) -> dict:
+    # Find the latest subscriber snapshot, until the first compaction there isn't one
+    if global_config['use_subscriber_snapshots']:
+        snapshot = snapshots.get_current_snapshot(
+            s3=global_config['s3_athena'],
+            bucket_name=global_config['subscriber_snapshots_bucket'])
+    else:
+        snapshot = None
+
+    pollution_request = {
+        'results_bucket': global_config['pollution_bucket'],
+        'sql_query': queries.pollution_query(since=since),
+        # The latest reading changes at most hourly so the results can be reused within the hour
+        'cache_params': {'hour': current_time.strftime('%Y-%m-%d %H')}
+    }
+
+    # The subscriber data is read in batches if a chunk size is configured
+    subscribers_read_request = dict(
+        quiet.get_subscriber_read_options(
+            levels=global_config['levels'],
+            include_last_message=not global_config['use_last_notified_index']),
+        chunksize=global_config['subscriber_chunk_size'])
+
+    # Only query the subscribers who will be sent a message at the current level, and if the eligibility check is
+    # pushed into the query only those not yet messaged today within the window. This waits on the pollution query,
+    # but with the topic partitioned layout the subscribers of the other topics are never read and only the
+    # subscribers who can be sent a message are downloaded. The gate can skip the subscriber query altogether once
+    # the pollution level is known.
+    if (global_config['query_subscribers_by_topic'] or global_config['filter_eligibility_in_query']
+            or gate_function is not None):
+        pollution_results, pollution_data = run_and_read_queries(
+            global_config, [pollution_request], [{}], retry_time)
+
+        skip_reason = gate_function(pollution_data[0]) if gate_function is not None else None
+        if skip_reason is not None:
+            return {
+                'air_pollution_data': pollution_data[0],
+                'pollution_query_result': pollution_results[0],
+                'skipped': skip_reason
+            }
+
+        predicates = get_eligibility_predicates(global_config, pollution_data[0], current_time)
+
+        subscribers_request = {
+            'results_bucket': global_config['subscribers_bucket'],
+            'sql_query': get_subscribers_query(
+                global_config, since, snapshot,
+                topics=predicates['topics'],
+                eligibility=predicates if global_config['filter_eligibility_in_query'] else None)
+        }
+        subscribers_results, subscriber_data = run_and_read_queries(
+            global_config, [subscribers_request], [subscribers_read_request], retry_time)
+
+        query_results = pollution_results + subscribers_results
+        data = pollution_data + subscriber_data
+
+    # Otherwise the pollution and subscriber queries are independent of each other
+    else:
+        subscribers_request = {
+            'results_bucket': global_config['subscribers_bucket'],
+            'sql_query': get_subscribers_query(global_config, since, snapshot)
+        }
+        query_results, data = run_and_read_queries(
+            global_config, [pollution_request, subscribers_request], [{}, subscribers_read_request], retry_time)
+
+    return {
+        'air_pollution_data': data[0],
+        'subscriber_data': data[1],
+        'pollution_query_result': query_results[0],
+        'subscribers_query_result': query_results[1]
+    }
+
+
+def send_notifications(global_config: dict, retry_time: int = 10, get_current_time_function=datetime.now) -> dict:
+
+    timer = scheduler.StageTimer()
+
+    now = get_current_time_function()
+    current_time = (now-timedelta(days=1)).strftime("%Y-%m-%d")
+
+    # Check the cheap gates first so nothing is queried when no message could be sent, the level is only known once
+    # the pollution query has run so that gate is checked before the subscriber query
+    skip_reason = get_window_skip_reason(global_config, now)
+
+    if skip_reason is None:
+        if global_config['skip_unchanged_level']:
+            gate_function = lambda air_pollution_data: get_level_skip_reason(global_config, air_pollution_data, now)
+        else:
+            gate_function = None
+
+        with timer.stage('query'):
+            cycle_data = fetch_cycle_data(
+                global_config, since=current_time, retry_time=retry_time, current_time=now,
+                gate_function=gate_function)
+        skip_reason = cycle_data.get('skipped')
+
+    if skip_reason is not None:
+        logging.debug(f"Skipping the cycle, {skip_reason}")
+        metrics.registry.increment('silence_cycles_skipped_total', labels={'reason': skip_reason})
+        record_cycle_metrics(global_config, timer.as_dict())
+        return {'messages': 0, 'skipped': skip_reason, 'stage_timings': timer.as_dict()}
+
+    # Load when each subscriber was last messaged if the index is used instead of the notification logs
+    with timer.stage('load_last_notified'):
+        if global_config['use_last_notified_index']:
+            last_notified_location = get_last_notified_location(global_config)
+            last_notified_index = last_notified.load_last_notified(**last_notified_location)
+        else:
+            last_notified_index = None
+
+    air_pollution_data = cycle_data['air_pollution_data']
+    subscriber_data = cycle_data['subscriber_data']
+
+    # Check which users are eligible for a notification based on past activity, a batch at a time so that only the
+    # eligible subscribers are held in memory at once. With a chunk size the results are read from S3 as the
+    # batches are checked so this stage includes reading them.
+    with timer.stage('eligibility'):
+        if global_config['subscriber_chunk_size'] is None:
+            subscriber_data = [subscriber_data]
+
+        subscriber_data_eligible = [
+            quiet.check_eligibility(
+                subscriber_df_with_last_message=subscriber_chunk,
+                start_hour=global_config['start_hour'],
+                end_hour=global_config['end_hour'],
+                get_current_time_function=get_current_time_function,
+                last_notified=last_notified_index)
+            for subscriber_chunk in subscriber_data]
+
+        subscriber_data_eligible = pd.concat(subscriber_data_eligible) if subscriber_data_eligible else pd.DataFrame(
+            columns=['phone', 'topic'])
 
     # Get the current pollution level & alert category
     current_level, level_category = quiet.process_air_pollution_data(air_pollution_data)
 
     # Send notifications to the relevant subscribers
-    messages = quiet.send_notifications(
-        topic=global_config['levels'][level_category],
-        level=current_level,
-        subscriber_df=subscriber_data_eligible,
-        client=global_config['twilio'],
-        messages=global_config['messages'],
-        levels=global_config['levels'])
+    with timer.stage('send'):
+        messages = quiet.send_notifications(
+            topic=global_config['levels'][level_category],
+            level=current_level,
+            subscriber_df=subscriber_data_eligible,
+            client=global_config['twilio'],
+            messages=global_config['messages'],
+            levels=global_config['levels'],
+            max_workers=global_config['max_workers'],
+            throttle=global_config['twilio_throttle'])
+
+    # Remember the level of this cycle for the level gate, unless some messages failed and should be retried
+    alerted_subscribers = subscriber_data_eligible['topic'].isin(global_config['levels'][:level_category + 1]).sum()
+    if len(messages) == alerted_subscribers:
+        global_config['previous_cycle'] = {'day': now.strftime('%Y-%m-%d'), 'level_category': level_category}
+    else:
+        global_config.pop('previous_cycle', None)
 
     # Save the messages to logs
-    message_ids = quiet.log_notifications_sent(
-        s3=global_config['s3_logs'],
-        bucket_name=global_config['logs_bucket'],
-        message_logs=messages)
+    with timer.stage('log'):
+        message_ids = quiet.log_notifications_sent(
+            s3=global_config['s3_logs'],
+            bucket_name=global_config['parquet_logs_bucket'] if global_config['notification_log_format'] == 'parquet'
+            else global_config['logs_bucket'],
+            message_logs=messages,
+            max_workers=global_config['log_workers'],
+            log_format=global_config['notification_log_format'],
+            compress=global_config['compress_notification_logs'])
+
+    # Record who was messaged this cycle, dropping anyone who hasn't been messaged recently to keep the index small
+    with timer.stage('save_last_notified'):
+        if last_notified_index is not None:
+            last_notified_index = last_notified.update_last_notified(last_notified_index, messages)
+            last_notified_index = last_notified.prune_last_notified(
+                last_notified_index, retention_days=global_config['last_notified_retention_days'])
+            last_notified.save_last_notified(last_notified_index, **last_notified_location)
 
     # Print the ids of the messages sent
     logging.debug('Messages succesfully sent')
     logging.debug(str(message_ids))
+    logging.debug(f"Pollution query statistics: {cycle_data['pollution_query_result']['statistics']}")
+    logging.debug(f"Subscribers query statistics: {cycle_data['subscribers_query_result']['statistics']}")
+    logging.debug(f"Twilio traffic so far: {global_config['twilio_throttle'].counters.as_dict()}")
+
+    record_cycle_metrics(global_config, timer.as_dict())
+
+    return {'messages': len(message_ids), 'stage_timings': timer.as_dict()}
+
+
+def record_cycle_metrics(global_config: dict, stage_timings: dict) -> None:
+    # Record how long each stage took and when the cycle finished
+    for stage, duration in stage_timings.items():
+        metrics.registry.observe('silence_cycle_stage_seconds', duration, labels={'stage': stage})
+    metrics.registry.set_gauge('silence_last_cycle_timestamp_seconds', time.time())
+
+    # The Twilio traffic is counted by the throttle across every cycle
+    for name, count in global_config['twilio_throttle'].counters.as_dict().items():
+        metrics.registry.set_gauge('silence_twilio_requests', count, labels={'outcome': name})
 
-    # Wait the notification interval
-    time.sleep(notification_interval)
+    # Save the metrics to a local file if a path is provided
+    if global_config['metrics_json_path'] is not None:
+        metrics.registry.write_json(global_config['metrics_json_path'])
@@ -0,0 +1,158 @@
+def pollution_query(since: str) -> str:
+    """
+    Builds the query for the latest hourly average air pollution level
+
+    :param str since: The date (YYYY-MM-DD) to look for readings from, limits the partitions scanned
+
+    :return: str sql_query: The query to execute
+    """
+
+    return f"""
+        SELECT * FROM (
+          SELECT
+          time,
+          dt,
+          avg("air_quality_index (aqi)") as "average",
+          count("air_quality_index (aqi)") as "count"
+          FROM airpollution
+          WHERE dt>='{since}'
+          GROUP BY time, dt
+          ORDER BY time DESC)
+        LIMIT 1;
+        """
+
+
+def current_subscribers(subscribers_table: str = 'subscribers', topics: list = None, snapshot: str = None,
+                        snapshots_table: str = 'subscriber_snapshots',
+                        tombstones_table: str = 'subscriber_tombstones') -> str:
+    """
+    Builds the subquery for the current subscribers and the hashes of their phone numbers
+
+    :param str subscribers_table: The table holding the per subscriber objects, 'subscribers' or the topic partitioned
+    'subscribers_by_topic'
+    :param list[str] topics: The topics to read the subscribers of, with the topic partitioned table only those
+    partitions are read. If None every subscriber is read.
+    :param str snapshot: The id of the subscriber snapshot to read, see snapshots.py. The subscribers saved since the
+    snapshot replace those in it and the tombstones remove those who have unsubscribed. If None only the per
+    subscriber objects are read.
+    :param str snapshots_table: The table holding the subscriber snapshots
+    :param str tombstones_table: The table holding the tombstones of the subscribers who have unsubscribed
+
+    :return: str sql_query: The subquery, with the columns phone_hash, phone and topic
+    """
+
+    if topics is not None:
+        topic_list = ', '.join(f"'{topic}'" for topic in topics)
+        delta_filter = f"WHERE subscribers.topic IN ({topic_list})"
+        snapshot_filter = f"AND snapshots.topic IN ({topic_list})"
+    else:
+        delta_filter = ""
+        snapshot_filter = ""
+
+    delta = f"""
+          SELECT lower(to_hex(md5(to_utf8(phone)))) as phone_hash, phone, subscribers.topic
+          FROM {subscribers_table} AS subscribers
+          {delta_filter}
+        """
+
+    if snapshot is None:
+        return f"({delta})"
+
+    # Anyone saved since the snapshot replaces their row in it whatever their topic now is, so every topic is read
+    # for them. There are only the changes since the last compaction to read.
+    changed = f"""
+          SELECT lower(to_hex(md5(to_utf8(phone)))) as phone_hash FROM {subscribers_table}
+        """
+
+    return f"""(
+          SELECT phone_hash, phone, topic FROM ({delta}) AS delta
+
+          UNION ALL
+
+          SELECT snapshots.phone_hash, snapshots.phone, snapshots.topic
+          FROM {snapshots_table} AS snapshots
+          LEFT JOIN ({changed}) AS changed ON snapshots.phone_hash = changed.phone_hash
+          LEFT JOIN {tombstones_table} AS tombstones ON snapshots.phone_hash = tombstones.phone_hash
+          WHERE snapshots.snapshot_id='{snapshot}' AND changed.phone_hash IS NULL AND tombstones.phone_hash IS NULL
+          {snapshot_filter}
+        )"""
+
+
+def eligibility_filter(eligibility: dict = None) -> str:
+    """
+    Builds the HAVING clause which leaves only the subscribers who can be sent a message, the same check as
+    quiet.check_eligibility
+
+    :param dict eligibility: The predicates from quiet.get_eligibility_predicates, if None there is no clause
+
+    :return: str sql_clause: The clause to add after the GROUP BY
+    """
+
+    if eligibility is None:
+        return ""
+
+    # The logs hold the time the message was created in UTC either as a string or a timestamp, both start with the day
+    messaged_day = "substr(CAST(max(date_created) AS varchar), 1, 10)"
+
+    return f"""HAVING (max(date_created) IS NULL OR {messaged_day} <> '{eligibility['day']}')
+        AND {str(eligibility['in_window']).lower()}"""
+
+
+def subscribers_query(logs_table: str = 'notificationlogs', logs_since: str = None, subscribers: str = None,
+                      eligibility: dict = None) -> str:
+    """
+    Builds the query for the subscribers along with the time they were last sent a message
+
+    :param str logs_table: The table holding the notification logs
+    :param str logs_since: The date (YYYY-MM-DD) to look for messages from. The eligibility check only needs to know
+    about messages sent today so with a table partitioned by dt this avoids scanning the whole history. If None the
+    whole table is scanned, which is required for the unpartitioned JSON logs.
+    :param str subscribers: The subquery for the subscribers from current_subscribers, if None every subscriber in
+    the subscribers table is read
+    :param dict eligibility: The predicates from quiet.get_eligibility_predicates, if provided only the subscribers who
+    haven't been messaged on the day are returned and none outside the notification window. The topics are filtered by
+    current_subscribers.
+
+    :return: str sql_query: The query to execute
+    """
+
+    # Only read the partitions of the logs which are needed
+    if logs_since is not None:
+        logs = f"""(
+          SELECT "to", date_created FROM {logs_table} WHERE dt>='{logs_since}'
+        )"""
+    else:
+        logs = logs_table
+
+    return f"""
+        SELECT max(date_created) as last_message, phone, a.topic from
+        {subscribers or current_subscribers()} AS a
+
+        LEFT JOIN {logs} AS notificationlogs
+
+        ON a.phone_hash = notificationlogs.to
+
+        GROUP BY a.phone_hash, a.phone, a.topic
+        {eligibility_filter(eligibility)}
+        """
+
+
+def subscribers_only_query(subscribers: str = None, eligibility: dict = None) -> str:
+    """
+    Builds the query for the subscribers alone, used when the time each subscriber was last messaged comes from the
+    last notified index rather than the notification logs
+
+    :param str subscribers: The subquery for the subscribers from current_subscribers, if None every subscriber in
+    the subscribers table is read
+    :param dict eligibility: The predicates from quiet.get_eligibility_predicates, if provided no subscribers are
+    returned outside the notification window. The day is checked against the last notified index afterwards.
+
+    :return: str sql_query: The query to execute
+    """
+
+    window_filter = f"WHERE {str(eligibility['in_window']).lower()}" if eligibility is not None else ""
+
+    return f"""
+        SELECT phone, topic FROM {subscribers or current_subscribers()} AS subscribers
+        {window_filter}
+        """
@@ -1,40 +1,46 @@
-import time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import hashlib
+import gzip
+import io
+import pyarrow as pa
+import pyarrow.parquet as pq
 from datetime import datetime
 import json
 import logging
 import math
-import logging
+import time
+import metrics
 
-def import_data(file_path: str, retry_time: int):
+def get_subscriber_read_options(levels, include_last_message=True):
     """
-    This function imports data from a CSV file.
+    This function gives the options for reading the subscriber data into compact types. Only the needed columns are
+    read, the topic is a categorical holding each level once rather than a string per subscriber and the last
+    message time is a datetime64 rather than a string.
 
-    :param str file_path: The path to the data csv file
-    :param int retry_time: The time to wait in seconds before re-trying if
-    the file import fails
+    The phone number stays a string as subscribers may have entered it in more than one format, so it can't safely
+    be held as an integer.
 
-    :return pd.DataFrame data: The dataframe containing the data
+    :param list[str] levels: The available levels, used as the categories of the topic
+    :param bool include_last_message: Whether the data includes the last message time
+
+    :return dict read_options: The usecols, dtype and parse_dates options for pd.read_csv
     """
 
-    # Keep running until the data is loaded
-    while True:
-        # Try and read the data from a CSV
-        try:
-            data = pd.read_csv(file_path)
-            # If succesful break the loop
-            break
-        # If not succesful, assume file does not exist and wait out the retry_period
-        except:
-            print(
-                'File does not exist yet, waiting {} secs before retrying'.format(
-                    retry_time
-                ))
-            time.sleep(retry_time)
+    read_options = {
+        'usecols': ['phone', 'topic'],
+        'dtype': {
+            'phone': str,
+            'topic': pd.api.types.CategoricalDtype(categories=levels)
+        },
+        'parse_dates': []
+    }
+
+    if include_last_message:
+        read_options['usecols'].append('last_message')
+        read_options['parse_dates'].append('last_message')
 
-    # Return the air pollution data
-    return data
+    return read_options
 
 
 def process_air_pollution_data(air_pollution_data):
@@ -59,7 +65,8 @@ def process_air_pollution_data(air_pollution_data):
     return current_level, level_category
 
 
-def check_eligibility(subscriber_df_with_last_message, start_hour, end_hour, get_current_time_function=datetime.now):
+def check_eligibility(subscriber_df_with_last_message, start_hour, end_hour, get_current_time_function=datetime.now,
+                      last_notified=None):
     """
     This function checks when a user was last messaged to ensure that they are eligible to receive a notifictation.
     This prevents sending messages to frequently
@@ -69,21 +76,15 @@ def check_eligibility(subscriber_df_with_last_message, start_hour, end_hour, get
     :param int start_hour: The hour to start sending notifications from e.g. 8 would be 8am in the morning
     :param int end_hour: The hour to stop sending notifications over e.g. 20 would be 10pm at night
     :param func get_current_time_function: The function to use to get the current time
+    :param dict last_notified: The time each subscriber was last messaged keyed by the hash of their phone number.
+    If provided it is used for the last message time instead of the last_message column.
 
     :return pd.DataFrame subscriber_data_eligible: The subscriber information
     """
 
     logging.debug(f"There are {len(subscriber_df_with_last_message)} potentially eligible subscribers")
 
-    # Convert the last message time to a datetime
-    subscriber_df_with_last_message['last_message'] = pd.to_datetime(
-        subscriber_df_with_last_message['last_message'], yearfirst=True, utc=True)
-
-    # Extract the day (that is the year, month, day combination) of the last message
-    subscriber_df_with_last_message['day'] = subscriber_df_with_last_message['last_message'].apply(
-        lambda x: x.strftime('%Y-%m-%d'))
-
-    # Get the current time including the current day as above and the current hour
+    # Get the current time including the current day and the current hour
     current_time = get_current_time_function()
     day = current_time.strftime('%Y-%m-%d')
     hour = int(current_time.strftime('%H'))
@@ -93,22 +94,83 @@ def check_eligibility(subscriber_df_with_last_message, start_hour, end_hour, get
         logging.debug(f"Outside of notification window, no eligible subscribers")
         return pd.DataFrame(columns=['phone', 'topic'])
 
-    # If a message has already been sent today don't send another
-    ineligible_subscribers = subscriber_df_with_last_message.index[
-        subscriber_df_with_last_message['day'] == day].tolist()
+    # Look up the last message time for each subscriber from the index, or take it from the query results
+    if last_notified is not None:
+        last_message = pd.Series(
+            [last_notified.get(hash_phone_number(str(phone))) for phone in subscriber_df_with_last_message['phone']],
+            index=subscriber_df_with_last_message.index)
+    else:
+        last_message = subscriber_df_with_last_message['last_message']
+
+    # Convert the last message time to a datetime
+    last_message = pd.to_datetime(last_message, yearfirst=True, utc=True)
+
+    # If a message has already been sent today don't send another, subscribers never messaged have no day (NaT) and
+    # so are always eligible
+    messaged_today = (last_message.dt.normalize() == pd.Timestamp(day, tz='UTC')).values
 
-    logging.debug(f"There are {len(ineligible_subscribers)} ineligible subscribers to remove")
+    logging.debug(f"There are {messaged_today.sum()} ineligible subscribers to remove")
 
-    # Drop the ineligible subscribers
-    subscriber_df_with_last_message.drop(inplace=True, index=ineligible_subscribers)
-    subscriber_data_eligible = subscriber_df_with_last_message.loc[: ,['phone', 'topic']]
+    # Select the eligible subscribers, leaving the caller's dataframe untouched
+    subscriber_data_eligible = subscriber_df_with_last_message.loc[~messaged_today, ['phone', 'topic']]
 
     logging.debug(f"There are {len(subscriber_data_eligible)} eligible subscribers remaining")
 
+    metrics.registry.increment('silence_subscribers_checked_total', len(subscriber_df_with_last_message))
+    metrics.registry.increment('silence_subscribers_eligible_total', len(subscriber_data_eligible))
+
     return subscriber_data_eligible
 
 
-def send_notifications(topic, level, subscriber_df, client, messages, levels):
+def get_eligibility_predicates(current_time, start_hour, end_hour, levels, level_category):
+    """
+    This function works out which subscribers can be sent a message this cycle, in a form which can be pushed into
+    the subscriber query by queries.current_subscribers and queries.subscribers_query or applied locally by
+    filter_eligible_subscribers with the same result as check_eligibility followed by the topic filter in
+    send_notifications
+
+    :param datetime current_time: The time of the cycle
+    :param int start_hour: The hour to start sending notifications from
+    :param int end_hour: The hour to stop sending notifications over
+    :param list[str] levels: The available levels
+    :param int level_category: The current level as an index into the levels
+
+    :return dict predicates: The day subscribers already messaged are skipped for, whether the cycle is in the
+    notification window and the topics at or below the current level
+    """
+
+    hour = int(current_time.strftime('%H'))
+
+    return {
+        'day': current_time.strftime('%Y-%m-%d'),
+        'in_window': start_hour <= hour <= end_hour,
+        'topics': list(levels[:level_category + 1])
+    }
+
+
+def filter_eligible_subscribers(subscriber_df_with_last_message, predicates):
+    """
+    This function applies the eligibility predicates locally, it gives the same subscribers as the subscriber query
+    with the predicates pushed into it
+
+    :param pd.DataFrame subscriber_df_with_last_message: The subscriber information including when they last
+    received a message
+    :param dict predicates: The predicates from get_eligibility_predicates
+
+    :return pd.DataFrame subscriber_data_eligible: The phone and topic of each subscriber who can be sent a message
+    """
+
+    if not predicates['in_window']:
+        return pd.DataFrame(columns=['phone', 'topic'])
+
+    last_message = pd.to_datetime(subscriber_df_with_last_message['last_message'], yearfirst=True, utc=True)
+    messaged_today = (last_message.dt.normalize() == pd.Timestamp(predicates['day'], tz='UTC')).values
+    alerted = subscriber_df_with_last_message['topic'].isin(predicates['topics']).values
+
+    return subscriber_df_with_last_message.loc[~messaged_today & alerted, ['phone', 'topic']]
+
+
+def send_notifications(topic, level, subscriber_df, client, messages, levels, max_workers=1, throttle=None):
     """
     This function sends a topic (alert level) and the current pollution level
     to the relevant subscribers.
@@ -119,6 +181,8 @@ def send_notifications(topic, level, subscriber_df, client, messages, levels):
     :param Twilio.Client client: The twilio client to use
     :param dict messages: The text of the messages to send
     :param list[str] levels: The available levels
+    :param int max_workers: The maximum number of messages to send concurrently
+    :param throttle.Throttle throttle: The throttle for the Twilio account, if any
 
     :return list[dict] message_logs: The details of each message which was sent
     """
@@ -138,43 +202,122 @@ def send_notifications(topic, level, subscriber_df, client, messages, levels):
     # Get the current topic level as an integer for ordinal comparison
     current_topic_level = levels.index(topic)
     logging.debug(f"Current topic level is {current_topic_level}")
-    # Get the subscription topics for all subscribers as an integer also
-    subscriber_df['topic_level'] = subscriber_df['topic'].apply(lambda x: levels.index(x))
+    # Get the subscription topics for all subscribers as an integer also, topics which aren't a level are never sent
+    topic_levels = subscriber_df['topic'].map(
+        {level_name: index for index, level_name in enumerate(levels)}).astype(float)
     # Identify the relevant subscribers who have a notification level less than or equal to the current level
-    relevant_subscribers = subscriber_df[current_topic_level >= subscriber_df['topic_level']]
+    relevant_subscribers = subscriber_df.loc[(topic_levels <= current_topic_level).values]
     logging.debug(f"There are {len(relevant_subscribers)} relevant subscribers")
 
-    # For each subscriber send a notification
-    for subscriber_phone in relevant_subscribers['phone'].values:
-        # Send an SMS message
-        logging.debug("Creating message to send for subscriber")
-        # Create the details of the current message
-        current_message = {}
-        current_message['topic'] = topic
-        current_message['level'] = level
-        current_message['topic_level'] = current_topic_level
-
-        # Create the current message in Twilio and send it
-        message = client.messages.create(
-            from_='+442033225373',
-            body=message_body,
-            to=subscriber_phone)
-
-        # Update the details of the current message from the call to Twilio
-        current_message_extra = vars(message)['_properties']
-        current_message_extra['subresource_uris.media'] = current_message_extra['subresource_uris']['media']
-        current_message_extra['to'] = hash_phone_number(current_message_extra['to'].replace('+44', '0'))
-        current_message_extra['date_created'] = current_message_extra['date_created'].replace(tzinfo=None)
-        current_message_extra['date_updated'] = current_message_extra['date_updated'].replace(tzinfo=None)
-        del current_message_extra['subresource_uris']
-        current_message.update(current_message_extra)
+    # Send the notification to every relevant subscriber, results come back in the same order as the phone numbers
+    results = dispatch_messages(
+        client=client,
+        message_body=message_body,
+        phone_numbers=list(relevant_subscribers['phone'].values),
+        max_workers=max_workers,
+        throttle=throttle)
+
+    for result in results:
+        # A failed send should not stop the rest of the batch, log it and move on
+        if not result['success']:
+            logging.warning(f"Failed to send notification: {result['error']}")
+            continue
 
         # Append the message to the message logs
-        message_logs.append(current_message)
+        message_logs.append(create_message_log(
+            topic=topic,
+            level=level,
+            topic_level=current_topic_level,
+            message=result['message']))
+
+    logging.debug(f"{len(message_logs)} of {len(results)} notifications sent successfully")
 
     return message_logs
 
 
+def dispatch_messages(client, message_body, phone_numbers, max_workers=1, throttle=None):
+    """
+    This function sends the same message to each phone number using a bounded pool of worker threads.
+    A failure to send to one phone number does not stop the rest of the batch.
+
+    :param Twilio.Client client: The twilio client to use
+    :param str message_body: The text of the message to send
+    :param list[str] phone_numbers: The phone numbers to send the message to
+    :param int max_workers: The maximum number of messages to send concurrently
+    :param throttle.Throttle throttle: The throttle for the Twilio account, if any
+
+    :return list[dict] results: The outcome for each phone number in the same order as phone_numbers,
+    each holding whether the send succeeded and either the Twilio message or the error raised
+    """
+
+    def send(phone_number):
+        result = {'to': phone_number}
+        start = time.perf_counter()
+
+        # Create the message in Twilio and send it, capturing any failure instead of raising
+        try:
+            if throttle is not None:
+                # Respects the account's rate limit and retries if Twilio throttles the request
+                result['message'] = throttle.call(
+                    client.messages.create,
+                    from_='+442033225373',
+                    body=message_body,
+                    to=phone_number)
+            else:
+                result['message'] = client.messages.create(
+                    from_='+442033225373',
+                    body=message_body,
+                    to=phone_number)
+            result['success'] = True
+        except Exception as e:
+            result['error'] = e
+            result['success'] = False
+
+        metrics.registry.observe('silence_twilio_send_seconds', time.perf_counter() - start)
+        metrics.registry.increment(
+            'silence_messages_total', labels={'outcome': 'sent' if result['success'] else 'failed'})
+
+        return result
+
+    # With a single worker there is nothing to gain from a thread pool
+    if max_workers <= 1:
+        return [send(phone_number) for phone_number in phone_numbers]
+
+    # The executor's map keeps the results in the same order as the phone numbers
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(send, phone_numbers))
+
+
+def create_message_log(topic, level, topic_level, message):
+    """
+    This function creates the log of a message which has been sent
+
+    :param str topic: The alert level the message was sent for
+    :param str level: The air quality index pollution level the message was sent for
+    :param int topic_level: The alert level as an integer
+    :param twilio.rest.api.v2010.account.message.MessageInstance message: The message returned by Twilio
+
+    :return dict current_message: The details of the message
+    """
+
+    # Create the details of the current message
+    current_message = {}
+    current_message['topic'] = topic
+    current_message['level'] = level
+    current_message['topic_level'] = topic_level
+
+    # Update the details of the current message from the call to Twilio
+    current_message_extra = vars(message)['_properties']
+    current_message_extra['subresource_uris.media'] = current_message_extra['subresource_uris']['media']
+    current_message_extra['to'] = hash_phone_number(current_message_extra['to'].replace('+44', '0'))
+    current_message_extra['date_created'] = current_message_extra['date_created'].replace(tzinfo=None)
+    current_message_extra['date_updated'] = current_message_extra['date_updated'].replace(tzinfo=None)
+    del current_message_extra['subresource_uris']
+    current_message.update(current_message_extra)
+
+    return current_message
+
+
 def hash_phone_number(phone_number):
     """
     This function creates an md5 hash of a phone number
@@ -190,7 +333,8 @@ def hash_phone_number(phone_number):
     return phone_hash
 
 
-def log_notifications_sent(s3, bucket_name, message_logs):
+def log_notifications_sent(s3, bucket_name, message_logs, max_workers=1, log_format='message', compress=False,
+                           get_current_time_function=datetime.now):
     """
     This function logs messages that have been sent by saving the details
     of each message to a bucket in S3.
@@ -198,24 +342,197 @@ def log_notifications_sent(s3, bucket_name, message_logs):
     :param: boto3.resource s3: The boto3 S3 resource to use for interacting
     :param: str bucket_name: The bucket name in S3 to store the user information
     :param: list[dict] message_logs: The logs of the messages which have been created
+    :param: int max_workers: The maximum number of objects to write concurrently
+    :param: str log_format: Either 'message' to write each message to its own JSON object, 'json' to combine
+    them into a single newline delimited JSON object or 'parquet' to combine them into a single Parquet object
+    :param: bool compress: Whether to gzip the combined JSON object
+    :param: func get_current_time_function: The function to use to get the current time
 
     :return: list[str] message_ids: The sid of each message logged to S3
     """
-    message_ids = []
 
-    for message in message_logs:
+    write_status = write_notification_logs(
+        s3=s3,
+        bucket_name=bucket_name,
+        message_logs=message_logs,
+        max_workers=max_workers,
+        log_format=log_format,
+        compress=compress,
+        get_current_time_function=get_current_time_function)
+
+    if write_status['failed']:
+        logging.warning(f"Failed to write the notification logs {write_status['failed']}")
+
+    return write_status['message_ids']
 
-        serialised_message = json.dumps(message, default=str)
 
+def write_notification_logs(s3, bucket_name, message_logs, max_workers=1, log_format='message', compress=False,
+                            get_current_time_function=datetime.now):
+    """
+    This function writes the logs of the messages which have been sent to S3. Either each message is written to its
+    own object, in parallel, or all of the messages are combined into a single newline delimited JSON or Parquet
+    object partitioned by date.
+
+    :param: boto3.resource s3: The boto3 S3 resource to use for interacting
+    :param: str bucket_name: The bucket name in S3 to store the logs in
+    :param: list[dict] message_logs: The logs of the messages which have been created
+    :param: int max_workers: The maximum number of objects to write concurrently
+    :param: str log_format: Either 'message' to write each message to its own JSON object, 'json' to combine
+    them into a single newline delimited JSON object or 'parquet' to combine them into a single Parquet object
+    :param: bool compress: Whether to gzip the combined JSON object
+    :param: func get_current_time_function: The function to use to get the current time
+
+    :return: dict write_status: The sid of each message logged, the keys written and the keys which failed
+    to be written so that they can be retried
+    """
+
+    write_status = {'message_ids': [], 'written': [], 'failed': []}
+
+    if len(message_logs) == 0:
+        return write_status
+
+    # Each object to write is made up of a key, a body and the sids of the messages it contains
+    if log_format == 'json':
+        objects = [create_batch_log_object(message_logs, compress, get_current_time_function())]
+    elif log_format == 'parquet':
+        objects = [create_parquet_log_object(message_logs, get_current_time_function())]
+    elif log_format == 'message':
+        objects = [
+            ('message-{}.json'.format(message['sid']), json.dumps(message, default=str), [message['sid']])
+            for message in message_logs]
+    else:
+        raise ValueError(f"The log format {log_format} is not supported, please use one of message, json or parquet")
+
+    # The low level client is thread safe and shares its connection pool between the workers, unlike the resource
+    client = s3.meta.client
+
+    def put(s3_object):
+        key, body, _ = s3_object
         try:
-            s3.Object(bucket_name, 'message-{}.json'.format(
-                message['sid'])).put(Body=serialised_message)
+            with metrics.registry.time('silence_s3_log_write_seconds'):
+                client.put_object(Bucket=bucket_name, Key=key, Body=body)
+            return True
+        except Exception as e:
+            logging.debug(f"Failed to write {key}: {e}")
+            return False
+
+    if max_workers <= 1 or len(objects) == 1:
+        results = [put(s3_object) for s3_object in objects]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(put, objects))
+
+    for (key, _, message_ids), success in zip(objects, results):
+        if success:
+            write_status['written'].append(key)
+            write_status['message_ids'].extend(message_ids)
+        else:
+            write_status['failed'].append(key)
+
+    return write_status
+
+
+def create_batch_log_object(message_logs, compress, current_time):
+    """
+    This function combines the logs of many messages into a single newline delimited JSON object, which can be
+    queried by Athena in the same way as the per message objects
 
-            message_ids.append(message['sid'])
-        except:
-            pass
+    :param: list[dict] message_logs: The logs of the messages which have been created
+    :param: bool compress: Whether to gzip the object
+    :param: datetime current_time: The time of the run, used to partition and name the object
 
-    return message_ids
+    :return: str, bytes, list[str] key, body, message_ids: The key and body of the object and the sids it contains
+    """
 
+    body = '\n'.join(json.dumps(message, default=str) for message in message_logs).encode('utf-8')
+    key = 'dt={}/notifications-{}.json'.format(current_time.strftime('%Y-%m-%d'), current_time.strftime('%Y%m%dT%H%M%S'))
+
+    if compress:
+        body = gzip.compress(body)
+        key += '.gz'
+
+    return key, body, [message['sid'] for message in message_logs]
+
+
+# The columns of the Parquet notification logs, every file is written with this schema so that Athena can read them
+# as a single table whatever values happen to be missing from a particular batch
+NOTIFICATION_LOG_SCHEMA = pa.schema([
+    ('topic', pa.string()),
+    ('level', pa.float64()),
+    ('topic_level', pa.int64()),
+    ('account_sid', pa.string()),
+    ('api_version', pa.string()),
+    ('body', pa.string()),
+    ('date_created', pa.timestamp('ms')),
+    ('date_updated', pa.timestamp('ms')),
+    ('date_sent', pa.timestamp('ms')),
+    ('direction', pa.string()),
+    ('error_code', pa.string()),
+    ('error_message', pa.string()),
+    ('from_', pa.string()),
+    ('messaging_service_sid', pa.string()),
+    ('num_media', pa.string()),
+    ('num_segments', pa.string()),
+    ('price', pa.string()),
+    ('price_unit', pa.string()),
+    ('sid', pa.string()),
+    ('status', pa.string()),
+    ('to', pa.string()),
+    ('uri', pa.string()),
+    ('subresource_uris_media', pa.string())
+])
+
+
+def create_notification_log_table(message_logs):
+    """
+    This function converts the logs of messages into a table with the notification log schema
+
+    :param: list[dict] message_logs: The logs of the messages which have been created
+
+    :return: pyarrow.Table table: The message logs as a table
+    """
+
+    # The message logs name the media URI with a dot, which Athena can't address in a column name
+    data = pd.DataFrame(message_logs).rename(columns={'subresource_uris.media': 'subresource_uris_media'})
+    data = data.reindex(columns=NOTIFICATION_LOG_SCHEMA.names)
+
+    # Coerce each column to the type in the schema, the Twilio values arrive as a mix of types and None
+    for field in NOTIFICATION_LOG_SCHEMA:
+        if pa.types.is_timestamp(field.type):
+            data[field.name] = pd.to_datetime(data[field.name], utc=True).dt.tz_localize(None)
+        elif pa.types.is_string(field.type):
+            data[field.name] = data[field.name].apply(lambda x: None if pd.isnull(x) else str(x))
+
+    return pa.Table.from_pandas(data, schema=NOTIFICATION_LOG_SCHEMA, preserve_index=False)
+
+
+def create_parquet_log_object(message_logs, current_time):
+    """
+    This function combines the logs of many messages into a single Parquet object partitioned by date
+
+    :param: list[dict] message_logs: The logs of the messages which have been created
+    :param: datetime current_time: The time of the run, used to partition and name the object
+
+    :return: str, bytes, list[str] key, body, message_ids: The key and body of the object and the sids it contains
+    """
+
+    key = 'dt={}/notifications-{}.parquet'.format(
+        current_time.strftime('%Y-%m-%d'), current_time.strftime('%Y%m%dT%H%M%S'))
+
+    return key, write_parquet_bytes(create_notification_log_table(message_logs)), [
+        message['sid'] for message in message_logs]
+
+
+def write_parquet_bytes(table):
+    """
+    This function serialises a table to Parquet
+
+    :param: pyarrow.Table table: The table to serialise
+
+    :return: bytes body: The Parquet file
+    """
 
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression='snappy')
 
+    return buffer.getvalue()
@@ -1,4 +1,6 @@
 import main
+import scheduler
+import metrics
 import logging
 
 # Get the logger
@@ -8,5 +10,15 @@ logger.setLevel(logging.DEBUG)
 global_config = main.generate_config()
 global_config = main.create_clients(global_config)
 
-while True:
-    main.send_notifications(global_config)
+# Serve the metrics for Prometheus to scrape if a port is provided
+if global_config['metrics_port'] is not None:
+    metrics.registry.serve(global_config['metrics_port'])
+
+# Run a cycle a fixed time after the start of each interval, e.g. a few minutes after the new pollution data lands
+notification_scheduler = scheduler.Scheduler(
+    cycle_function=lambda scheduled_time: main.send_notifications(global_config),
+    interval=global_config['schedule_interval'],
+    offset=global_config['schedule_offset'],
+    overrun=global_config['schedule_overrun'])
+
+notification_scheduler.run()
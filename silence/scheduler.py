@@ -0,0 +1,149 @@
+import logging
+import time
+from contextlib import contextmanager
+
+
+def get_next_run_time(now: float, interval: float, offset: float = 0) -> float:
+    """
+    Gets the next time on the wall clock boundary to run at, e.g. five minutes past each hour
+
+    :param float now: The current time in seconds since the epoch
+    :param float interval: The number of seconds between runs, boundaries are multiples of this since the epoch so
+    an interval of 3600 is aligned to the hour in UTC
+    :param float offset: The number of seconds after each boundary to run at
+
+    :return: float next_run_time: The next time to run in seconds since the epoch, strictly after now
+    """
+
+    next_run_time = (now - offset) // interval * interval + offset
+
+    while next_run_time <= now:
+        next_run_time += interval
+
+    return next_run_time
+
+
+class StageTimer:
+    """
+    Records how long each stage of a cycle takes
+    """
+
+    def __init__(self, get_current_time_function=time.perf_counter) -> None:
+        """
+        :param func get_current_time_function: The function to use to get the current time in seconds
+        """
+        self.get_current_time_function = get_current_time_function
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Times the code run inside the with block
+
+        :param str name: The name of the stage
+        """
+        start = self.get_current_time_function()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + self.get_current_time_function() - start
+
+    def as_dict(self) -> dict:
+        """
+        :return: dict timings: The number of seconds each stage took in the order they were run
+        """
+        return dict(self.timings)
+
+
+class Scheduler:
+    """
+    Runs a cycle on wall clock boundaries rather than sleeping for a fixed time between cycles, so the start of
+    each cycle doesn't drift later by the time the previous one took. If a cycle overruns one or more boundaries
+    they are either skipped, waiting for the next boundary, or coalesced into a single cycle run straight away.
+    """
+
+    def __init__(self, cycle_function, interval: float = 3600, offset: float = 0, overrun: str = 'skip',
+                 get_current_time_function=time.time, sleep_function=time.sleep) -> None:
+        """
+        :param func cycle_function: The function to run each cycle, called with the time the cycle was scheduled
+        for. It may return a dict of details about the cycle which are logged.
+        :param float interval: The number of seconds between cycles
+        :param float offset: The number of seconds after each boundary to run at
+        :param str overrun: What to do with boundaries missed while a cycle overran, 'skip' or 'coalesce'
+        :param func get_current_time_function: The function to use to get the current time in seconds since the epoch
+        :param func sleep_function: The function to use to wait
+        """
+
+        if overrun not in ['skip', 'coalesce']:
+            raise ValueError(f"The overrun policy {overrun} is not supported, please use one of ['skip', 'coalesce']")
+
+        self.cycle_function = cycle_function
+        self.interval = interval
+        self.offset = offset
+        self.overrun = overrun
+        self.get_current_time_function = get_current_time_function
+        self.sleep_function = sleep_function
+
+    def run_cycle(self, scheduled_time: float) -> dict:
+        """
+        Runs a single cycle, logging rather than raising any error so that the next cycle still runs
+
+        :param float scheduled_time: The time the cycle was scheduled for
+
+        :return: dict cycle: The time the cycle was scheduled for, how late it started, how long it took, whether
+        it succeeded and anything returned by the cycle function
+        """
+
+        start = self.get_current_time_function()
+        cycle = {'scheduled_time': scheduled_time, 'start_delay': start - scheduled_time}
+
+        try:
+            cycle['details'] = self.cycle_function(scheduled_time)
+            cycle['success'] = True
+        except Exception:
+            logging.exception(f"The cycle scheduled for {scheduled_time} failed")
+            cycle['success'] = False
+
+        cycle['duration'] = self.get_current_time_function() - start
+
+        return cycle
+
+    def run(self, max_cycles: int = None) -> list:
+        """
+        Runs cycles until stopped
+
+        :param int max_cycles: The number of cycles to run before returning, if None it runs forever
+
+        :return: list[dict] cycles: The details of each cycle run
+        """
+
+        cycles = []
+        next_run_time = get_next_run_time(self.get_current_time_function(), self.interval, self.offset)
+
+        while max_cycles is None or len(cycles) < max_cycles:
+
+            wait_time = next_run_time - self.get_current_time_function()
+            if wait_time > 0:
+                logging.debug(f"Waiting {wait_time:.0f} secs for the next cycle")
+                self.sleep_function(wait_time)
+
+            cycle = self.run_cycle(next_run_time)
+
+            # Work out which boundaries passed while the cycle was running
+            following_run_time = get_next_run_time(self.get_current_time_function(), self.interval, self.offset)
+            cycle['missed'] = int(round((following_run_time - next_run_time) / self.interval)) - 1
+
+            if cycle['missed'] > 0 and self.overrun == 'coalesce':
+                # Run once straight away for all the missed boundaries, from the latest of them
+                following_run_time -= self.interval
+
+            if cycle['missed'] > 0:
+                logging.warning(f"The cycle took {cycle['duration']:.0f} secs and overran {cycle['missed']} "
+                                f"boundaries, which were {'coalesced' if self.overrun == 'coalesce' else 'skipped'}")
+
+            logging.debug(f"Cycle timings: {cycle}")
+
+            cycles.append(cycle)
+            next_run_time = following_run_time
+
+        return cycles
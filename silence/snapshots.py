@@ -0,0 +1,308 @@
+import argparse
+import io
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import quiet
+import utilities
+
+# The schema of the subscriber snapshots, see sql/subscriber_snapshots.sql
+SUBSCRIBER_SNAPSHOT_SCHEMA = pa.schema([
+    ('phone_hash', pa.string()),
+    ('phone', pa.string()),
+    ('topic', pa.string()),
+    ('opt_in', pa.string())
+])
+
+# The object naming the current snapshot, kept outside of the snapshots prefix so Athena doesn't read it
+CURRENT_SNAPSHOT_KEY = 'current-snapshot.json'
+SNAPSHOTS_PREFIX = 'snapshots/'
+# The markers chirp writes when someone unsubscribes, see sql/subscriber_tombstones.sql
+TOMBSTONES_PREFIX = 'tombstones/'
+
+
+def get_current_snapshot(s3, bucket_name: str) -> str:
+    """
+    Gets the snapshot the subscriber queries should read
+
+    :param boto3.resource s3: The S3 resource to use
+    :param str bucket_name: The bucket holding the subscriber snapshots
+
+    :return: str snapshot: The id of the current snapshot, or None if there hasn't been a compaction yet
+    """
+
+    client = s3.meta.client
+
+    try:
+        response = client.get_object(Bucket=bucket_name, Key=CURRENT_SNAPSHOT_KEY)
+    except client.exceptions.NoSuchKey:
+        return None
+
+    return json.loads(response['Body'].read())['snapshot']
+
+
+def list_object_etags(s3, bucket_name: str, prefix: str) -> dict:
+    """
+    Lists the objects under a prefix along with their ETags, which change whenever an object is rewritten
+
+    :param boto3.resource s3: The S3 resource to use
+    :param str bucket_name: The bucket to list
+    :param str prefix: The prefix of the objects
+
+    :return: dict etags: The ETag of each object keyed by its key
+    """
+
+    etags = {}
+    paginator = s3.meta.client.get_paginator('list_objects_v2')
+
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        etags.update({s3_object['Key']: s3_object['ETag'] for s3_object in page.get('Contents', [])})
+
+    return etags
+
+
+def read_json_objects(s3, bucket_name: str, keys: list, max_workers: int = 8) -> list:
+    """
+    Reads JSON objects in parallel, skipping any which have been deleted since they were listed
+
+    :param boto3.resource s3: The S3 resource to use
+    :param str bucket_name: The bucket holding the objects
+    :param list[str] keys: The keys of the objects to read
+    :param int max_workers: The maximum number of objects to read concurrently
+
+    :return: list[dict] objects: The objects which still exist, in the same order as the keys
+    """
+
+    client = s3.meta.client
+
+    def read(key):
+        try:
+            return json.loads(client.get_object(Bucket=bucket_name, Key=key)['Body'].read())
+        except client.exceptions.NoSuchKey:
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return [json_object for json_object in executor.map(read, keys) if json_object is not None]
+
+
+def read_snapshot(s3, bucket_name: str, snapshot: str) -> pd.DataFrame:
+    """
+    Reads every file of a subscriber snapshot
+
+    :param boto3.resource s3: The S3 resource to use
+    :param str bucket_name: The bucket holding the subscriber snapshots
+    :param str snapshot: The id of the snapshot, if None there are no subscribers
+
+    :return: pd.DataFrame subscribers: The subscribers in the snapshot
+    """
+
+    if snapshot is None:
+        return SUBSCRIBER_SNAPSHOT_SCHEMA.empty_table().to_pandas()
+
+    client = s3.meta.client
+    keys = sorted(list_object_etags(s3, bucket_name, f'{SNAPSHOTS_PREFIX}snapshot_id={snapshot}/'))
+
+    tables = [pq.read_table(io.BytesIO(client.get_object(Bucket=bucket_name, Key=key)['Body'].read()))
+              for key in keys]
+
+    if not tables:
+        return SUBSCRIBER_SNAPSHOT_SCHEMA.empty_table().to_pandas()
+
+    return pa.concat_tables(tables).to_pandas()
+
+
+def merge_subscribers(snapshot_df: pd.DataFrame, subscribers: list, tombstones: list) -> pd.DataFrame:
+    """
+    Applies the subscribers saved and removed since a snapshot to it. A subscriber saved since the snapshot replaces
+    any earlier version and wins over a tombstone, as chirp removes the tombstone when someone subscribes again.
+
+    :param pd.DataFrame snapshot_df: The subscribers in the previous snapshot
+    :param list[dict] subscribers: The subscribers saved by chirp since the snapshot
+    :param list[dict] tombstones: The tombstones written by chirp for the subscribers who have unsubscribed
+
+    :return: pd.DataFrame subscribers: The subscribers in the new snapshot, sorted by their topic and phone hash
+    """
+
+    delta_df = pd.DataFrame(subscribers, columns=['phone', 'topic', 'opt-in']).rename(columns={'opt-in': 'opt_in'})
+    delta_df['phone_hash'] = [quiet.hash_phone_number(str(phone)) for phone in delta_df['phone']]
+
+    removed = set(delta_df['phone_hash']) | set(tombstone['phone_hash'] for tombstone in tombstones)
+
+    # A subscriber left under the flat layout as well as a topic is only kept once
+    merged_df = pd.concat([
+        snapshot_df[~snapshot_df['phone_hash'].isin(removed)],
+        delta_df[SUBSCRIBER_SNAPSHOT_SCHEMA.names].drop_duplicates('phone_hash', keep='last')
+    ], ignore_index=True)
+
+    return merged_df.sort_values(['topic', 'phone_hash']).reset_index(drop=True)
+
+
+def list_subscriber_etags(s3, bucket_name: str) -> dict:
+    """
+    Lists the per subscriber objects saved by chirp, which are either at the top of the bucket or partitioned by topic
+
+    :param boto3.resource s3: The S3 resource to use
+    :param str bucket_name: The bucket chirp saves each subscriber to
+
+    :return: dict etags: The ETag of each object keyed by its key
+    """
+
+    return {key: etag for key, etag in list_object_etags(s3, bucket_name, '').items()
+            if key.split('/')[-1].startswith('subscriber-')}
+
+
+def delete_unchanged_objects(s3, bucket_name: str, etags: dict, prefix: str) -> int:
+    """
+    Deletes the objects which have been merged into a snapshot, keeping any which were rewritten after they were read
+
+    :param boto3.resource s3: The S3 resource to use
+    :param str bucket_name: The bucket holding the objects
+    :param dict etags: The ETag of each object when it was read keyed by its key
+    :param str prefix: The prefix of the objects
+
+    :return: int deleted: The number of objects deleted
+    """
+
+    client = s3.meta.client
+    current_etags = list_object_etags(s3, bucket_name, prefix)
+    keys = [key for key, etag in etags.items() if current_etags.get(key) == etag]
+
+    for start in range(0, len(keys), 1000):
+        client.delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]]})
+
+    return len(keys)
+
+
+def delete_old_snapshots(s3, bucket_name: str, retain: int) -> list:
+    """
+    Deletes all but the most recent snapshots, earlier ones are kept for queries which started before the latest
+
+    :param boto3.resource s3: The S3 resource to use
+    :param str bucket_name: The bucket holding the subscriber snapshots
+    :param int retain: The number of snapshots to keep, at least one
+
+    :return: list[str] deleted: The ids of the snapshots deleted
+    """
+
+    client = s3.meta.client
+    keys = list_object_etags(s3, bucket_name, SNAPSHOTS_PREFIX)
+
+    snapshots = {}
+    for key in keys:
+        snapshot = key[len(SNAPSHOTS_PREFIX):].split('/')[0][len('snapshot_id='):]
+        snapshots.setdefault(snapshot, []).append(key)
+
+    # The ids are timestamps so sort in the order they were taken
+    deleted = sorted(snapshots)[:-retain]
+
+    old_keys = [key for snapshot in deleted for key in snapshots[snapshot]]
+    for start in range(0, len(old_keys), 1000):
+        client.delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': [{'Key': key} for key in old_keys[start:start + 1000]]})
+
+    return deleted
+
+
+def compact_subscribers(s3, subscribers_bucket: str, snapshots_bucket: str, max_workers: int = 8,
+                        rows_per_file: int = 1000000, retain: int = 2,
+                        get_current_time_function=datetime.now) -> dict:
+    """
+    Merges the per subscriber JSON objects written by chirp and its tombstones into a new Parquet snapshot, then
+    deletes the objects merged. The subscriber queries read the current snapshot plus whatever has been saved or
+    removed since, so they give the same answer before, during and after a compaction.
+
+    :param boto3.resource s3: The S3 resource to use
+    :param str subscribers_bucket: The bucket chirp saves each subscriber to
+    :param str snapshots_bucket: The bucket holding the snapshots and the tombstones
+    :param int max_workers: The maximum number of objects to read concurrently
+    :param int rows_per_file: The maximum number of subscribers in each Parquet file of the snapshot
+    :param int retain: The number of snapshots to keep
+    :param func get_current_time_function: The function to use to get the current time
+
+    :return: dict compaction_status: The new snapshot, the number of subscribers in it, the number of subscribers and
+    tombstones merged and deleted, and the snapshots deleted
+    """
+
+    if retain < 1:
+        raise ValueError(f"At least one snapshot must be kept, not {retain}")
+
+    client = s3.meta.client
+    snapshot = get_current_time_function().strftime('%Y%m%dT%H%M%S')
+
+    # List the changes before reading the previous snapshot, anything saved after this is left for the next compaction
+    subscriber_etags = list_subscriber_etags(s3, subscribers_bucket)
+    tombstone_etags = list_object_etags(s3, snapshots_bucket, TOMBSTONES_PREFIX)
+    logging.debug(f"There are {len(subscriber_etags)} subscribers and {len(tombstone_etags)} tombstones to merge")
+
+    previous_snapshot = get_current_snapshot(s3, snapshots_bucket)
+
+    subscribers_df = merge_subscribers(
+        snapshot_df=read_snapshot(s3, snapshots_bucket, previous_snapshot),
+        subscribers=read_json_objects(s3, subscribers_bucket, list(subscriber_etags), max_workers),
+        tombstones=read_json_objects(s3, snapshots_bucket, list(tombstone_etags), max_workers))
+
+    # Each file only holds one topic, so a query for some topics skips the files of the others from their statistics
+    files = []
+    for _, topic_df in subscribers_df.groupby('topic', sort=True):
+        files.extend(topic_df.iloc[start:start + rows_per_file] for start in range(0, len(topic_df), rows_per_file))
+
+    # Always write at least one file so that an empty snapshot still exists
+    for part, file_df in enumerate(files or [subscribers_df]):
+        table = pa.Table.from_pandas(file_df, schema=SUBSCRIBER_SNAPSHOT_SCHEMA, preserve_index=False)
+        client.put_object(
+            Bucket=snapshots_bucket,
+            Key=f'{SNAPSHOTS_PREFIX}snapshot_id={snapshot}/part-{part:05d}.parquet',
+            Body=quiet.write_parquet_bytes(table))
+
+    # Switch the queries to the new snapshot once every file has been written
+    client.put_object(
+        Bucket=snapshots_bucket,
+        Key=CURRENT_SNAPSHOT_KEY,
+        Body=json.dumps({'snapshot': snapshot, 'previous_snapshot': previous_snapshot}))
+
+    # The merged objects are now in the snapshot, so the queries give the same answer without them
+    compaction_status = {
+        'snapshot': snapshot,
+        'subscribers': len(subscribers_df),
+        'subscribers_merged': len(subscriber_etags),
+        'tombstones_merged': len(tombstone_etags),
+        'subscribers_deleted': delete_unchanged_objects(s3, subscribers_bucket, subscriber_etags, ''),
+        'tombstones_deleted': delete_unchanged_objects(s3, snapshots_bucket, tombstone_etags, TOMBSTONES_PREFIX),
+        'snapshots_deleted': delete_old_snapshots(s3, snapshots_bucket, retain)
+    }
+
+    return compaction_status
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Merges the per subscriber JSON objects and tombstones into a Parquet subscriber snapshot')
+    parser.add_argument('subscribers_bucket', help='The bucket chirp saves each subscriber to')
+    parser.add_argument('snapshots_bucket', help='The bucket holding the subscriber snapshots and tombstones')
+    parser.add_argument('--region', default=None, help='The AWS region of the buckets')
+    parser.add_argument('--max-workers', type=int, default=8, help='The number of objects to read concurrently')
+    parser.add_argument('--rows-per-file', type=int, default=1000000,
+                        help='The maximum number of subscribers in each Parquet file')
+    parser.add_argument('--retain', type=int, default=2, help='The number of snapshots to keep')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.DEBUG)
+
+    print(compact_subscribers(
+        s3=utilities.create_aws_client(
+            client_type='s3',
+            region=args.region,
+            max_pool_connections=args.max_workers),
+        subscribers_bucket=args.subscribers_bucket,
+        snapshots_bucket=args.snapshots_bucket,
+        max_workers=args.max_workers,
+        rows_per_file=args.rows_per_file,
+        retain=args.retain))
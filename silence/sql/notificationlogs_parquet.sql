@@ -0,0 +1,41 @@
+-- The Parquet notification logs written with the parquet log format and by compact.py.
+-- Partition projection means new dt partitions are queryable without running MSCK REPAIR TABLE.
+-- Replace <bucket> with the value of PARQUET_NOTIFICATION_LOGS_S3_BUCKET_NAME.
+CREATE EXTERNAL TABLE IF NOT EXISTS notificationlogs_parquet (
+  `topic` string,
+  `level` double,
+  `topic_level` bigint,
+  `account_sid` string,
+  `api_version` string,
+  `body` string,
+  `date_created` timestamp,
+  `date_updated` timestamp,
+  `date_sent` timestamp,
+  `direction` string,
+  `error_code` string,
+  `error_message` string,
+  `from_` string,
+  `messaging_service_sid` string,
+  `num_media` string,
+  `num_segments` string,
+  `price` string,
+  `price_unit` string,
+  `sid` string,
+  `status` string,
+  `to` string,
+  `uri` string,
+  `subresource_uris_media` string
+)
+PARTITIONED BY (`dt` string)
+STORED AS PARQUET
+LOCATION 's3://<bucket>/'
+TBLPROPERTIES (
+  'parquet.compression'='SNAPPY',
+  'projection.enabled'='true',
+  'projection.dt.type'='date',
+  'projection.dt.format'='yyyy-MM-dd',
+  'projection.dt.range'='2019-01-01,NOW',
+  'projection.dt.interval'='1',
+  'projection.dt.interval.unit'='DAYS',
+  'storage.location.template'='s3://<bucket>/dt=${dt}/'
+);
@@ -0,0 +1,18 @@
+-- The Parquet subscriber snapshots written by snapshots.py, each under its own snapshot_id partition.
+-- The id of the current snapshot is in current-snapshot.json, injected projection means the queries must name it.
+-- Replace <bucket> with the value of SUBSCRIBER_SNAPSHOTS_S3_BUCKET_NAME.
+CREATE EXTERNAL TABLE IF NOT EXISTS subscriber_snapshots (
+  `phone_hash` string,
+  `phone` string,
+  `topic` string,
+  `opt_in` string
+)
+PARTITIONED BY (`snapshot_id` string)
+STORED AS PARQUET
+LOCATION 's3://<bucket>/snapshots/'
+TBLPROPERTIES (
+  'parquet.compression'='SNAPPY',
+  'projection.enabled'='true',
+  'projection.snapshot_id.type'='injected',
+  'storage.location.template'='s3://<bucket>/snapshots/snapshot_id=${snapshot_id}/'
+);
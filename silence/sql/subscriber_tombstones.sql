@@ -0,0 +1,8 @@
+-- The tombstones chirp writes when someone unsubscribes, removed once snapshots.py has merged them into a snapshot.
+-- Replace <bucket> with the value of SUBSCRIBER_SNAPSHOTS_S3_BUCKET_NAME.
+CREATE EXTERNAL TABLE IF NOT EXISTS subscriber_tombstones (
+  `phone_hash` string,
+  `unsubscribed_at` string
+)
+ROW FORMAT SERDE 'org.openx.data.jsonserde.JsonSerDe'
+LOCATION 's3://<bucket>/tombstones/';
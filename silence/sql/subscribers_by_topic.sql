@@ -0,0 +1,17 @@
+-- The subscribers saved by chirp with SUBSCRIBER_LAYOUT=topic, each under the partition of their topic.
+-- The topic comes from the partition so it isn't a column of the JSON, and a query for some topics only lists
+-- and reads those partitions.
+-- Replace <bucket> with the value of SUBSCRIBERS_S3_BUCKET_NAME.
+CREATE EXTERNAL TABLE IF NOT EXISTS subscribers_by_topic (
+  `phone` string,
+  `opt-in` string
+)
+PARTITIONED BY (`topic` string)
+ROW FORMAT SERDE 'org.openx.data.jsonserde.JsonSerDe'
+LOCATION 's3://<bucket>/'
+TBLPROPERTIES (
+  'projection.enabled'='true',
+  'projection.topic.type'='enum',
+  'projection.topic.values'='green,yellow,amber,red',
+  'storage.location.template'='s3://<bucket>/topic=${topic}/'
+);
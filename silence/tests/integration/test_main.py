@@ -16,4 +16,4 @@ class TestMain(unittest.TestCase):
         logging.getLogger('boto3').setLevel(logging.CRITICAL)
 
     def test_main(self):
-        main.send_notifications(self.global_config, notification_interval=0, retry_time=20)
+        main.send_notifications(self.global_config, retry_time=20)
@@ -0,0 +1,60 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from parameterized import parameterized
+import clients
+
+
+class TestClients(unittest.TestCase):
+
+    def test_create_aws_client_shared(self):
+
+        first_client = clients.create_aws_client('athena', public_key='abc', secret_key='def', region='eu-west-2')
+        second_client = clients.create_aws_client('athena', public_key='abc', secret_key='def', region='eu-west-2')
+
+        self.assertIs(first_client, second_client)
+
+    def test_create_aws_client_per_service(self):
+
+        athena = clients.create_aws_client('athena', public_key='abc', secret_key='def', region='eu-west-2')
+        s3 = clients.create_aws_client('s3', resource=True, public_key='abc', secret_key='def', region='eu-west-2',
+                                       max_pool_connections=4)
+
+        self.assertIsNot(athena, s3.meta.client)
+
+    def test_create_aws_client_threads_share_client(self):
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            aws_clients = list(executor.map(
+                lambda _: clients.create_aws_client('sqs', public_key='abc', secret_key='def', region='eu-west-1'),
+                range(16)))
+
+        self.assertTrue(all(aws_client is aws_clients[0] for aws_client in aws_clients))
+
+    @parameterized.expand([
+        ["Default settings", {}, 10, 5, 60, {'mode': 'adaptive', 'total_max_attempts': 5}],
+        [
+            "Tuned settings",
+            {'max_pool_connections': 32, 'connect_timeout': 2, 'read_timeout': 10, 'max_attempts': 3,
+             'retry_mode': 'standard'},
+            32, 2, 10, {'mode': 'standard', 'total_max_attempts': 3}
+        ]
+    ])
+    def test_create_aws_client_config(self, test_name, settings, expected_pool, expected_connect_timeout,
+                                      expected_read_timeout, expected_retries):
+
+        aws_client = clients.create_aws_client('athena', region='eu-west-1', **settings)
+        config = aws_client.meta.config
+
+        self.assertEqual(
+            first=(config.max_pool_connections, config.connect_timeout, config.read_timeout, config.retries),
+            second=(expected_pool, expected_connect_timeout, expected_read_timeout, expected_retries))
+
+    def test_create_twilio_client(self):
+
+        twilio_client = clients.create_twilio_client('AC123', 'token', pool_connections=16, timeout=10)
+        adapter = twilio_client.http_client.session.get_adapter('https://api.twilio.com')
+
+        self.assertEqual(
+            first=(adapter._pool_maxsize, adapter.max_retries.connect, adapter.max_retries.read,
+                   twilio_client.http_client.timeout),
+            second=(16, 3, 0, 10))
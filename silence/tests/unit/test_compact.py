@@ -0,0 +1,113 @@
+import unittest
+import io
+import json
+from datetime import datetime
+import pyarrow.parquet as pq
+import compact
+
+
+class MockS3Client:
+    """
+    This is a mock of the low level AWS S3 client holding objects in memory
+    """
+
+    def __init__(self, objects: dict) -> None:
+        """
+        :param dict objects: The objects in the mock S3 keyed by bucket and key
+        """
+        self.objects = objects
+
+    def get_paginator(self, operation_name: str):
+
+        objects = self.objects
+
+        class Paginator:
+
+            def paginate(self, Bucket, Prefix):
+                keys = sorted(key for bucket, key in objects if bucket == Bucket and key.startswith(Prefix))
+                # Split into pages of two to exercise the pagination
+                for start in range(0, len(keys), 2):
+                    yield {'Contents': [{'Key': key} for key in keys[start:start + 2]]}
+
+        return Paginator()
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def delete_objects(self, Bucket, Delete):
+        for s3_object in Delete['Objects']:
+            del self.objects[(Bucket, s3_object['Key'])]
+
+
+class MockS3Resource:
+
+    def __init__(self, objects: dict) -> None:
+        self.meta = type('Meta', (), {'client': MockS3Client(objects)})()
+
+
+class TestCompact(unittest.TestCase):
+
+    def setUp(self):
+        messages = [
+            {"sid": "SM1", "to": "abc", "date_created": "2019-10-19 21:59:24", "level": 52.33},
+            {"sid": "SM2", "to": "def", "date_created": "2019-10-20 08:00:01", "level": 60.1},
+            {"sid": "SM3", "to": "ghi", "date_created": "2019-10-20 09:00:01", "level": 61.0}
+        ]
+        self.objects = {
+            ('jsonlogs', 'message-{}.json'.format(message['sid'])): json.dumps(message).encode('utf-8')
+            for message in messages}
+
+    def test_compact_notification_logs(self):
+
+        s3 = MockS3Resource(self.objects)
+
+        compaction_status = compact.compact_notification_logs(
+            s3=s3,
+            source_bucket='jsonlogs',
+            destination_bucket='parquetlogs',
+            batch_size=10,
+            delete_source=True,
+            get_current_time_function=lambda: datetime(year=2019, month=10, day=21))
+
+        self.assertEqual(
+            first=compaction_status,
+            second={
+                'messages': 3,
+                'written': [
+                    'dt=2019-10-19/compacted-20191021T000000-0.parquet',
+                    'dt=2019-10-20/compacted-20191021T000000-0.parquet'
+                ],
+                'deleted': 3
+            }
+        )
+
+        # Only the Parquet files remain
+        self.assertEqual(
+            first=sorted(bucket for bucket, _ in self.objects),
+            second=['parquetlogs', 'parquetlogs']
+        )
+
+        table = pq.read_table(io.BytesIO(self.objects[('parquetlogs', compaction_status['written'][1])]))
+
+        self.assertEqual(
+            first=table.column('sid').to_pylist(),
+            second=['SM2', 'SM3']
+        )
+
+    def test_compact_notification_logs_keeps_source(self):
+
+        s3 = MockS3Resource(self.objects)
+
+        compact.compact_notification_logs(
+            s3=s3,
+            source_bucket='jsonlogs',
+            destination_bucket='parquetlogs',
+            batch_size=2)
+
+        self.assertEqual(
+            first=len([bucket for bucket, _ in self.objects if bucket == 'jsonlogs']),
+            second=3
+        )
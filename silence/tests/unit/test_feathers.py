@@ -3,6 +3,9 @@ from parameterized import parameterized
 import uuid
 import feathers
 import logging
+import io
+import os
+import pandas as pd
 
 
 class MockAthenaClient:
@@ -10,17 +13,22 @@ class MockAthenaClient:
     This is a mock of the AWS Athena client
     """
 
-    def __init__(self, failure_flag: bool, results_file: str) -> None:
+    def __init__(self, failure_flag: bool, results_file: str, failure_state: str = 'FAILED',
+                 request_limit: int = 3) -> None:
         """
 
         :param bool failure_flag: Whether the query should succeed or fail
         :param str results_file: The name of the results file
+        :param str failure_state: The state of the query if it fails, either FAILED or CANCELLED
+        :param int request_limit: The number of requests before returning success or failure
         """
         self.results_file = results_file
         self.failure = failure_flag
+        self.failure_state = failure_state
+        self.stopped = False
 
         self.request_counter = 0  # To track the number of requests made
-        self.request_limit = 3  # Hardcoded request limit before returning success or failure
+        self.request_limit = request_limit  # The request limit before returning success or failure
 
         self.ResultConfiguration = None
         self.QueryString = None
@@ -73,7 +81,7 @@ class MockAthenaClient:
         if self.request_counter >= self.request_limit and not self.failure:
             state = 'SUCCEEDED'
         elif self.failure:
-            state = 'FAILED'
+            state = self.failure_state
         else:
             state = 'RUNNING'
 
@@ -100,8 +108,8 @@ class MockAthenaClient:
                     'CompletionDateTime': None
                 },
                 'Statistics': {
-                    'EngineExecutionTimeInMillis': None,
-                    'DataScannedInBytes': None,
+                    'EngineExecutionTimeInMillis': 1200,
+                    'DataScannedInBytes': 2048,
                     'DataManifestLocation': None
                 },
                 'WorkGroup': None
@@ -110,6 +118,76 @@ class MockAthenaClient:
 
         return response
 
+    def stop_query_execution(self, QueryExecutionId: str) -> dict:
+        """
+        Mocks cancelling a query being executed
+
+        :param str QueryExecutionId: The unique QueryExecutionId for this query
+        :return: dict response: The response from Athena in AWS
+        """
+
+        self.stopped = True
+
+        return {}
+
+
+class MockConcurrentAthenaClient:
+    """
+    This is a mock of the AWS Athena client which can run several queries at once, each query completing after
+    a number of checks given by the query string
+    """
+
+    def __init__(self) -> None:
+        self.executions = {}
+
+    def start_query_execution(self, QueryString: str, ClientRequestToken: str, QueryExecutionContext,
+                              ResultConfiguration) -> dict:
+
+        query_id = str(uuid.uuid4())
+
+        self.executions[query_id] = {
+            'checks_remaining': int(QueryString),
+            'output_location': ResultConfiguration['OutputLocation'] + "/" + query_id + ".csv"
+        }
+
+        return {"QueryExecutionId": query_id}
+
+    def get_query_execution(self, QueryExecutionId: str) -> dict:
+
+        execution = self.executions[QueryExecutionId]
+        execution['checks_remaining'] -= 1
+
+        return {
+            'QueryExecution': {
+                'QueryExecutionId': QueryExecutionId,
+                'ResultConfiguration': {'OutputLocation': execution['output_location']},
+                'Status': {'State': 'SUCCEEDED' if execution['checks_remaining'] <= 0 else 'RUNNING'},
+                'Statistics': {}
+            }
+        }
+
+
+class MockS3Resource:
+    """
+    This is a mock of the AWS S3 resource holding a single object
+    """
+
+    def __init__(self, bucket: str, file_path: str, body: bytes) -> None:
+        """
+        :param str bucket: The bucket holding the object
+        :param str file_path: The key of the object
+        :param bytes body: The contents of the object
+        """
+
+        class Client:
+
+            def get_object(self, Bucket, Key):
+                if (Bucket, Key) != (bucket, file_path):
+                    raise KeyError(f"No object {Key} in {Bucket}")
+                return {'Body': io.BytesIO(body)}
+
+        self.meta = type('Meta', (), {'client': Client()})()
+
 
 class TestFeathers(unittest.TestCase):
 
@@ -164,6 +242,15 @@ class TestFeathers(unittest.TestCase):
             "select * from airpollution",
             2,
             Exception
+        ],
+        [
+            "Cancelled generation of the data view",
+            MockAthenaClient(failure_flag=True, results_file="1241241_result.csv", failure_state='CANCELLED'),
+            "airpollutionqueryresults",
+            "AIRPOLLUTION",
+            "select * from airpollution",
+            2,
+            feathers.QueryFailedError
         ]
     ])
     def test_generate_data_view_failure(self, test_name, client, results_bucket, database_name, sql_query,
@@ -180,5 +267,250 @@ class TestFeathers(unittest.TestCase):
             )
 
 
-    def test_fetch_data_view(self):
-        pass
\ No newline at end of file
+    def test_wait_for_query_backs_off(self):
+
+        client = MockAthenaClient(failure_flag=False, results_file="1241241_result.csv", request_limit=6)
+        query_id = feathers.start_query(client, "airpollutionqueryresults", "AIRPOLLUTION", "select 1")
+        delays = []
+
+        query_execution = feathers.wait_for_query(
+            client=client,
+            query_id=query_id,
+            max_delay=1,
+            initial_delay=0.25,
+            sleep_function=delays.append)
+
+        self.assertEqual(
+            first=delays,
+            second=[0.25, 0.5, 1, 1, 1]
+        )
+
+        self.assertEqual(
+            first=feathers.get_query_statistics(query_execution),
+            second={
+                'data_scanned_bytes': 2048,
+                'engine_execution_time_ms': 1200,
+                'queue_time_ms': None,
+                'total_execution_time_ms': None
+            }
+        )
+
+    def test_wait_for_query_times_out(self):
+
+        client = MockAthenaClient(failure_flag=False, results_file="1241241_result.csv", request_limit=100)
+        query_id = feathers.start_query(client, "airpollutionqueryresults", "AIRPOLLUTION", "select 1")
+        clock = {'now': 0.0}
+
+        def sleep(seconds):
+            clock['now'] += seconds
+
+        with self.assertRaises(feathers.QueryFailedError):
+            feathers.wait_for_query(
+                client=client,
+                query_id=query_id,
+                max_delay=4,
+                timeout=10,
+                sleep_function=sleep,
+                get_current_time_function=lambda: clock['now'])
+
+        self.assertTrue(
+            expr=client.stopped,
+            msg="The query was not cancelled after timing out"
+        )
+
+    def test_run_queries(self):
+
+        client = MockConcurrentAthenaClient()
+
+        query_results = feathers.run_queries(
+            client=client,
+            database_name="AIRPOLLUTION",
+            query_requests=[
+                {'results_bucket': "airpollutionqueryresults", 'sql_query': "5"},
+                {'results_bucket': "subscriberqueryresults", 'sql_query': "1"}
+            ],
+            retry_time=1,
+            sleep_function=lambda seconds: None)
+
+        # Both queries are submitted before either is waited on
+        self.assertEqual(
+            first=len(client.executions),
+            second=2
+        )
+
+        self.assertEqual(
+            first=[query_result['bucket'] for query_result in query_results],
+            second=["airpollutionqueryresults", "subscriberqueryresults"]
+        )
+
+    def test_query_cache_key_ignores_layout(self):
+
+        self.assertEqual(
+            first=feathers.QueryCache.make_key("SELECT *\n    FROM airpollution", "AIRPOLLUTION", "bucket", {'hour': 1}),
+            second=feathers.QueryCache.make_key("SELECT * FROM airpollution", "AIRPOLLUTION", "bucket", {'hour': 1})
+        )
+
+        self.assertNotEqual(
+            first=feathers.QueryCache.make_key("SELECT * FROM airpollution", "AIRPOLLUTION", "bucket", {'hour': 1}),
+            second=feathers.QueryCache.make_key("SELECT * FROM airpollution", "AIRPOLLUTION", "bucket", {'hour': 2})
+        )
+
+    def test_query_cache_expiry_and_eviction(self):
+
+        clock = {'now': 0.0}
+        cache = feathers.QueryCache(ttl=60, max_entries=2, get_current_time_function=lambda: clock['now'])
+
+        for key in ['a', 'b', 'c']:
+            cache.put(key, {'query_id': key})
+
+        # The least recently used entry is evicted once the cache is full
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), {'query_id': 'b', 'cached': True})
+
+        # Entries expire after the time to live
+        clock['now'] = 61
+        self.assertIsNone(cache.get('c'))
+
+    def test_query_cache_survives_restart(self):
+
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "query-cache.json")
+
+        try:
+            feathers.QueryCache(ttl=60, path=path).put('a', {'query_id': 'a'})
+
+            self.assertEqual(
+                first=feathers.QueryCache(ttl=60, path=path).get('a'),
+                second={'query_id': 'a', 'cached': True}
+            )
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_run_query_uses_cache(self):
+
+        client = MockConcurrentAthenaClient()
+        cache = feathers.QueryCache(ttl=60)
+
+        for _ in range(2):
+            query_result = feathers.run_query(
+                client=client,
+                results_bucket="airpollutionqueryresults",
+                database_name="AIRPOLLUTION",
+                sql_query="1",
+                retry_time=1,
+                sleep_function=lambda seconds: None,
+                cache=cache,
+                cache_params={'hour': '2019-10-20 10'})
+
+        self.assertEqual(
+            first=len(client.executions),
+            second=1
+        )
+
+        self.assertTrue(query_result['cached'])
+
+    @parameterized.expand([
+        ["Supported by botocore", ['QueryString', 'ResultReuseConfiguration'], True],
+        ["Not supported by an older botocore", ['QueryString'], False]
+    ])
+    def test_start_query_result_reuse(self, test_name, parameters, expected_reuse):
+
+        class MockReuseAthenaClient:
+
+            def __init__(self):
+                input_shape = type('Shape', (), {'members': {parameter: None for parameter in parameters}})()
+                operation_model = type('OperationModel', (), {'input_shape': input_shape})()
+                service_model = type('ServiceModel', (), {'operation_model': lambda self, name: operation_model})()
+                self.meta = type('Meta', (), {'service_model': service_model})()
+                self.parameters = None
+
+            def start_query_execution(self, **parameters):
+                self.parameters = parameters
+                return {'QueryExecutionId': 'a'}
+
+        client = MockReuseAthenaClient()
+
+        if expected_reuse:
+            feathers.start_query(client, "airpollutionqueryresults", "AIRPOLLUTION", "1", result_reuse_minutes=60)
+        else:
+            with self.assertLogs(level='WARNING'):
+                feathers.start_query(client, "airpollutionqueryresults", "AIRPOLLUTION", "1", result_reuse_minutes=60)
+
+        self.assertEqual(
+            first='ResultReuseConfiguration' in client.parameters,
+            second=expected_reuse
+        )
+
+    def test_run_query_without_cache_params_not_cached(self):
+
+        client = MockConcurrentAthenaClient()
+        cache = feathers.QueryCache(ttl=60)
+
+        query_results = [
+            feathers.run_query(
+                client=client,
+                results_bucket="airpollutionqueryresults",
+                database_name="AIRPOLLUTION",
+                sql_query="1",
+                retry_time=1,
+                sleep_function=lambda seconds: None,
+                cache=cache)
+            for _ in range(2)]
+
+        self.assertEqual(
+            first=(len(client.executions), [query_result.get('cached', False) for query_result in query_results]),
+            second=(2, [False, False])
+        )
+
+    def test_run_query(self):
+
+        query_result = feathers.run_query(
+            client=MockAthenaClient(failure_flag=False, results_file="1241241_result.csv"),
+            results_bucket="airpollutionqueryresults",
+            database_name="AIRPOLLUTION",
+            sql_query="select * from airpollution",
+            retry_time=1,
+            sleep_function=lambda seconds: None)
+
+        self.assertEqual(
+            first=(query_result['bucket'], query_result['file_path'], query_result['statistics']['data_scanned_bytes']),
+            second=("airpollutionqueryresults", "1241241_result.csv", 2048)
+        )
+
+    @parameterized.expand([
+        [
+            "Read the whole result at once",
+            None,
+            1
+        ],
+        [
+            "Read the result in batches",
+            2,
+            2
+        ]
+    ])
+    def test_read_data_view(self, test_name, chunksize, expected_batches):
+
+        s3 = MockS3Resource(
+            bucket="airpollutionqueryresults",
+            file_path="1241241_result.csv",
+            body=b'"phone","topic"\n"07719143007","yellow"\n"07719143008","amber"\n"07719143009","red"\n')
+
+        data = feathers.read_data_view(
+            s3=s3,
+            bucket="airpollutionqueryresults",
+            file_path="1241241_result.csv",
+            dtype={'phone': str},
+            chunksize=chunksize)
+
+        batches = [data] if chunksize is None else list(data)
+
+        self.assertEqual(
+            first=len(batches),
+            second=expected_batches
+        )
+
+        self.assertEqual(
+            first=list(pd.concat(batches)['phone']),
+            second=["07719143007", "07719143008", "07719143009"]
+        )
\ No newline at end of file
@@ -0,0 +1,67 @@
+import unittest
+import os
+from datetime import datetime
+from parameterized import parameterized
+import last_notified
+
+
+class TestLastNotified(unittest.TestCase):
+
+    @parameterized.expand([
+        [
+            "A new subscriber is added to the index",
+            {},
+            [{"to": "abc", "date_created": datetime(year=2019, month=10, day=20, hour=10)}],
+            {"abc": "2019-10-20 10:00:00"}
+        ],
+        [
+            "A later message replaces an earlier one",
+            {"abc": "2019-10-19 10:00:00"},
+            [{"to": "abc", "date_created": datetime(year=2019, month=10, day=20, hour=10)}],
+            {"abc": "2019-10-20 10:00:00"}
+        ],
+        [
+            "An earlier message does not replace a later one",
+            {"abc": "2019-10-20 11:00:00"},
+            [{"to": "abc", "date_created": datetime(year=2019, month=10, day=20, hour=10)}],
+            {"abc": "2019-10-20 11:00:00"}
+        ]
+    ])
+    def test_update_last_notified(self, test_name, index, message_logs, expected_outcome):
+
+        self.assertEqual(
+            first=last_notified.update_last_notified(index, message_logs),
+            second=expected_outcome
+        )
+
+    def test_prune_last_notified(self):
+
+        index = {"abc": "2019-10-20 09:00:00", "def": "2019-10-17 09:00:00"}
+
+        self.assertEqual(
+            first=last_notified.prune_last_notified(
+                index,
+                retention_days=2,
+                get_current_time_function=lambda: datetime(year=2019, month=10, day=20, hour=10)),
+            second={"abc": "2019-10-20 09:00:00"}
+        )
+
+    def test_save_and_load_local(self):
+
+        local_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "last-notified.json")
+
+        try:
+            self.assertEqual(
+                first=last_notified.load_last_notified(local_path=local_path),
+                second={}
+            )
+
+            last_notified.save_last_notified({"abc": "2019-10-20 09:00:00"}, local_path=local_path)
+
+            self.assertEqual(
+                first=last_notified.load_last_notified(local_path=local_path),
+                second={"abc": "2019-10-20 09:00:00"}
+            )
+        finally:
+            if os.path.exists(local_path):
+                os.remove(local_path)
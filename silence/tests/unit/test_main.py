@@ -0,0 +1,218 @@
+import unittest
+import io
+import uuid
+from datetime import datetime
+from parameterized import parameterized
+import pandas as pd
+import main
+import metrics
+import throttle
+
+
+class MockAthenaClient:
+    """
+    This is a mock of the AWS Athena client where every query succeeds straight away, recording each query run
+    """
+
+    def __init__(self) -> None:
+        self.executions = {}
+
+    def start_query_execution(self, QueryString: str, ClientRequestToken: str, QueryExecutionContext,
+                              ResultConfiguration, **kwargs) -> dict:
+
+        query_id = str(uuid.uuid4())
+        self.executions[query_id] = {'query': QueryString, 'output_location': ResultConfiguration['OutputLocation']}
+
+        return {"QueryExecutionId": query_id}
+
+    def get_query_execution(self, QueryExecutionId: str) -> dict:
+
+        return {
+            'QueryExecution': {
+                'QueryExecutionId': QueryExecutionId,
+                'ResultConfiguration': {
+                    'OutputLocation': self.executions[QueryExecutionId]['output_location'] + "/results.csv"},
+                'Status': {'State': 'SUCCEEDED'},
+                'Statistics': {}
+            }
+        }
+
+
+class MockS3Resource:
+    """
+    This is a mock of the AWS S3 resource returning the same query results for every object in each bucket
+    """
+
+    def __init__(self, bodies: dict) -> None:
+        """
+        :param dict bodies: The contents of the objects in each bucket
+        """
+
+        class Client:
+
+            def __init__(self):
+                self.objects = {}
+
+            def get_object(self, Bucket, Key):
+                return {'Body': io.BytesIO(bodies[Bucket])}
+
+            def put_object(self, Bucket, Key, Body):
+                self.objects[(Bucket, Key)] = Body
+
+        self.meta = type('Meta', (), {'client': Client()})()
+
+
+class MockTwilioClient:
+    """
+    This is a mock of the Twilio client which fails to send to the given numbers
+    """
+
+    def __init__(self, failing_numbers=()):
+
+        class Messages:
+
+            def create(self, from_, to, body):
+                if to in failing_numbers:
+                    raise RuntimeError("Invalid number")
+                created = datetime(year=2019, month=10, day=20, hour=10)
+                message = type('Message', (), {})()
+                message._properties = {
+                    'sid': 'SM' + to, 'to': to, 'body': body, 'date_created': created, 'date_updated': created,
+                    'subresource_uris': {'media': '/Media.json'}}
+                return message
+
+        self.messages = Messages()
+
+
+class TestMain(unittest.TestCase):
+
+    def setUp(self):
+        self.global_config = main.generate_config()
+        self.global_config['twilio_throttle'] = throttle.Throttle(bucket=throttle.TokenBucket(rate=1, capacity=1))
+        metrics.registry.reset()
+
+    def test_send_notifications_outside_window(self):
+
+        # There are no clients so any query or S3 request would fail
+        cycle = main.send_notifications(
+            self.global_config, get_current_time_function=lambda: datetime(year=2019, month=10, day=20, hour=23))
+
+        self.assertEqual(
+            first=(cycle['messages'], cycle['skipped'], metrics.registry.as_dict()['counters']),
+            second=(0, 'outside_window', {'silence_cycles_skipped_total{reason="outside_window"}': 1}))
+
+    @parameterized.expand([
+        ["Concurrent queries", True, False],
+        ["Sequential queries", False, False],
+        ["Sequential queries after the pollution level", True, True]
+    ])
+    def test_fetch_cycle_data_subscribers_never_cached(self, test_name, concurrent_queries, query_subscribers_by_topic):
+
+        athena = MockAthenaClient()
+        self.global_config.update({
+            'athena': athena,
+            's3_athena': MockS3Resource({
+                'pollution': b'"average"\n"60"\n',
+                'subscribers': b'"phone","topic","last_message"\n"07719143007","yellow",""\n'}),
+            'pollution_bucket': 'pollution',
+            'subscribers_bucket': 'subscribers',
+            'database': 'AIRPOLLUTION',
+            'concurrent_queries': concurrent_queries,
+            'query_subscribers_by_topic': query_subscribers_by_topic,
+            'query_cache': main.feathers.QueryCache(ttl=3600)
+        })
+
+        for _ in range(2):
+            cycle_data = main.fetch_cycle_data(
+                self.global_config, since='2019-10-19', retry_time=1, current_time=datetime.now())
+
+        # The pollution query is reused within the hour but the subscribers are queried afresh every cycle
+        self.assertEqual(
+            first=(sorted(execution['output_location'] for execution in athena.executions.values()),
+                   cycle_data['subscribers_query_result'].get('cached', False)),
+            second=(['s3://pollution', 's3://subscribers', 's3://subscribers'], False))
+
+    def test_fetch_cycle_data_uses_cycle_time(self):
+
+        athena = MockAthenaClient()
+        query_cache = main.feathers.QueryCache(ttl=3600)
+        self.global_config.update({
+            'athena': athena,
+            's3_athena': MockS3Resource({
+                'pollution': b'"average"\n"60"\n',
+                'subscribers': b'"phone","topic","last_message"\n"07719143007","yellow",""\n'}),
+            'pollution_bucket': 'pollution',
+            'subscribers_bucket': 'subscribers',
+            'database': 'AIRPOLLUTION',
+            'filter_eligibility_in_query': True,
+            'query_cache': query_cache
+        })
+
+        # The cycle's time is outside the window on a day other than today, whatever the time now is
+        current_time = datetime(year=2019, month=10, day=20, hour=23)
+        main.fetch_cycle_data(self.global_config, since='2019-10-19', retry_time=1, current_time=current_time)
+        subscribers_query = next(
+            execution['query'] for execution in athena.executions.values()
+            if execution['output_location'] == 's3://subscribers')
+        pollution_key = query_cache.make_key(
+            main.queries.pollution_query(since='2019-10-19'), 'AIRPOLLUTION', 'pollution', {'hour': '2019-10-20 23'})
+
+        self.assertEqual(
+            first=("<> '2019-10-20'" in subscribers_query, 'AND false' in subscribers_query,
+                   query_cache.get(pollution_key) is not None),
+            second=(True, True, True))
+
+    def configure_cycle(self, athena, failing_numbers=()):
+
+        self.global_config.update({
+            'athena': athena,
+            's3_athena': MockS3Resource({
+                'pollution': b'"average"\n"60"\n',
+                'subscribers': b'"phone","topic","last_message"\n"07719143007","yellow",""\n'}),
+            's3_logs': MockS3Resource({}),
+            'twilio': MockTwilioClient(failing_numbers),
+            'pollution_bucket': 'pollution',
+            'subscribers_bucket': 'subscribers',
+            'logs_bucket': 'logs',
+            'database': 'AIRPOLLUTION',
+            'query_cache': main.feathers.QueryCache(ttl=3600),
+            'skip_unchanged_level': True
+        })
+
+    @parameterized.expand([
+        ["Every message sent", (), 'level_unchanged', 2],
+        ["A message failed", ('07719143007',), None, 3]
+    ])
+    def test_send_notifications_level_unchanged(self, test_name, failing_numbers, expected_skip_reason,
+                                                expected_executions):
+
+        athena = MockAthenaClient()
+        self.configure_cycle(athena, failing_numbers)
+
+        cycles = [
+            main.send_notifications(
+                self.global_config, get_current_time_function=lambda: datetime(year=2019, month=10, day=20, hour=10))
+            for _ in range(2)]
+
+        # The pollution query is reused, so a skipped cycle runs no query at all
+        self.assertEqual(
+            first=(cycles[0]['messages'], cycles[1].get('skipped'), len(athena.executions)),
+            second=(1 - len(failing_numbers), expected_skip_reason, expected_executions))
+
+    @parameterized.expand([
+        ["No previous cycle", None, 60, None],
+        ["Same level earlier today", {'day': '2019-10-20', 'level_category': 1}, 60, 'level_unchanged'],
+        ["Higher level earlier today", {'day': '2019-10-20', 'level_category': 2}, 60, None],
+        ["Lower level earlier today", {'day': '2019-10-20', 'level_category': 0}, 60, None],
+        ["Same level yesterday", {'day': '2019-10-19', 'level_category': 1}, 60, None]
+    ])
+    def test_get_level_skip_reason(self, test_name, previous_cycle, average, expected_skip_reason):
+
+        self.global_config['previous_cycle'] = previous_cycle
+
+        self.assertEqual(
+            first=main.get_level_skip_reason(
+                self.global_config,
+                pd.DataFrame({'average': [average]}),
+                datetime(year=2019, month=10, day=20, hour=10)),
+            second=expected_skip_reason)
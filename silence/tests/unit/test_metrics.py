@@ -0,0 +1,143 @@
+import unittest
+import json
+import os
+import tempfile
+import urllib.request
+from parameterized import parameterized
+import metrics
+import quiet
+
+
+class MockClock:
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def time(self) -> float:
+        return self.now
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    @parameterized.expand([
+        ["A value in the first bucket", [0.5], {'1': 1, '5': 1}, 1],
+        ["Values across the buckets", [0.5, 2, 10], {'1': 1, '5': 2}, 3],
+        ["A value on a bucket boundary", [1], {'1': 1, '5': 1}, 1]
+    ])
+    def test_histogram(self, test_name, values, expected_buckets, expected_count):
+
+        histogram = metrics.Histogram(buckets=[5, 1])
+        for value in values:
+            histogram.observe(value)
+
+        self.assertEqual(
+            first=histogram.as_dict(),
+            second={'buckets': expected_buckets, 'count': expected_count, 'sum': sum(values)})
+
+    def test_time(self):
+
+        clock = MockClock()
+        registry = metrics.Registry(get_current_time_function=clock.time)
+
+        with registry.time('silence_stage_seconds', labels={'stage': 'send'}):
+            clock.now += 2
+
+        self.assertEqual(
+            first=registry.as_dict()['histograms']['silence_stage_seconds{stage="send"}']['sum'],
+            second=2)
+
+    def test_to_prometheus(self):
+
+        self.registry.describe('silence_messages_total', 'Messages sent')
+        self.registry.increment('silence_messages_total', labels={'outcome': 'sent'})
+        self.registry.increment('silence_messages_total', 2, labels={'outcome': 'sent'})
+        self.registry.set_gauge('silence_last_cycle_timestamp_seconds', 100)
+        self.registry.observe('silence_send_seconds', 0.3, buckets=[0.1, 1])
+
+        self.assertEqual(
+            first=self.registry.to_prometheus(),
+            second='\n'.join([
+                '# HELP silence_messages_total Messages sent',
+                '# TYPE silence_messages_total counter',
+                'silence_messages_total{outcome="sent"} 3',
+                '# HELP silence_last_cycle_timestamp_seconds Time the last notification cycle finished',
+                '# TYPE silence_last_cycle_timestamp_seconds gauge',
+                'silence_last_cycle_timestamp_seconds 100',
+                '# TYPE silence_send_seconds histogram',
+                'silence_send_seconds_bucket{le="0.1"} 0',
+                'silence_send_seconds_bucket{le="1"} 1',
+                'silence_send_seconds_bucket{le="+Inf"} 1',
+                'silence_send_seconds_sum 0.3',
+                'silence_send_seconds_count 1',
+            ]) + '\n')
+
+    def test_write_json(self):
+
+        self.registry.increment('silence_subscribers_checked_total', 10)
+        path = os.path.join(tempfile.mkdtemp(), 'metrics.json')
+
+        self.registry.write_json(path)
+
+        with open(path) as json_file:
+            self.assertEqual(
+                first=json.load(json_file)['counters'],
+                second={'silence_subscribers_checked_total': 10})
+
+    def test_merge(self):
+
+        other = metrics.Registry()
+        for registry in [self.registry, other]:
+            registry.increment('chirp_responses_total', labels={'route': '/subscribe', 'status': 200})
+            registry.observe('chirp_request_seconds', 0.3, labels={'route': '/subscribe'}, buckets=[0.1, 1])
+
+        # Going through JSON as the snapshots of other workers are read from files
+        self.registry.merge(json.loads(json.dumps(other.snapshot())))
+
+        self.assertEqual(
+            first=self.registry.as_dict(),
+            second={
+                'counters': {'chirp_responses_total{route="/subscribe",status="200"}': 2},
+                'gauges': {},
+                'histograms': {
+                    'chirp_request_seconds{route="/subscribe"}': {
+                        'buckets': {'0.1': 0, '1': 2}, 'count': 2, 'sum': 0.6}}})
+
+    def test_serve(self):
+
+        self.registry.increment('silence_subscribers_checked_total', 10)
+        server = self.registry.serve(port=0, address='127.0.0.1')
+
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(server.server_address[1])) as response:
+                body = response.read().decode('utf-8')
+        finally:
+            server.shutdown()
+
+        self.assertIn('silence_subscribers_checked_total 10', body)
+
+    def test_dispatch_messages_recorded(self):
+
+        class MockTwilioClient:
+
+            class Messages:
+
+                def create(self, from_, to, body):
+                    if to == 'bad':
+                        raise RuntimeError("Invalid number")
+                    return {'to': to}
+
+            def __init__(self):
+                self.messages = self.Messages()
+
+        metrics.registry.reset()
+
+        quiet.dispatch_messages(MockTwilioClient(), 'Hello', ['a', 'bad', 'c'], max_workers=2)
+
+        recorded = metrics.registry.as_dict()
+
+        self.assertEqual(
+            first=(recorded['counters'], recorded['histograms']['silence_twilio_send_seconds']['count']),
+            second=({'silence_messages_total{outcome="sent"}': 2, 'silence_messages_total{outcome="failed"}': 1}, 3))
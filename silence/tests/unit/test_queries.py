@@ -0,0 +1,51 @@
+import unittest
+import queries
+
+
+class TestQueries(unittest.TestCase):
+
+    def test_subscribers_query_reads_only_recent_partitions(self):
+
+        self.assertIn(
+            member="WHERE dt>='2019-10-19'",
+            container=queries.subscribers_query(logs_table='notificationlogs_parquet', logs_since='2019-10-19')
+        )
+
+        self.assertNotIn(
+            member="WHERE dt>=",
+            container=queries.subscribers_query(logs_table='notificationlogs')
+        )
+
+    def test_subscribers_query_reads_snapshot(self):
+
+        self.assertIn(
+            member="WHERE snapshots.snapshot_id='20191021T010000'",
+            container=queries.subscribers_only_query(
+                subscribers=queries.current_subscribers(snapshot='20191021T010000'))
+        )
+
+        self.assertNotIn(
+            member="subscriber_snapshots",
+            container=queries.subscribers_query(logs_table='notificationlogs')
+        )
+
+    def test_subscribers_query_reads_only_alerted_topics(self):
+
+        subscribers = queries.current_subscribers(
+            subscribers_table='subscribers_by_topic', topics=['green', 'yellow'], snapshot='20191021T010000')
+
+        self.assertEqual(
+            first=[subscribers.count("WHERE subscribers.topic IN ('green', 'yellow')"),
+                   subscribers.count("AND snapshots.topic IN ('green', 'yellow')")],
+            second=[1, 1])
+
+    def test_subscribers_query_filters_eligibility(self):
+
+        eligibility = {'day': '2019-10-20', 'in_window': False, 'topics': ['green']}
+
+        self.assertEqual(
+            first=[
+                "<> '2019-10-20')\n        AND false" in queries.subscribers_query(eligibility=eligibility),
+                "WHERE false" in queries.subscribers_only_query(eligibility=eligibility),
+                "HAVING" in queries.subscribers_query()],
+            second=[True, True, False])
@@ -5,6 +5,10 @@ from datetime import datetime
 import pytz
 import quiet
 import logging
+import json
+import gzip
+import io
+import pyarrow.parquet as pq
 
 
 class TestQuiet(unittest.TestCase):
@@ -186,6 +190,118 @@ class TestQuiet(unittest.TestCase):
             msg="The output does not match the expected outcome"
         )
 
+    def test_filtering_leaves_input_untouched(self) -> None:
+        """
+        This tests that neither the eligibility check nor the notifications modify the caller's dataframe
+        :return: None
+        """
+
+        subscribers = pd.DataFrame(
+            data={
+                "last_message": ["2019-10-20 09:12:56.000", ""],
+                "phone": ["07719143007", "07719143008"],
+                "topic": ["yellow", "amber"]
+            },
+            index=[0, 1])
+        original_subscribers = subscribers.copy()
+
+        eligible_subscribers = quiet.check_eligibility(
+            subscriber_df_with_last_message=subscribers,
+            start_hour=8,
+            end_hour=20,
+            get_current_time_function=self.mock_get_current_datetime_function)
+
+        quiet.send_notifications(
+            topic="green",
+            level=20.0,
+            subscriber_df=eligible_subscribers,
+            client=self.MockTwilioClient(),
+            messages={"green": ""},
+            levels=["green", "yellow", "amber", "red"])
+
+        self.assertTrue(
+            expr=subscribers.equals(original_subscribers),
+            msg="The subscriber dataframe was modified"
+        )
+
+        self.assertEqual(
+            first=list(eligible_subscribers.columns),
+            second=["phone", "topic"]
+        )
+
+    def test_typed_subscriber_data(self) -> None:
+        """
+        This tests that subscriber data read with the compact types gives the same eligible subscribers
+        :return: None
+        """
+
+        levels = ["green", "yellow", "amber", "red"]
+        csv = '"last_message","phone","topic","unused"\n' \
+              '"2019-10-20 09:12:56.000","07719143007","yellow","a"\n' \
+              '"","07719143008","amber","b"\n' \
+              '"2019-10-19 09:12:56.000","07719143009","green","c"\n'
+
+        subscribers = pd.read_csv(io.StringIO(csv), **quiet.get_subscriber_read_options(levels))
+
+        self.assertEqual(
+            first=(str(subscribers['topic'].dtype), str(subscribers['last_message'].dtype), subscribers['phone'][0]),
+            second=("category", "datetime64[ns]", "07719143007")
+        )
+
+        eligible_subscribers = quiet.check_eligibility(
+            subscriber_df_with_last_message=subscribers,
+            start_hour=8,
+            end_hour=20,
+            get_current_time_function=self.mock_get_current_datetime_function)
+
+        message_logs = quiet.send_notifications(
+            topic="yellow",
+            level=52.33,
+            subscriber_df=eligible_subscribers,
+            client=self.MockTwilioClient(),
+            messages={"yellow": ""},
+            levels=levels)
+
+        self.assertEqual(
+            first=[message["to"] for message in message_logs],
+            second=[quiet.hash_phone_number("07719143009")]
+        )
+
+    def test_check_eligibility_with_last_notified(self) -> None:
+        """
+        This tests that the last message time can come from the last notified index instead of the logs
+        :return: None
+        """
+
+        subscribers = pd.DataFrame(
+            data={
+                "phone": ["07719143007", "07719143008", "07719143009"],
+                "topic": ["yellow", "amber", "red"]
+            },
+            index=[0, 1, 2])
+
+        last_notified = {
+            quiet.hash_phone_number("07719143007"): "2019-10-20 09:12:56",
+            quiet.hash_phone_number("07719143008"): "2019-10-19 09:12:56"
+        }
+
+        eligible_subscribers = quiet.check_eligibility(
+            subscriber_df_with_last_message=subscribers,
+            start_hour=8,
+            end_hour=20,
+            get_current_time_function=self.mock_get_current_datetime_function,
+            last_notified=last_notified)
+
+        self.assertTrue(
+            expr=eligible_subscribers.equals(pd.DataFrame(
+                data={
+                    "phone": ["07719143008", "07719143009"],
+                    "topic": ["amber", "red"]
+                },
+                index=[1, 2])),
+            msg="The output does not match the expected outcome"
+        )
+
     @parameterized.expand([
         # Test single notification where level is appropriate for eligible subscriber
         [
@@ -273,8 +389,248 @@ class TestQuiet(unittest.TestCase):
         )
 
 
+    class MockFailingTwilioClient():
+
+        def __init__(self, failing_numbers):
+            self.messages = self.Messages(failing_numbers)
+
+        class Messages:
+
+            def __init__(self, failing_numbers):
+                self.failing_numbers = failing_numbers
+
+            def create(self, from_, to, body):
+
+                if to in self.failing_numbers:
+                    raise ValueError(f"Unable to send to {to}")
+
+                return {"to": to, "body": body}
+
+    @parameterized.expand([
+        [
+            "All messages sent with a single worker",
+            ["07719143007", "07719143008", "07719143009"],
+            [],
+            1,
+            [True, True, True]
+        ],
+        [
+            "All messages sent with several workers",
+            ["0771914300{}".format(i) for i in range(10)],
+            [],
+            4,
+            [True] * 10
+        ],
+        [
+            "A failed message does not stop the rest of the batch",
+            ["07719143007", "07719143008", "07719143009"],
+            ["07719143008"],
+            2,
+            [True, False, True]
+        ]
+    ])
+    def test_dispatch_messages(self, test_name, phone_numbers, failing_numbers, max_workers, expected_outcome):
+
+        results = quiet.dispatch_messages(
+            client=self.MockFailingTwilioClient(failing_numbers),
+            message_body="test",
+            phone_numbers=phone_numbers,
+            max_workers=max_workers)
+
+        self.assertEqual(
+            first=[result['to'] for result in results],
+            second=phone_numbers,
+            msg="The results are not in the same order as the phone numbers"
+        )
+
+        self.assertEqual(
+            first=[result['success'] for result in results],
+            second=expected_outcome
+        )
+
+    def test_create_parquet_log_object(self):
+
+        key, body, message_ids = quiet.create_parquet_log_object(
+            message_logs=[
+                {
+                    "sid": "SM1",
+                    "level": 52.33,
+                    "topic_level": 1,
+                    "date_created": datetime(year=2019, month=10, day=19, hour=21, minute=59, second=24),
+                    "date_sent": None,
+                    "num_media": 0,
+                    "subresource_uris.media": "/Media.json"
+                }
+            ],
+            current_time=self.mock_get_current_datetime_function())
+
+        table = pq.read_table(io.BytesIO(body))
+
+        self.assertEqual(
+            first=key,
+            second="dt=2019-10-20/notifications-20191020T100000.parquet"
+        )
+
+        self.assertEqual(
+            first=table.schema,
+            second=quiet.NOTIFICATION_LOG_SCHEMA
+        )
+
+        self.assertEqual(
+            first=(table.to_pylist()[0]['num_media'], table.to_pylist()[0]['subresource_uris_media']),
+            second=("0", "/Media.json")
+        )
+
     def test_hash_phone_number(self):
         pass
 
-    def test_log_notifications_sent(self):
-        pass
\ No newline at end of file
+    class MockS3Resource():
+
+        def __init__(self, failing_keys=None):
+            self.meta = self.Meta(failing_keys or [])
+
+        class Meta:
+
+            def __init__(self, failing_keys):
+                self.client = self.Client(failing_keys)
+
+            class Client:
+
+                def __init__(self, failing_keys):
+                    self.failing_keys = failing_keys
+                    self.objects = {}
+
+                def put_object(self, Bucket, Key, Body):
+
+                    if Key in self.failing_keys:
+                        raise ValueError(f"Unable to write {Key}")
+
+                    self.objects[(Bucket, Key)] = Body
+
+    @parameterized.expand([
+        [
+            "Each message written to its own object",
+            ["SM1", "SM2", "SM3"],
+            [],
+            'message',
+            False,
+            ["SM1", "SM2", "SM3"],
+            ["message-SM1.json", "message-SM2.json", "message-SM3.json"],
+            []
+        ],
+        [
+            "A failed write is reported rather than swallowed",
+            ["SM1", "SM2", "SM3"],
+            ["message-SM2.json"],
+            'message',
+            False,
+            ["SM1", "SM3"],
+            ["message-SM1.json", "message-SM3.json"],
+            ["message-SM2.json"]
+        ],
+        [
+            "All messages combined into a single object partitioned by date",
+            ["SM1", "SM2", "SM3"],
+            [],
+            'json',
+            False,
+            ["SM1", "SM2", "SM3"],
+            ["dt=2019-10-20/notifications-20191020T100000.json"],
+            []
+        ],
+        [
+            "All messages combined into a single Parquet object partitioned by date",
+            ["SM1", "SM2", "SM3"],
+            [],
+            'parquet',
+            False,
+            ["SM1", "SM2", "SM3"],
+            ["dt=2019-10-20/notifications-20191020T100000.parquet"],
+            []
+        ],
+        [
+            "All messages combined into a single compressed object",
+            ["SM1", "SM2"],
+            [],
+            'json',
+            True,
+            ["SM1", "SM2"],
+            ["dt=2019-10-20/notifications-20191020T100000.json.gz"],
+            []
+        ]
+    ])
+    def test_write_notification_logs(self, test_name, message_sids, failing_keys, log_format, compress,
+                                     expected_message_ids, expected_written, expected_failed):
+
+        s3 = self.MockS3Resource(failing_keys)
+
+        write_status = quiet.write_notification_logs(
+            s3=s3,
+            bucket_name="notificationlogs",
+            message_logs=[{"sid": sid, "topic": "yellow"} for sid in message_sids],
+            max_workers=2,
+            log_format=log_format,
+            compress=compress,
+            get_current_time_function=self.mock_get_current_datetime_function)
+
+        self.assertEqual(
+            first=write_status,
+            second={'message_ids': expected_message_ids, 'written': expected_written, 'failed': expected_failed}
+        )
+
+    def test_create_batch_log_object(self):
+
+        key, body, message_ids = quiet.create_batch_log_object(
+            message_logs=[{"sid": "SM1", "level": 52.33}, {"sid": "SM2", "level": 52.33}],
+            compress=True,
+            current_time=self.mock_get_current_datetime_function())
+
+        self.assertEqual(
+            first=[json.loads(line) for line in gzip.decompress(body).decode('utf-8').split('\n')],
+            second=[{"sid": "SM1", "level": 52.33}, {"sid": "SM2", "level": 52.33}]
+        )
+
+        self.assertEqual(
+            first=message_ids,
+            second=["SM1", "SM2"]
+        )
+    @parameterized.expand([
+        ["Green level in the window", 10, 0],
+        ["Amber level in the window", 10, 2],
+        ["Red level in the window", 10, 3],
+        ["Before the window", 6, 3]
+    ])
+    def test_filter_eligible_subscribers_matches_check_eligibility(self, test_name, hour, level_category) -> None:
+        """
+        This tests that the eligibility predicates pushed into the subscriber query select the same subscribers
+        as the eligibility check followed by the topic filter in send_notifications
+        :return: None
+        """
+
+        levels = ["green", "yellow", "amber", "red"]
+        current_time = datetime(year=2019, month=10, day=20, hour=hour, tzinfo=pytz.UTC)
+        subscribers = pd.DataFrame(
+            data={
+                "last_message": ["2019-10-20 09:12:56.000", "", "2019-10-19 23:59:59.000", "",
+                                 "2019-10-20 00:00:00.000", "2019-10-18 10:00:00.000"],
+                "phone": ["07719143001", "07719143002", "07719143003", "07719143004", "07719143005", "07719143006"],
+                "topic": ["green", "green", "yellow", "amber", "red", "red"]
+            })
+
+        eligible_subscribers = quiet.check_eligibility(
+            subscriber_df_with_last_message=subscribers,
+            start_hour=7,
+            end_hour=21,
+            get_current_time_function=lambda: current_time)
+        topic_levels = eligible_subscribers['topic'].map({level: index for index, level in enumerate(levels)})
+        expected_subscribers = eligible_subscribers.loc[(topic_levels <= level_category).values]
+
+        filtered_subscribers = quiet.filter_eligible_subscribers(
+            subscriber_df_with_last_message=subscribers,
+            predicates=quiet.get_eligibility_predicates(
+                current_time=current_time, start_hour=7, end_hour=21, levels=levels, level_category=level_category))
+
+        self.assertEqual(
+            first=filtered_subscribers.to_dict('records'),
+            second=expected_subscribers.to_dict('records')
+        )
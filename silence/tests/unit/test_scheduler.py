@@ -0,0 +1,109 @@
+import unittest
+from parameterized import parameterized
+import scheduler
+
+
+class MockClock:
+    """
+    This is a mock of the wall clock which only moves when slept or when work is done
+    """
+
+    def __init__(self, now: float) -> None:
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+class TestScheduler(unittest.TestCase):
+
+    @parameterized.expand([
+        ["Before the offset in the hour", 7200 + 60, 3600, 300, 7200 + 300],
+        ["After the offset in the hour", 7200 + 600, 3600, 300, 10800 + 300],
+        ["Exactly on the boundary", 7200 + 300, 3600, 300, 10800 + 300],
+        ["No offset", 7200 + 1, 3600, 0, 10800],
+        ["Quarter hourly", 7200 + 1000, 900, 60, 7200 + 1860]
+    ])
+    def test_get_next_run_time(self, test_name, now, interval, offset, expected_next_run_time):
+
+        self.assertEqual(
+            first=scheduler.get_next_run_time(now, interval, offset),
+            second=expected_next_run_time)
+
+    def test_stage_timer(self):
+
+        clock = MockClock(0)
+        timer = scheduler.StageTimer(get_current_time_function=clock.time)
+
+        with timer.stage('query'):
+            clock.sleep(5)
+        with timer.stage('send'):
+            clock.sleep(2)
+        with timer.stage('query'):
+            clock.sleep(1)
+
+        self.assertEqual(
+            first=timer.as_dict(),
+            second={'query': 6, 'send': 2})
+
+    def test_run_aligned(self):
+
+        clock = MockClock(3600 * 5 + 1000)
+
+        # Each cycle takes 20 minutes, which would drift the start later with a fixed sleep between cycles
+        def cycle_function(scheduled_time):
+            clock.sleep(1200)
+            return {'messages': 1}
+
+        cycles = scheduler.Scheduler(
+            cycle_function, interval=3600, offset=300, get_current_time_function=clock.time,
+            sleep_function=clock.sleep).run(max_cycles=3)
+
+        self.assertEqual(
+            first=[(cycle['scheduled_time'], cycle['start_delay'], cycle['missed'], cycle['details'])
+                   for cycle in cycles],
+            second=[(3600 * 6 + 300, 0, 0, {'messages': 1}),
+                    (3600 * 7 + 300, 0, 0, {'messages': 1}),
+                    (3600 * 8 + 300, 0, 0, {'messages': 1})])
+
+    @parameterized.expand([
+        ["Skip the missed boundaries", 'skip', [(3600, 0, 2), (3600 * 4, 0, 0)]],
+        ["Coalesce the missed boundaries", 'coalesce', [(3600, 0, 2), (3600 * 3, 1000, 0)]]
+    ])
+    def test_run_overrun(self, test_name, overrun, expected_cycles):
+
+        clock = MockClock(0)
+        durations = [3600 * 2 + 1000, 10]
+
+        def cycle_function(scheduled_time):
+            clock.sleep(durations.pop(0))
+
+        cycles = scheduler.Scheduler(
+            cycle_function, interval=3600, overrun=overrun, get_current_time_function=clock.time,
+            sleep_function=clock.sleep).run(max_cycles=2)
+
+        self.assertEqual(
+            first=[(cycle['scheduled_time'], cycle['start_delay'], cycle['missed']) for cycle in cycles],
+            second=expected_cycles)
+
+    def test_run_failed_cycle(self):
+
+        clock = MockClock(0)
+        calls = []
+
+        def cycle_function(scheduled_time):
+            calls.append(scheduled_time)
+            if len(calls) == 1:
+                raise RuntimeError("Athena is down")
+
+        with self.assertLogs(level='ERROR'):
+            cycles = scheduler.Scheduler(
+                cycle_function, interval=60, get_current_time_function=clock.time,
+                sleep_function=clock.sleep).run(max_cycles=2)
+
+        self.assertEqual(
+            first=[cycle['success'] for cycle in cycles],
+            second=[False, True])
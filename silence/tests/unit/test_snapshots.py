@@ -0,0 +1,168 @@
+import unittest
+import hashlib
+import io
+import json
+from datetime import datetime
+import snapshots
+
+
+class MockS3Client:
+    """
+    This is a mock of the low level AWS S3 client holding objects in memory, using the body of each object as its ETag
+    """
+
+    class exceptions:
+
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self, objects: dict) -> None:
+        """
+        :param dict objects: The objects in the mock S3 keyed by bucket and key
+        """
+        self.objects = objects
+
+    def get_paginator(self, operation_name: str):
+
+        objects = self.objects
+
+        class Paginator:
+
+            def paginate(self, Bucket, Prefix):
+                keys = sorted(key for bucket, key in objects if bucket == Bucket and key.startswith(Prefix))
+                # Split into pages of two to exercise the pagination
+                for start in range(0, len(keys), 2):
+                    yield {'Contents': [{'Key': key, 'ETag': hash(objects[(Bucket, key)])}
+                                        for key in keys[start:start + 2]]}
+
+        return Paginator()
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body.encode('utf-8') if isinstance(Body, str) else Body
+
+    def delete_objects(self, Bucket, Delete):
+        for s3_object in Delete['Objects']:
+            del self.objects[(Bucket, s3_object['Key'])]
+
+
+class MockS3Resource:
+
+    def __init__(self, objects: dict) -> None:
+        self.meta = type('Meta', (), {'client': MockS3Client(objects)})()
+
+
+def save_subscriber(objects: dict, phone: str, topic: str) -> None:
+    phone_hash = hashlib.md5(phone.encode('utf-8')).hexdigest()
+    objects[('subscribers', 'subscriber-{}.json'.format(phone_hash))] = json.dumps(
+        {'phone': phone, 'topic': topic, 'opt-in': 'False'}).encode('utf-8')
+
+
+def remove_subscriber(objects: dict, phone: str) -> None:
+    phone_hash = hashlib.md5(phone.encode('utf-8')).hexdigest()
+    objects.pop(('subscribers', 'subscriber-{}.json'.format(phone_hash)), None)
+    objects[('snapshots', 'tombstones/tombstone-{}.json'.format(phone_hash))] = json.dumps(
+        {'phone_hash': phone_hash}).encode('utf-8')
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.objects = {}
+        self.s3 = MockS3Resource(self.objects)
+        for phone, topic in [('07000000001', 'red'), ('07000000002', 'amber'), ('07000000003', 'green')]:
+            save_subscriber(self.objects, phone, topic)
+
+    def compact(self, hour: int) -> dict:
+        return snapshots.compact_subscribers(
+            s3=self.s3,
+            subscribers_bucket='subscribers',
+            snapshots_bucket='snapshots',
+            rows_per_file=2,
+            get_current_time_function=lambda: datetime(year=2019, month=10, day=21, hour=hour))
+
+    def get_current_subscribers(self) -> list:
+        subscribers_df = snapshots.read_snapshot(
+            self.s3, 'snapshots', snapshots.get_current_snapshot(self.s3, 'snapshots'))
+        return sorted(zip(subscribers_df['phone'], subscribers_df['topic']))
+
+    def test_compact_subscribers(self):
+
+        compaction_status = self.compact(hour=1)
+
+        self.assertEqual(
+            first=(compaction_status, self.get_current_subscribers()),
+            second=(
+                {'snapshot': '20191021T010000', 'subscribers': 3, 'subscribers_merged': 3, 'tombstones_merged': 0,
+                 'subscribers_deleted': 3, 'tombstones_deleted': 0, 'snapshots_deleted': []},
+                [('07000000001', 'red'), ('07000000002', 'amber'), ('07000000003', 'green')]))
+
+        # The snapshot is split into a file for each topic and the per subscriber objects are gone
+        self.assertEqual(
+            first=sorted(key for bucket, key in self.objects),
+            second=['current-snapshot.json',
+                    'snapshots/snapshot_id=20191021T010000/part-00000.parquet',
+                    'snapshots/snapshot_id=20191021T010000/part-00001.parquet',
+                    'snapshots/snapshot_id=20191021T010000/part-00002.parquet'])
+
+    def test_compact_subscribers_with_changes(self):
+
+        self.compact(hour=1)
+
+        # Change topic, unsubscribe, subscribe, and unsubscribe then subscribe again
+        save_subscriber(self.objects, '07000000001', 'yellow')
+        save_subscriber(self.objects, '07000000003', 'green')
+        remove_subscriber(self.objects, '07000000002')
+        remove_subscriber(self.objects, '07000000003')
+        save_subscriber(self.objects, '07000000003', 'red')
+        self.objects.pop(('snapshots', 'tombstones/tombstone-{}.json'.format(
+            hashlib.md5(b'07000000003').hexdigest())))
+        save_subscriber(self.objects, '07000000004', 'amber')
+
+        self.compact(hour=2)
+        compaction_status = self.compact(hour=3)
+
+        self.assertEqual(
+            first=(compaction_status['snapshots_deleted'], self.get_current_subscribers()),
+            second=(['20191021T010000'],
+                    [('07000000001', 'yellow'), ('07000000003', 'red'), ('07000000004', 'amber')]))
+
+    def test_compact_subscribers_by_topic(self):
+
+        # Saved under the topic layout, with one subscriber also left at the top of the bucket from the flat layout
+        for key in list(self.objects):
+            subscriber = json.loads(self.objects[key])
+            self.objects[(key[0], 'topic={}/{}'.format(subscriber['topic'], key[1]))] = self.objects.pop(key)
+        save_subscriber(self.objects, '07000000001', 'red')
+
+        compaction_status = self.compact(hour=1)
+
+        self.assertEqual(
+            first=(compaction_status['subscribers_deleted'], self.get_current_subscribers()),
+            second=(4, [('07000000001', 'red'), ('07000000002', 'amber'), ('07000000003', 'green')]))
+
+    def test_merge_subscribers_delta_wins_over_tombstone(self):
+
+        phone_hash = hashlib.md5(b'07000000001').hexdigest()
+
+        subscribers_df = snapshots.merge_subscribers(
+            snapshot_df=snapshots.read_snapshot(self.s3, 'snapshots', None),
+            subscribers=[{'phone': '07000000001', 'topic': 'red', 'opt-in': 'True'}],
+            tombstones=[{'phone_hash': phone_hash}])
+
+        self.assertEqual(
+            first=subscribers_df.to_dict('records'),
+            second=[{'phone_hash': phone_hash, 'phone': '07000000001', 'topic': 'red', 'opt_in': 'True'}])
+
+    def test_deleted_objects_changed_since_read_are_kept(self):
+
+        etags = snapshots.list_object_etags(self.s3, 'subscribers', 'subscriber-')
+        save_subscriber(self.objects, '07000000001', 'yellow')
+
+        self.assertEqual(
+            first=snapshots.delete_unchanged_objects(self.s3, 'subscribers', etags, 'subscriber-'),
+            second=2)
@@ -0,0 +1,197 @@
+import unittest
+from parameterized import parameterized
+import throttle
+
+
+class MockThrottledError(Exception):
+    """
+    This mocks the error raised by a provider when a request is throttled
+    """
+
+    def __init__(self, status: int, headers: dict = None) -> None:
+        """
+        :param int status: The HTTP status code of the response
+        :param dict headers: The headers of the response
+        """
+        super().__init__(status)
+        self.status = status
+        self.headers = headers
+
+
+class MockClock:
+    """
+    This mocks the passing of time so that waiting is instant
+    """
+
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.waits = []
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.waits.append(seconds)
+        self.now += seconds
+
+
+class TestThrottle(unittest.TestCase):
+
+    @parameterized.expand([
+        [
+            "A full bucket allows a burst without waiting",
+            2,
+            3,
+            3,
+            []
+        ],
+        [
+            "An empty bucket waits for each token to be refilled",
+            2,
+            1,
+            3,
+            [0.5, 0.5]
+        ]
+    ])
+    def test_token_bucket(self, test_name, rate, capacity, requests, expected_waits):
+
+        clock = MockClock()
+
+        bucket = throttle.TokenBucket(
+            rate=rate,
+            capacity=capacity,
+            get_current_time_function=clock.time,
+            sleep_function=clock.sleep)
+
+        for _ in range(requests):
+            bucket.acquire()
+
+        self.assertEqual(
+            first=clock.waits,
+            second=expected_waits
+        )
+
+    @parameterized.expand([
+        [
+            "Not throttled",
+            ValueError("Bad request"),
+            False,
+            None
+        ],
+        [
+            "Throttled by status code without a Retry-After header",
+            MockThrottledError(status=429),
+            True,
+            None
+        ],
+        [
+            "Throttled by status code with a Retry-After header",
+            MockThrottledError(status=429, headers={'Retry-After': '7'}),
+            True,
+            7.0
+        ]
+    ])
+    def test_is_throttled(self, test_name, error, expected_throttled, expected_retry_after):
+
+        self.assertEqual(
+            first=throttle.is_throttled(error),
+            second=expected_throttled
+        )
+
+        self.assertEqual(
+            first=throttle.get_retry_after(error),
+            second=expected_retry_after
+        )
+
+    def test_call_retries_throttled_requests(self):
+
+        clock = MockClock()
+        errors = [MockThrottledError(status=429), MockThrottledError(status=429, headers={'Retry-After': '5'})]
+
+        def request():
+            if errors:
+                raise errors.pop(0)
+            return "sent"
+
+        test_throttle = throttle.Throttle(
+            bucket=throttle.TokenBucket(
+                rate=100,
+                capacity=100,
+                get_current_time_function=clock.time,
+                sleep_function=clock.sleep),
+            base_delay=1,
+            sleep_function=clock.sleep,
+            random_function=lambda low, high: high)
+
+        self.assertEqual(
+            first=test_throttle.call(request),
+            second="sent"
+        )
+
+        self.assertEqual(
+            first=clock.waits,
+            second=[1, 6.0]
+        )
+
+        self.assertEqual(
+            first=test_throttle.counters.as_dict(),
+            second={'sent': 1, 'queued': 0, 'throttled': 2, 'retried': 2, 'failed': 0}
+        )
+
+    def test_call_gives_up_after_max_retries(self):
+
+        clock = MockClock()
+
+        def request():
+            raise MockThrottledError(status=429)
+
+        test_throttle = throttle.Throttle(
+            bucket=throttle.TokenBucket(
+                rate=100,
+                get_current_time_function=clock.time,
+                sleep_function=clock.sleep),
+            max_retries=2,
+            sleep_function=clock.sleep)
+
+        with self.assertRaises(MockThrottledError):
+            test_throttle.call(request)
+
+        self.assertEqual(
+            first=test_throttle.counters.as_dict(),
+            second={'sent': 0, 'queued': 0, 'throttled': 3, 'retried': 2, 'failed': 1}
+        )
+
+    @parameterized.expand([
+        ["Within the maximum delay", '3', [4.0], 'sent'],
+        ["The jitter is capped at the maximum delay", '4.5', [5], 'sent'],
+        ["Longer than the maximum delay", '30', [], None]
+    ])
+    def test_call_retry_after_limited_by_max_delay(self, test_name, retry_after, expected_waits, expected_result):
+
+        clock = MockClock()
+        errors = [MockThrottledError(status=429, headers={'Retry-After': retry_after})]
+
+        def request():
+            if errors:
+                raise errors.pop(0)
+            return "sent"
+
+        test_throttle = throttle.Throttle(
+            bucket=throttle.TokenBucket(
+                rate=100,
+                get_current_time_function=clock.time,
+                sleep_function=clock.sleep),
+            base_delay=1,
+            max_delay=5,
+            sleep_function=clock.sleep,
+            random_function=lambda low, high: high)
+
+        try:
+            result = test_throttle.call(request)
+        except MockThrottledError:
+            result = None
+
+        self.assertEqual(
+            first=(result, clock.waits),
+            second=(expected_result, expected_waits)
+        )
@@ -1,7 +1,6 @@
 import unittest
 from parameterized import parameterized
 import utilities
-import os
 import botocore
 
 
@@ -115,51 +114,3 @@ class TestFeathers(unittest.TestCase):
                 secret_key=private_key,
                 region=region
             )
-
-
-    @parameterized.expand([
-        [
-            "Delete a single file which exists",
-            ["./data/test.txt"],
-            ["./data/test.txt"],
-            ["./data/test.txt"]
-        ],
-        [
-            "Delete a file which exists and ignore a file which does not exist",
-            ["./data/test.txt", "./data/test_does_not_exist.json"],
-            ["./data/test.txt"],
-            ["./data/test.txt"]
-        ],
-        [
-            "Delete a file which exists and ignore a file which does not exist",
-            ["./data/test.txt", "./data/test_does_exist.json"],
-            ["./data/test.txt", "./data/test_does_exist.json"],
-            ["./data/test.txt", "./data/test_does_exist.json"]
-        ],
-        [
-            "Delete a file which exists and ignore a file which does not exist",
-            ["./data/test.txt", "./data/test_does_exist.json"],
-            [],
-            []
-        ]
-    ])
-    def test_delete_files_success(self, test_name, file_paths, file_paths_to_seed, expected_outcome):
-
-        file_paths = [os.path.join(os.path.dirname(os.path.abspath(__file__)), file_path) for file_path in file_paths]
-        file_paths_to_seed = [os.path.join(os.path.dirname(os.path.abspath(__file__)), file_path) for file_path in file_paths_to_seed]
-        expected_outcome = [os.path.join(os.path.dirname(os.path.abspath(__file__)), file_path) for file_path in expected_outcome]
-
-        for file_path in file_paths_to_seed:
-
-            with open(file_path, "w+") as f:
-                f.write("This is a test file")
-
-            if not os.path.exists(file_path):
-                raise FileNotFoundError("Test file not created successfully")
-
-        files_deleted = utilities.delete_files(file_paths)
-
-        self.assertEqual(
-            first=files_deleted,
-            second=expected_outcome
-        )
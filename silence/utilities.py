@@ -1,16 +1,23 @@
-import boto3
-import os
+import clients
 
 
 def create_aws_client(client_type: str, public_key: str = None, secret_key: str = None, region:
-                      str = None):
+                      str = None, max_pool_connections: int = 10, connect_timeout: float = 5, read_timeout: float = 60,
+                      max_attempts: int = 5, retry_mode: str = 'adaptive'):
     """
-    Creates an AWS client of the specified type
+    Creates an AWS client of the specified type, clients with the same settings are shared along with their
+    connection pools
     
     :param str client_type: The type of client to create e.g. s3
     :param str public_key: The public key to use with this client
     :param str secret_key: The secret key to use with this client
     :param str region: The AWS region to use with this client
+    :param int max_pool_connections: The maximum number of connections to keep in the client's pool, this
+    should be at least the number of threads sharing the client
+    :param float connect_timeout: The number of seconds to wait to make a connection
+    :param float read_timeout: The number of seconds to wait for a response
+    :param int max_attempts: The maximum number of attempts to make for each request, including the first
+    :param str retry_mode: How to retry requests, adaptive also slows the client down when AWS is throttling it
     
     :return: The AWS client
     """
@@ -25,34 +32,16 @@ def create_aws_client(client_type: str, public_key: str = None, secret_key: str
     else:
         client_type = client_type.lower()
 
-    # Check if the environment variables exist, they are only required for external access
-    if public_key is not None and secret_key is not None:
-
-        session = boto3.Session(
-            aws_access_key_id=public_key,
-            aws_secret_access_key=secret_key,
-            region_name=region
-        )
-        return getattr(session, client_mapping[client_type])(client_type)
-
-    # If no environment variables rely on a AWS role instead
-    else:
-        return getattr(boto3, client_mapping[client_type])(service_name=client_type, region_name=region)
-
-
-def delete_files(file_paths: list) -> list:
-    """
-    Deletes all the provided files if they exist
-
-    :param list[str] file_paths: The file paths to delete
-    :return: list[str] deleted_files: The files that were deleted
-    """
-    deleted_files = []
-
-    for file_path in file_paths:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            deleted_files.append(file_path)
-
-    return deleted_files
+    # If no credentials are provided boto3 relies on an AWS role instead
+    return clients.create_aws_client(
+        service_name=client_type,
+        resource=client_mapping[client_type] == "resource",
+        public_key=public_key,
+        secret_key=secret_key,
+        region=region,
+        max_pool_connections=max_pool_connections,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        max_attempts=max_attempts,
+        retry_mode=retry_mode)
 